@@ -1,15 +1,22 @@
+import asyncio
 import logging
 import os
 from pathlib import Path
 from typing import Optional
 from aiohttp import web
 from dotenv import load_dotenv
-from backend.tools.rag.ai_search import report_grounding_tool, search_tool
+from backend.tools.rag.ai_search import refresh_index_version, report_grounding_tool, search_tool
+from backend.tools.rag.search_cache import SearchResultCache
+from backend.tools.rag.context_packing import ContextPacker
+from backend.tools.rag.search_resilience import SearchResilience
+from backend.tools.rag.local_search import AzureOpenAIEmbedder, LocalSearchIndex, local_report_grounding_tool, local_search_tool
 from backend.helpers import load_prompt_from_markdown
+from backend.rtmt import RTMiddleTier, DEFAULT_MAX_SESSIONS, DEFAULT_ACS_PLAYOUT_DELAY_MS, DEFAULT_WEB_PLAYOUT_DELAY_MS, DEFAULT_SEND_QUEUE_MAX_AUDIO_MS
+from backend.azure import OPENAI_SCOPE, SEARCH_SCOPE, AzureStoragePrompt, AzureTokenCache, get_azure_credentials
 from backend.rtmt import RTMiddleTier
-from backend.azure import get_azure_credentials, fetch_prompt_from_azure_storage
-from backend.rtmt import RTMiddleTier
-from backend.acs import AcsCaller
+from backend.acs import ACS_AUDIO_FORMATS, AcsCaller
+from backend.audio import AUDIO_FORMATS
+from backend.metrics import CONTENT_TYPE, REGISTRY, monitor_event_loop_lag
 from azure.core.credentials import AzureKeyCredential
 from azure.search.documents.aio import SearchClient
 
@@ -18,10 +25,16 @@ logger = logging.getLogger("voicerag")
 
 async def create_app():
     load_dotenv()
+    # Only the application's own logger, the Azure SDKs log every request and response header at INFO
+    logger.setLevel(os.environ.get("LOG_LEVEL", "WARNING").upper())
 
     azure_credentials = get_azure_credentials(os.environ.get("AZURE_TENANT_ID"))
+    token_cache = AzureTokenCache(azure_credentials, [OPENAI_SCOPE, SEARCH_SCOPE])
     search_client: Optional[SearchClient] = None
+    search_cache: Optional[SearchResultCache] = None
     caller: Optional[AcsCaller] = None
+    prompt_source: Optional[AzureStoragePrompt] = None
+    search_resilience: Optional[SearchResilience] = None
 
     # Load LLM connection and authentication
     llm_endpoint = os.environ.get("AZURE_OPENAI_ENDPOINT")
@@ -47,6 +60,12 @@ async def create_app():
     acs_connection_string = os.environ.get("ACS_CONNECTION_STRING")
     acs_callback_path = os.environ.get("ACS_CALLBACK_PATH")
     acs_media_streaming_websocket_path = os.environ.get("ACS_MEDIA_STREAMING_WEBSOCKET_PATH")
+    # The format of /realtime-acs may be any of AUDIO_FORMATS, e.g. for other telephony gateways, while
+    # Call Automation only streams a subset. It uses the same format if it can, 24 kHz PCM otherwise.
+    acs_audio_format = os.environ.get("ACS_AUDIO_FORMAT", "pcm24k")
+    if acs_audio_format not in AUDIO_FORMATS:
+        raise ValueError(f"Unsupported ACS_AUDIO_FORMAT {acs_audio_format}, use one of {', '.join(AUDIO_FORMATS)}")
+    acs_media_streaming_audio_format = os.environ.get("ACS_MEDIA_STREAMING_AUDIO_FORMAT", acs_audio_format if acs_audio_format in ACS_AUDIO_FORMATS else "pcm24k")
     if (acs_source_number is not None and
         acs_connection_string is not None and
         acs_callback_path is not None and
@@ -55,41 +74,104 @@ async def create_app():
             acs_source_number,
             acs_connection_string,
             acs_callback_path,
-            acs_media_streaming_websocket_path
+            acs_media_streaming_websocket_path,
+            acs_media_streaming_audio_format
         )
     else:
         logger.warning("Azure Communication Services is not configured")
 
     # Create the OpenAI Realtime API handler
-    rtmt = RTMiddleTier(llm_endpoint, llm_deployment, llm_credential)
+    rtmt_max_sessions = int(os.environ.get("RTMT_MAX_SESSIONS", DEFAULT_MAX_SESSIONS))
+    rtmt_audio_coalesce_ms = int(os.environ.get("RTMT_AUDIO_COALESCE_MS", 0))
+    rtmt_pool_size = int(os.environ.get("RTMT_POOL_SIZE", 0))
+    rtmt_pool_max_idle_seconds = float(os.environ.get("RTMT_POOL_MAX_IDLE_SECONDS", 60))
+    rtmt_tool_timeout_seconds = float(os.environ.get("RTMT_TOOL_TIMEOUT_SECONDS", 10))
+    rtmt_speculative_tools = os.environ.get("RTMT_SPECULATIVE_TOOLS", "false").lower() == "true"
+    rtmt_web_playout_delay_ms = float(os.environ.get("RTMT_WEB_PLAYOUT_DELAY_MS", DEFAULT_WEB_PLAYOUT_DELAY_MS))
+    rtmt_acs_playout_delay_ms = float(os.environ.get("RTMT_ACS_PLAYOUT_DELAY_MS", DEFAULT_ACS_PLAYOUT_DELAY_MS))
+    rtmt_acs_playout_lead_ms = float(os.environ.get("RTMT_ACS_PLAYOUT_LEAD_MS", 0))
+    rtmt_recording_dir = os.environ.get("RTMT_RECORDING_DIR")
+    rtmt_greeting_cache_dir = os.environ.get("RTMT_GREETING_CACHE_DIR")
+    rtmt_send_queue_max_audio_ms = float(os.environ.get("RTMT_SEND_QUEUE_MAX_AUDIO_MS", DEFAULT_SEND_QUEUE_MAX_AUDIO_MS))
+    rtmt_silence_threshold_dbfs = os.environ.get("RTMT_SILENCE_THRESHOLD_DBFS")
+    rtmt_silence_hangover_ms = float(os.environ.get("RTMT_SILENCE_HANGOVER_MS", 700))
+    rtmt_silence_padding_ms = float(os.environ.get("RTMT_SILENCE_PADDING_MS", 300))
+    rtmt = RTMiddleTier(
+        llm_endpoint,
+        llm_deployment,
+        llm_credential,
+        max_sessions=rtmt_max_sessions,
+        audio_coalesce_ms=rtmt_audio_coalesce_ms,
+        pool_size=rtmt_pool_size,
+        pool_max_idle_seconds=rtmt_pool_max_idle_seconds,
+        token_cache=token_cache,
+        tool_timeout_seconds=rtmt_tool_timeout_seconds,
+        speculative_tools=rtmt_speculative_tools,
+        web_playout_delay_ms=rtmt_web_playout_delay_ms,
+        acs_playout_delay_ms=rtmt_acs_playout_delay_ms,
+        acs_playout_lead_ms=rtmt_acs_playout_lead_ms,
+        acs_audio_format=acs_audio_format,
+        recording_dir=rtmt_recording_dir,
+        greeting_cache_dir=rtmt_greeting_cache_dir,
+        send_queue_max_audio_ms=rtmt_send_queue_max_audio_ms,
+        silence_threshold_dbfs=float(rtmt_silence_threshold_dbfs) if rtmt_silence_threshold_dbfs else None,
+        silence_hangover_ms=rtmt_silence_hangover_ms,
+        silence_padding_ms=rtmt_silence_padding_ms
+    )
 
-    # Set the system prompt
-    system_prompt = None
+    # Set the system prompt, the hardcoded one is used until the one from Azure Storage has been fetched at startup
+    BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+    file_path = os.path.join(BASE_DIR, 'system_prompt.md')  # Ensure the file is in the same folder
+    rtmt.system_message = await load_prompt_from_markdown(file_path)
+    system_prompt_source = "local"
 
-    # Attempt to fetch from Azure Storage
+    # The prompt in Azure Storage is checked for changes in the background after it was fetched
     try:
-        system_prompt = await fetch_prompt_from_azure_storage(
+        prompt_source = AzureStoragePrompt.from_environment(
             container_name='prompt',
             file_name='system_prompt.md'
         )
     except Exception as e:
         logger.warning(f"Could not fetch system prompt from Azure Storage: {e}")
-        BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-        file_path = os.path.join(BASE_DIR, 'system_prompt.md')  # Ensure the file is in the same folder
-        system_prompt = await load_prompt_from_markdown(file_path)
-
-    rtmt.system_message = system_prompt
 
     # Register the tools for function calling
+    search_context_max_tokens = int(os.environ.get("SEARCH_CONTEXT_MAX_TOKENS", 0))
+    search_context_packer = ContextPacker(search_context_max_tokens) if search_context_max_tokens > 0 else None
     if search_client is not None and search_semantic_configuration is not None:
-        rtmt.tools["search"] = search_tool(search_client, search_semantic_configuration)
-        rtmt.tools["report_grounding"] = report_grounding_tool(search_client)
+        search_cache_size = int(os.environ.get("AZURE_SEARCH_CACHE_SIZE", 256))
+        search_cache_ttl_seconds = float(os.environ.get("AZURE_SEARCH_CACHE_TTL_SECONDS", 600))
+        search_index_version = os.environ.get("AZURE_SEARCH_INDEX_VERSION", "")
+        if search_cache_size > 0:
+            search_cache = SearchResultCache(search_cache_size, search_cache_ttl_seconds, search_index_version)
+        search_resilience = SearchResilience(
+            hedge_percentile=float(os.environ.get("AZURE_SEARCH_HEDGE_PERCENTILE", 95)),
+            failure_threshold=int(os.environ.get("AZURE_SEARCH_BREAKER_FAILURES", 5)),
+            open_seconds=float(os.environ.get("AZURE_SEARCH_BREAKER_OPEN_SECONDS", 30)),
+            # Shorter than the tool timeout, so a hung search still counts as a failure and can fall back to the cache
+            timeout_seconds=float(os.environ.get("AZURE_SEARCH_TIMEOUT_SECONDS", rtmt_tool_timeout_seconds * 0.6))
+        )
+        rtmt.tools["search"] = search_tool(search_client, search_semantic_configuration, search_cache, search_context_packer, search_resilience)
+        if search_cache is not None:
+            REGISTRY.counter("voicerag_search_cache_hits_total", "Searches answered from the search result cache", function=lambda: search_cache.hits)
+            REGISTRY.counter("voicerag_search_cache_misses_total", "Searches sent to Azure AI Search", function=lambda: search_cache.misses)
+            REGISTRY.counter("voicerag_search_cache_coalesced_total", "Searches that joined an identical search in flight", function=lambda: search_cache.coalesced)
+        rtmt.tools["report_grounding"] = report_grounding_tool(search_client, search_resilience)
+
+    # A local index replaces Azure AI Search, e.g. for small knowledge bases or to run without the network hop
+    local_search_index_path = os.environ.get("LOCAL_SEARCH_INDEX_PATH")
+    if local_search_index_path is not None:
+        search_resilience = None
+        # Queries are embedded like the index was built, with the hashing embedder unless an embedding deployment is set
+        local_search_index = LocalSearchIndex(local_search_index_path, AzureOpenAIEmbedder.from_environment(azure_credentials))
+        rtmt.tools["search"] = local_search_tool(local_search_index, search_context_packer)
+        rtmt.tools["report_grounding"] = local_report_grounding_tool(local_search_index)
 
     # Define the WebSocket handler for the Web Frontend
     async def websocket_handler(request: web.Request):
         ws = web.WebSocketResponse()
         await ws.prepare(request)
-        await rtmt.forward_messages(ws, False)
+        # The web client passes the voice selected in its UI, it only applies to this session
+        await rtmt.forward_messages(ws, False, request.query.get("voice"))
         return ws
 
     # Define the WebSocket handler for the Azure Communication Services Audio Stream
@@ -109,11 +191,6 @@ async def create_app():
     async def index(request):
         return web.FileResponse(static_directory / 'index.html')
     
-    async def update_voice(request):
-        data = await request.json()
-        rtmt.selected_voice = data.get('voice', 'alloy')
-        return web.Response(text="Voice selected successfully")
-
     async def call(request):
         body = await request.json()
         if (caller is not None):
@@ -122,6 +199,32 @@ async def create_app():
         else:
             return web.Response(text="Outbound calling is not configured")
 
+    async def metrics(request):
+        return web.Response(body=REGISTRY.render().encode("utf-8"), headers={"Content-Type": CONTENT_TYPE})
+
+    async def healthz(request):
+        return web.Response(text="ok")
+
+    async def ready(request):
+        # Dependencies a call needs right away, the connection pool only speeds calls up and is reported for information
+        checks = {
+            "warm_up": warmed_up,
+            "openai_token": bool(llm_key) or token_cache.is_warm(OPENAI_SCOPE),
+        }
+        is_ready = all(checks.values())
+        return web.json_response({
+            "ready": is_ready,
+            "checks": checks,
+            # Calls go on without grounding while Azure AI Search is unavailable, so it doesn't take the worker out of rotation
+            "search": None if search_resilience is None else {
+                "warm": search_resilience.succeeded,
+                "circuit_open": search_resilience.is_open,
+            },
+            "system_prompt": system_prompt_source,
+            "sessions": len(rtmt.sessions),
+            "pooled_connections": rtmt.pooled_connections,
+        }, status=200 if is_ready else 503)
+
     async def get_source_phone_number(request):
         phone_number = os.environ.get("ACS_SOURCE_NUMBER")
         return web.json_response({"phoneNumber": phone_number})
@@ -133,13 +236,101 @@ async def create_app():
     app.router.add_post('/call', call)
     app.router.add_get("/realtime", websocket_handler)
     app.router.add_get("/realtime-acs", websocket_handler_acs)
-    app.router.add_post('/update-voice', update_voice)
     app.router.add_get('/source-phone-number', get_source_phone_number)
+    app.router.add_get('/metrics', metrics)
+    app.router.add_get('/healthz', healthz)
+    app.router.add_get('/ready', ready)
     
     if (caller is not None):
         app.router.add_post("/acs", caller.outbound_call_handler)
         app.router.add_post("/acs/incoming", caller.inbound_call_handler)
 
+    # Start and stop the background work of the middle tier together with the app
+    background_tasks: list[asyncio.Task] = []
+    warmed_up = False
+    startup_timeout_seconds = float(os.environ.get("STARTUP_TIMEOUT_SECONDS", 10))
+
+    async def fetch_system_prompt():
+        nonlocal prompt_source, system_prompt_source
+        # If this times out, the source is kept and the watcher applies the prompt once it arrives
+        try:
+            rtmt.set_system_message(await prompt_source.fetch())
+            system_prompt_source = "azure-storage"
+        except Exception:
+            await prompt_source.close()
+            prompt_source = None
+            raise
+
+    async def warm_up_search(first_attempt: asyncio.Event):
+        # Retried until it succeeds, the first attempt is awaited as a startup step
+        retry_seconds = float(os.environ.get("AZURE_SEARCH_WARM_UP_RETRY_SECONDS", 10))
+        while True:
+            try:
+                await asyncio.wait_for(search_resilience.call("warm_up", search_client.get_document_count), startup_timeout_seconds)
+                return
+            except asyncio.TimeoutError:
+                logger.warning("Azure AI Search warm-up did not finish within %s seconds, retrying in %s seconds", startup_timeout_seconds, retry_seconds)
+            except Exception as e:
+                logger.warning("Azure AI Search warm-up failed, retrying in %s seconds: %s", retry_seconds, e)
+            finally:
+                first_attempt.set()
+            await asyncio.sleep(retry_seconds)
+
+    async def run_startup_step(name: str, step):
+        try:
+            await asyncio.wait_for(step, startup_timeout_seconds)
+        except asyncio.TimeoutError:
+            logger.warning("Startup step %s did not finish within %s seconds", name, startup_timeout_seconds)
+        except Exception as e:
+            logger.warning("Startup step %s failed: %s", name, e)
+
+    async def warm_up(steps: list):
+        nonlocal warmed_up
+        await asyncio.gather(*steps)
+        warmed_up = True
+        logger.info("Warm-up finished, ready for calls")
+        if prompt_source is not None:
+            prompt_poll_seconds = float(os.environ.get("AZURE_STORAGE_PROMPT_POLL_SECONDS", 60))
+            if prompt_poll_seconds > 0:
+                background_tasks.append(asyncio.create_task(prompt_source.watch(rtmt.set_system_message, prompt_poll_seconds)))
+
+    async def on_startup(app):
+        background_tasks.append(asyncio.create_task(monitor_event_loop_lag()))
+        # Independent warm-up steps run concurrently in the background, the worker already listens meanwhile
+        # and /ready reports it as not ready until they finished or timed out
+        steps = []
+        if not llm_key:
+            # Only needed for Entra ID authentication, warms the tokens before the pool connects.
+            # Shielded, so the cache keeps refreshing in the background even if the first token is late.
+            steps.append(run_startup_step("token", asyncio.shield(token_cache.start())))
+        if prompt_source is not None:
+            steps.append(run_startup_step("system prompt", fetch_system_prompt()))
+        if search_resilience is not None:
+            search_attempted = asyncio.Event()
+            background_tasks.append(asyncio.create_task(warm_up_search(search_attempted)))
+            steps.append(run_startup_step("search", search_attempted.wait()))
+        await rtmt.start()
+        background_tasks.append(asyncio.create_task(warm_up(steps)))
+        if search_cache is not None:
+            search_index_version_poll_seconds = float(os.environ.get("AZURE_SEARCH_INDEX_VERSION_POLL_SECONDS", 300))
+            if search_index_version_poll_seconds > 0:
+                background_tasks.append(asyncio.create_task(refresh_index_version(search_client, search_cache, search_index_version, search_index_version_poll_seconds)))
+
+    async def on_cleanup(app):
+        for task in background_tasks:
+            task.cancel()
+        await rtmt.close()
+        await token_cache.close()
+        if prompt_source is not None:
+            await prompt_source.close()
+        if caller is not None:
+            await caller.close()
+        if search_client is not None:
+            await search_client.close()
+
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+
     return app
 
 if __name__ == "__main__":
@@ -1,26 +1,63 @@
+import asyncio
+import logging
+from typing import Optional
 from aiohttp import web
 from azure.core.messaging import CloudEvent
 from azure.eventgrid import EventGridEvent
 from azure.communication.callautomation import (
-    CallAutomationClient,
     PhoneNumberIdentifier,
     MediaStreamingOptions,
     MediaStreamingTransportType,
     MediaStreamingContentType,
     MediaStreamingAudioChannelType,
     AudioFormat)
+from azure.communication.callautomation.aio import CallAutomationClient
+
+logger = logging.getLogger("voicerag")
+
+# Media streaming formats ACS supports for bidirectional audio, by the names used in backend.audio.AUDIO_FORMATS.
+# 16 kHz is all a phone line carries and needs a third less bandwidth than 24 kHz, the middle tier resamples it.
+ACS_AUDIO_FORMATS = {
+    "pcm24k": AudioFormat.PCM24_K_MONO,
+    "pcm16k": AudioFormat.PCM16_K_MONO,
+}
+
+class AcsCall:
+    """
+    State of a single call handled through Call Automation, keyed by its call connection id.
+    """
+    call_connection_id: str
+    direction: str
+    state: str
+    target_number: Optional[str]
+
+    def __init__(self, call_connection_id: str, direction: str, state: str, target_number: Optional[str] = None):
+        self.call_connection_id = call_connection_id
+        self.direction = direction
+        self.state = state
+        self.target_number = target_number
 
 class AcsCaller:
     source_number: str
     acs_connection_string: str
     acs_callback_path: str
     websocket_url: str
+    audio_format: str
     media_streaming_configuration: MediaStreamingOptions
 
-    def __init__(self, source_number:str, acs_connection_string: str, acs_callback_path: str, acs_media_streaming_websocket_path: str):
+    # Calls that were created or answered and have not been disconnected yet
+    calls: dict[str, AcsCall]
+
+    _call_automation_client: Optional[CallAutomationClient] = None
+
+    def __init__(self, source_number:str, acs_connection_string: str, acs_callback_path: str, acs_media_streaming_websocket_path: str, audio_format: str = "pcm24k"):
         self.source_number = source_number
         self.acs_connection_string = acs_connection_string
         self.acs_callback_path = acs_callback_path
+        self.calls = {}
+        if audio_format not in ACS_AUDIO_FORMATS:
+            raise ValueError(f"Unsupported ACS audio format {audio_format}, use one of {', '.join(ACS_AUDIO_FORMATS)}")
+        self.audio_format = audio_format
         self.media_streaming_configuration = MediaStreamingOptions(
             transport_url=acs_media_streaming_websocket_path,
             transport_type=MediaStreamingTransportType.WEBSOCKET,
@@ -28,27 +65,40 @@ class AcsCaller:
             audio_channel_type=MediaStreamingAudioChannelType.MIXED,
             start_media_streaming=True,
             enable_bidirectional=True,
-            audio_format=AudioFormat.PCM24_K_MONO
+            audio_format=ACS_AUDIO_FORMATS[audio_format]
         )
-    
-    async def initiate_call(self, target_number: str):
-        self.call_automation_client = CallAutomationClient.from_connection_string(self.acs_connection_string)
-        self.target_participant = PhoneNumberIdentifier(target_number)
-        self.source_caller = PhoneNumberIdentifier(self.source_number)
-        self.call_automation_client.create_call(
-            self.target_participant, 
+
+    def _get_client(self) -> CallAutomationClient:
+        # One long-lived async client for the process, its HTTP transport keeps connections to ACS open between calls
+        if self._call_automation_client is None:
+            self._call_automation_client = CallAutomationClient.from_connection_string(self.acs_connection_string)
+        return self._call_automation_client
+
+    async def close(self):
+        if self._call_automation_client is not None:
+            await self._call_automation_client.close()
+            self._call_automation_client = None
+
+    async def initiate_call(self, target_number: str) -> AcsCall:
+        call_connection_properties = await self._get_client().create_call(
+            PhoneNumberIdentifier(target_number),
             self.acs_callback_path,
             media_streaming=self.media_streaming_configuration,
-            source_caller_id_number=self.source_caller
+            source_caller_id_number=PhoneNumberIdentifier(self.source_number)
         )
+        call = AcsCall(call_connection_properties.call_connection_id, "outbound", call_connection_properties.call_connection_state, target_number)
+        self.calls[call.call_connection_id] = call
+        return call
 
-    async def answer_inbound_call(self, incoming_call_context: str):
-        self.call_automation_client = CallAutomationClient.from_connection_string(self.acs_connection_string)
-        self.call_automation_client.answer_call(
+    async def answer_inbound_call(self, incoming_call_context: str) -> AcsCall:
+        call_connection_properties = await self._get_client().answer_call(
             incoming_call_context,
             self.acs_callback_path,
             media_streaming=self.media_streaming_configuration
         )
+        call = AcsCall(call_connection_properties.call_connection_id, "inbound", call_connection_properties.call_connection_state)
+        self.calls[call.call_connection_id] = call
+        return call
 
     async def outbound_call_handler(self, request):
         cloudevent = await request.json() 
@@ -58,10 +108,15 @@ class AcsCaller:
                 continue
                 
             call_connection_id = event.data['callConnectionId']
-            print(f"{event.type} event received for call connection id: {call_connection_id}")
+            logger.info("%s event received for call connection id: %s", event.type, call_connection_id)
 
+            call = self.calls.get(call_connection_id)
             if event.type == "Microsoft.Communication.CallConnected":
-                print("Call connected")            
+                logger.info("Call connected")
+                if call is not None:
+                    call.state = "connected"
+            elif event.type == "Microsoft.Communication.CallDisconnected":
+                self.calls.pop(call_connection_id, None)
 
         return web.Response(status=200)
 
@@ -77,22 +132,24 @@ class AcsCaller:
         # Handle incoming call events
         try:
             event_data = await request.json()
-            print(f"Received event data: {event_data}")
+            logger.debug("Received event data: %s", event_data)
             
-            # EventGrid sends events in an array
+            # EventGrid sends events in an array, answer all incoming calls of a batch at the same time
+            incoming_call_contexts = []
             for event_dict in event_data:
-                print(f"Processing event: {event_dict}")
+                logger.debug("Processing event: %s", event_dict)
                 event = EventGridEvent.from_dict(event_dict)
-                
+
                 if event.event_type == "Microsoft.Communication.IncomingCall":
-                    print(f"Incoming call event data: {event.data}")
-                    incoming_call_context = event.data['incomingCallContext']
-                    await self.answer_inbound_call(incoming_call_context)
-                    print("Incoming call answered")
-                    return web.Response(status=200)
-                
+                    logger.info("Incoming call event data: %s", event.data)
+                    incoming_call_contexts.append(event.data['incomingCallContext'])
+
+            if len(incoming_call_contexts) > 0:
+                await asyncio.gather(*(self.answer_inbound_call(context) for context in incoming_call_contexts))
+                logger.info("%d incoming call(s) answered", len(incoming_call_contexts))
+
         except Exception as e:
-            print(f"Error handling inbound call: {str(e)}")
+            logger.exception("Error handling inbound call")
             return web.Response(status=500, text=str(e))
 
         return web.Response(status=200)
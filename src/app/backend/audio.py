@@ -0,0 +1,284 @@
+import asyncio
+import base64
+import math
+from collections import deque
+from typing import Awaitable, Callable, Optional
+import numpy as np
+
+# The OpenAI Realtime API is used with 24 kHz, 16 bit mono PCM in both directions
+PCM24K_BYTES_PER_MS = 48
+PCM24K_SAMPLE_RATE = 24000
+
+def base64_decoded_length(data: str) -> int:
+    """
+    Returns the number of bytes encoded in a base64 string without decoding it.
+    """
+    if not data:
+        return 0
+    return len(data) // 4 * 3 - data.count("=", -2)
+
+class AudioCoalescer:
+    """
+    Merges consecutive input_audio_buffer.append events of one session into a single upstream event per window.
+    Audio is sent once the window is full or, at the latest, window_ms after the first buffered chunk.
+    Every other event is sent through send() as well, which flushes buffered audio first, so events are never reordered.
+    """
+    window_ms: int
+
+    _APPEND_PREFIX = '{"type":"input_audio_buffer.append","audio":"'
+    _APPEND_SUFFIX = '"}'
+
+    def __init__(self, send: Callable[[str], Awaitable[None]], window_ms: int, bytes_per_ms: int = PCM24K_BYTES_PER_MS):
+        self.window_ms = window_ms
+        self._send = send
+        self._window_bytes = window_ms * bytes_per_ms
+        self._chunks: list[str] = []
+        self._buffered_bytes = 0
+        self._lock = asyncio.Lock()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._timer_flush: Optional[asyncio.Task] = None
+
+    async def append(self, audio: str):
+        """
+        Buffers a base64 encoded audio chunk.
+        """
+        self._chunks.append(audio)
+        self._buffered_bytes += base64_decoded_length(audio)
+        if self._buffered_bytes >= self._window_bytes:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window_ms / 1000, self._on_timer)
+
+    async def send(self, data: str):
+        """
+        Sends a non-audio event upstream, right after any buffered audio.
+        """
+        async with self._lock:
+            await self._flush_locked()
+            await self._send(data)
+
+    async def flush(self):
+        async with self._lock:
+            await self._flush_locked()
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._timer_flush is not None:
+            self._timer_flush.cancel()
+            self._timer_flush = None
+
+    def _on_timer(self):
+        self._timer = None
+        self._timer_flush = asyncio.ensure_future(self.flush())
+
+    async def _flush_locked(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._chunks:
+            return
+
+        chunks = self._chunks
+        self._chunks = []
+        self._buffered_bytes = 0
+
+        # Base64 strings can simply be concatenated as long as no chunk but the last one is padded,
+        # which is always the case for 20 ms ACS packets. Otherwise re-encode the decoded audio.
+        if len(chunks) == 1:
+            audio = chunks[0]
+        elif not any(chunk.endswith("=") for chunk in chunks[:-1]):
+            audio = "".join(chunks)
+        else:
+            audio = base64.b64encode(b"".join(base64.b64decode(chunk) for chunk in chunks)).decode("ascii")
+
+        await self._send(self._APPEND_PREFIX + audio + self._APPEND_SUFFIX)
+
+class Resampler:
+    """
+    Streaming polyphase resampler for 16 bit mono PCM between two sample rates with a rational ratio (e.g. 24 kHz to 8 kHz).
+    Frames are resampled one at a time as they arrive, the filter history and phase carry over from one frame to the next,
+    so the output is the same as resampling the whole stream at once and has no clicks at frame boundaries.
+    """
+    from_rate: int
+    to_rate: int
+
+    # Length of the low-pass filter in samples at the lower of the two rates, more taps give a steeper cutoff
+    TAPS_PER_OUTPUT_RATE = 24
+
+    def __init__(self, from_rate: int, to_rate: int):
+        self.from_rate = from_rate
+        self.to_rate = to_rate
+        divisor = math.gcd(from_rate, to_rate)
+        self._up = to_rate // divisor
+        self._down = from_rate // divisor
+
+        # Windowed sinc low-pass at the lower Nyquist frequency, split into one sub-filter per output phase
+        taps = math.ceil(self.TAPS_PER_OUTPUT_RATE * max(self._up, self._down) / self._up)
+        length = taps * self._up
+        cutoff = 0.95 / max(self._up, self._down)
+        n = np.arange(length) - (length - 1) / 2
+        h = cutoff * np.sinc(cutoff * n) * np.kaiser(length, 8.0) * self._up
+        self._phases = h.reshape(taps, self._up).T.astype(np.float32)
+        self._taps = taps
+        self._history = np.zeros(taps - 1, dtype=np.float32)
+        self._next = 0
+
+    def process(self, pcm: bytes) -> bytes:
+        if self._up == self._down:
+            return pcm
+        samples = np.frombuffer(pcm, dtype="<i2").astype(np.float32)
+        buffer = np.concatenate((self._history, samples))
+
+        # Output sample k sits at position k * down in the upsampled stream, which is input sample
+        # position // up filtered with sub-filter position % up
+        positions = np.arange(self._next, len(samples) * self._up, self._down)
+        inputs = positions // self._up + (self._taps - 1)
+        window = buffer[inputs[:, None] - np.arange(self._taps)[None, :]]
+        output = np.einsum("ij,ij->i", window, self._phases[positions % self._up])
+
+        self._next += len(positions) * self._down - len(samples) * self._up
+        self._history = buffer[len(buffer) - (self._taps - 1):]
+        return np.clip(np.rint(output), -32768, 32767).astype("<i2").tobytes()
+
+def _mulaw_encode_table() -> np.ndarray:
+    samples = np.arange(-32768, 32768, dtype=np.int32)
+    # Works on 14 bit magnitudes, like the reference implementation
+    sign = np.where(samples < 0, 0x80, 0)
+    magnitude = np.minimum(np.abs(samples >> 2), 8158) + 0x21
+    exponent = np.floor(np.log2(magnitude)).astype(np.int32) - 5
+    mantissa = (magnitude >> (exponent + 1)) & 0x0F
+    table = ~(sign | (exponent << 4) | mantissa) & 0xFF
+    # Indexed by the samples reinterpreted as unsigned 16 bit values
+    return np.roll(table, -32768).astype(np.uint8)
+
+def _mulaw_decode_table() -> np.ndarray:
+    codes = ~np.arange(256, dtype=np.int32) & 0xFF
+    exponent = (codes >> 4) & 0x07
+    magnitude = ((((codes & 0x0F) << 3) + 0x84) << exponent) - 0x84
+    return np.where(codes & 0x80, -magnitude, magnitude).astype("<i2")
+
+def _alaw_encode_table() -> np.ndarray:
+    samples = np.arange(-32768, 32768, dtype=np.int32)
+    mask = np.where(samples >= 0, 0xD5, 0x55)
+    magnitude = np.where(samples >= 0, samples, -samples - 1)
+    exponent = np.maximum(np.floor(np.log2(np.maximum(magnitude, 1))).astype(np.int32) - 7, 0)
+    mantissa = np.where(exponent == 0, magnitude >> 4, magnitude >> (exponent + 3)) & 0x0F
+    table = ((exponent << 4) | mantissa) ^ mask
+    return np.roll(table, -32768).astype(np.uint8)
+
+def _alaw_decode_table() -> np.ndarray:
+    codes = np.arange(256, dtype=np.int32) ^ 0x55
+    exponent = (codes >> 4) & 0x07
+    mantissa = (codes & 0x0F) << 4
+    magnitude = np.where(exponent == 0, mantissa + 8, (mantissa + 0x108) << np.maximum(exponent - 1, 0))
+    return np.where(codes & 0x80, magnitude, -magnitude).astype("<i2")
+
+# G.711 codecs as lookup tables, encoding indexes by the 16 bit sample, decoding by the 8 bit code
+_G711_TABLES = {
+    "mulaw": (_mulaw_encode_table(), _mulaw_decode_table()),
+    "alaw": (_alaw_encode_table(), _alaw_decode_table()),
+}
+
+# Audio formats a telephony leg can use: sample rate and encoding
+AUDIO_FORMATS = {
+    "pcm24k": (24000, "pcm16"),
+    "pcm16k": (16000, "pcm16"),
+    "pcm8k": (8000, "pcm16"),
+    "mulaw8k": (8000, "mulaw"),
+    "alaw8k": (8000, "alaw"),
+}
+
+class AudioTranscoder:
+    """
+    Converts the audio of one call between the 24 kHz PCM the OpenAI Realtime API uses and the format of the telephony leg.
+    Both directions keep their own resampler state, so one instance must only be used for one call.
+    """
+    audio_format: str
+    sample_rate: int
+    encoding: str
+
+    def __init__(self, audio_format: str):
+        if audio_format not in AUDIO_FORMATS:
+            raise ValueError(f"Unsupported audio format {audio_format}, use one of {', '.join(AUDIO_FORMATS)}")
+        self.audio_format = audio_format
+        self.sample_rate, self.encoding = AUDIO_FORMATS[audio_format]
+        self._downsampler = Resampler(PCM24K_SAMPLE_RATE, self.sample_rate)
+        self._upsampler = Resampler(self.sample_rate, PCM24K_SAMPLE_RATE)
+
+    @property
+    def is_passthrough(self) -> bool:
+        return self.audio_format == "pcm24k"
+
+    def from_pcm24k(self, pcm: bytes) -> bytes:
+        pcm = self._downsampler.process(pcm)
+        if self.encoding == "pcm16":
+            return pcm
+        encode_table, _ = _G711_TABLES[self.encoding]
+        return encode_table[np.frombuffer(pcm, dtype="<u2")].tobytes()
+
+    def to_pcm24k(self, data: bytes) -> bytes:
+        if self.encoding != "pcm16":
+            _, decode_table = _G711_TABLES[self.encoding]
+            data = decode_table[np.frombuffer(data, dtype=np.uint8)].tobytes()
+        return self._upsampler.process(data)
+
+    def from_pcm24k_base64(self, audio: str) -> str:
+        return base64.b64encode(self.from_pcm24k(base64.b64decode(audio))).decode("ascii")
+
+    def to_pcm24k_base64(self, audio: str) -> str:
+        return base64.b64encode(self.to_pcm24k(base64.b64decode(audio))).decode("ascii")
+
+class SilenceGate:
+    """
+    Holds back caller audio while its energy stays below threshold_dbfs, so long silences and quiet hold periods of a
+    call are not streamed to the Realtime API. After speech, audio keeps flowing for hangover_ms, which must be longer
+    than the silence the server VAD waits for before it ends the turn. When speech starts again, the last padding_ms of
+    held back audio is released ahead of it, so the server VAD and the transcription get the onset of the speech.
+    Works on 24 kHz PCM, one instance per session.
+    """
+    threshold_dbfs: float
+    hangover_ms: float
+    padding_ms: float
+    suppressed_ms: float
+
+    def __init__(self, threshold_dbfs: float, hangover_ms: float = 700, padding_ms: float = 300, bytes_per_ms: int = PCM24K_BYTES_PER_MS):
+        self.threshold_dbfs = threshold_dbfs
+        self.hangover_ms = hangover_ms
+        self.padding_ms = padding_ms
+        self.suppressed_ms = 0
+        self._bytes_per_ms = bytes_per_ms
+        # Mean square of the samples at the threshold, compared without taking roots or logarithms per frame
+        self._threshold_power = (32768 * 10 ** (threshold_dbfs / 20)) ** 2
+        self._hangover_left_ms = 0.0
+        self._padding: deque[tuple[str, float]] = deque()
+        self._padding_ms = 0.0
+
+    def process(self, audio: str) -> list[str]:
+        """
+        Takes a base64 encoded chunk and returns the chunks to forward, in order, the given one last if it is forwarded.
+        """
+        pcm = base64.b64decode(audio)
+        duration_ms = len(pcm) / self._bytes_per_ms
+        samples = np.frombuffer(pcm, dtype="<i2", count=len(pcm) // 2).astype(np.float32)
+        power = float(np.dot(samples, samples)) / len(samples) if len(samples) > 0 else 0.0
+        if power >= self._threshold_power:
+            self._hangover_left_ms = self.hangover_ms
+            released = [chunk for chunk, _ in self._padding]
+            self.suppressed_ms -= self._padding_ms
+            self._padding.clear()
+            self._padding_ms = 0
+            released.append(audio)
+            return released
+        if self._hangover_left_ms > 0:
+            self._hangover_left_ms -= duration_ms
+            return [audio]
+
+        self._padding.append((audio, duration_ms))
+        self._padding_ms += duration_ms
+        self.suppressed_ms += duration_ms
+        while self._padding and self._padding_ms - self._padding[0][1] >= self.padding_ms:
+            _, dropped_ms = self._padding.popleft()
+            self._padding_ms -= dropped_ms
+        return []
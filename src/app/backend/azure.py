@@ -1,35 +1,177 @@
+import asyncio
+import logging
+import time
+from typing import Callable, Optional
+from azure.core import MatchConditions
+from azure.core.credentials import AccessToken
+from azure.core.exceptions import ResourceNotModifiedError
 from azure.identity import AzureDeveloperCliCredential, DefaultAzureCredential
 import os
 from azure.storage.blob.aio import BlobServiceClient
 
+logger = logging.getLogger("voicerag")
+
+OPENAI_SCOPE = "https://cognitiveservices.azure.com/.default"
+SEARCH_SCOPE = "https://search.azure.com/.default"
+
 def get_azure_credentials(tenant_id: str | None = None) -> AzureDeveloperCliCredential | DefaultAzureCredential:
     credentials: AzureDeveloperCliCredential | DefaultAzureCredential | None = None
 
     if tenant_id is not None:
-        print("Using AzureDeveloperCliCredential with tenant_id %s", tenant_id)                
+        logger.info("Using AzureDeveloperCliCredential with tenant_id %s", tenant_id)
         credentials =  AzureDeveloperCliCredential(tenant_id=tenant_id, process_timeout=60)
     else:
-        print("Using DefaultAzureCredential")
+        logger.info("Using DefaultAzureCredential")
         credentials = DefaultAzureCredential()
-    
-    # Warm up before we start getting requests
-    credentials.get_token("https://search.azure.com/.default")
+
+    # Tokens are warmed up asynchronously by the AzureTokenCache, so creating the credentials never blocks
     return credentials
 
+class AzureTokenCache:
+    """
+    Caches Entra ID access tokens for a set of scopes and refreshes them in the background before they expire.
+    The sync azure-identity credentials may do blocking HTTP requests or spawn the Azure CLI, so they only
+    ever run in a worker thread. Callers on the event loop get the cached token immediately.
+    """
+    scopes: list[str]
 
+    # Refresh tokens this many seconds before they expire
+    REFRESH_MARGIN_SECONDS = 300
+    # Seconds to wait before retrying after a refresh failed
+    RETRY_SECONDS = 10
 
-async def fetch_prompt_from_azure_storage(container_name: str, file_name: str) -> str:
+    def __init__(self, credentials: AzureDeveloperCliCredential | DefaultAzureCredential, scopes: list[str]):
+        self.scopes = scopes
+        self._credentials = credentials
+        self._tokens: dict[str, AccessToken] = {}
+        self._refreshing: dict[str, asyncio.Future] = {}
+        self._task: asyncio.Task | None = None
+
+    async def start(self):
+        """
+        Fetches tokens for all scopes concurrently and keeps refreshing them until close() is called.
+        """
+        results = await asyncio.gather(*(self._refresh(scope) for scope in self.scopes), return_exceptions=True)
+        for scope, result in zip(self.scopes, results):
+            if isinstance(result, Exception):
+                logger.warning("Could not get token for %s, retrying in the background: %s", scope, result)
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def is_warm(self, scope: str) -> bool:
+        return self._is_valid(self._tokens.get(scope))
+
+    async def get_token(self, scope: str) -> str:
+        token = self._tokens.get(scope)
+        if not self._is_valid(token):
+            token = await self._refresh(scope)
+        return token.token
+
+    async def get_bearer(self, scope: str) -> str:
+        return f"Bearer {await self.get_token(scope)}"
+
+    def _is_valid(self, token: AccessToken | None) -> bool:
+        return token is not None and token.expires_on - time.time() > 30
+
+    async def _refresh(self, scope: str) -> AccessToken:
+        # Concurrent callers share a single refresh per scope, shielded so a caller giving up doesn't cancel it for the others
+        refresh = self._refreshing.get(scope)
+        if refresh is None:
+            refresh = asyncio.ensure_future(self._fetch(scope))
+            self._refreshing[scope] = refresh
+        return await asyncio.shield(refresh)
+
+    async def _fetch(self, scope: str) -> AccessToken:
+        try:
+            token = await asyncio.to_thread(self._credentials.get_token, scope)
+            self._tokens[scope] = token
+            return token
+        finally:
+            del self._refreshing[scope]
+
+    async def _run(self):
+        while True:
+            next_refresh = min((self._tokens[scope].expires_on - self.REFRESH_MARGIN_SECONDS for scope in self.scopes if scope in self._tokens), default=time.time())
+            await asyncio.sleep(max(0, next_refresh - time.time()))
+            for scope in self.scopes:
+                token = self._tokens.get(scope)
+                if token is None or token.expires_on - self.REFRESH_MARGIN_SECONDS <= time.time():
+                    try:
+                        await self._refresh(scope)
+                    except Exception as e:
+                        logger.warning("Could not refresh token for %s: %s", scope, e)
+                        await asyncio.sleep(self.RETRY_SECONDS)
+
+class AzureStoragePrompt:
     """
-    Fetches a prompt as text from the specified container in Azure Storage.
+    A prompt stored as a text blob in Azure Storage. Reads are conditional on the ETag of the last read,
+    so checking for changes only transfers the prompt when it was actually modified.
     """
-    connection_string = os.environ.get("AZURE_STORAGE_CONNECTION_STRING")
-    if not connection_string:
-        raise ValueError("Missing 'AZURE_STORAGE_CONNECTION_STRING' environment variable.")
+    container_name: str
+    file_name: str
+    etag: Optional[str]
+
+    def __init__(self, connection_string: str, container_name: str, file_name: str):
+        self.container_name = container_name
+        self.file_name = file_name
+        self.etag = None
+        self._service_client = BlobServiceClient.from_connection_string(connection_string)
+        self._blob_client = self._service_client.get_container_client(container_name).get_blob_client(file_name)
+
+    @classmethod
+    def from_environment(cls, container_name: str, file_name: str) -> "AzureStoragePrompt":
+        connection_string = os.environ.get("AZURE_STORAGE_CONNECTION_STRING")
+        if not connection_string:
+            raise ValueError("Missing 'AZURE_STORAGE_CONNECTION_STRING' environment variable.")
+        return cls(connection_string, container_name, file_name)
 
-    blob_service_client = BlobServiceClient.from_connection_string(connection_string)
-    container_client = blob_service_client.get_container_client(container_name)
-    blob_client = container_client.get_blob_client(file_name)
+    async def fetch(self) -> Optional[str]:
+        """
+        Returns the prompt, or None if it didn't change since the last call.
+        """
+        try:
+            if self.etag is None:
+                blob_data = await self._blob_client.download_blob()
+            else:
+                blob_data = await self._blob_client.download_blob(etag=self.etag, match_condition=MatchConditions.IfModified)
+        except ResourceNotModifiedError:
+            return None
+        content = await blob_data.readall()
+        self.etag = blob_data.properties.etag
+        return content.decode("utf-8")
 
-    blob_data = await blob_client.download_blob()
-    content = await blob_data.readall()
-    return content.decode("utf-8")
\ No newline at end of file
+    async def watch(self, on_change: Callable[[str], None], interval_seconds: float):
+        """
+        Checks the prompt for changes every interval_seconds and passes new versions to on_change.
+        """
+        while True:
+            await asyncio.sleep(interval_seconds)
+            try:
+                prompt = await self.fetch()
+                if prompt is not None:
+                    logger.info("Prompt %s/%s changed", self.container_name, self.file_name)
+                    on_change(prompt)
+            except Exception as e:
+                logger.warning("Could not check %s/%s for changes: %s", self.container_name, self.file_name, e)
+
+    async def close(self):
+        await self._service_client.close()
+
+async def fetch_prompt_from_azure_storage(container_name: str, file_name: str) -> str:
+    """
+    Fetches a prompt as text from the specified container in Azure Storage.
+    """
+    prompt = AzureStoragePrompt.from_environment(container_name, file_name)
+    try:
+        return await prompt.fetch()
+    finally:
+        await prompt.close()
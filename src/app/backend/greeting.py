@@ -0,0 +1,84 @@
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import os
+import uuid
+from typing import Optional
+from backend.audio import PCM24K_BYTES_PER_MS
+
+logger = logging.getLogger("voicerag")
+
+class Greeting:
+    """
+    Audio and transcript of the opening answer of a session, 24 kHz PCM.
+    """
+    transcript: str
+    pcm: bytes
+
+    def __init__(self, transcript: str, pcm: bytes):
+        self.transcript = transcript
+        self.pcm = pcm
+
+    def audio_chunks(self, chunk_ms: int = 100) -> list[str]:
+        """
+        Returns the audio as base64 encoded chunks, the way the Realtime API streams it.
+        """
+        size = chunk_ms * PCM24K_BYTES_PER_MS
+        return [base64.b64encode(self.pcm[i:i + size]).decode("ascii") for i in range(0, len(self.pcm), size)]
+
+class GreetingCache:
+    """
+    Keeps the first greeting the model generated for a system prompt and voice on disk, so later sessions can play it
+    right away instead of waiting for the model. Greetings are stored by a hash of the prompt and the voice, a changed
+    prompt or voice simply misses the cache and records a new greeting. Loaded greetings are kept in memory, misses are
+not, so a greeting another worker records is picked up by the next session.
+    """
+    directory: str
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._greetings: dict[str, Greeting] = {}
+
+    @staticmethod
+    def key(system_message: Optional[str], voice: str) -> str:
+        return hashlib.sha256(json.dumps([system_message, voice]).encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"greeting-{key}.json")
+
+    async def get(self, key: str) -> Optional[Greeting]:
+        greeting = self._greetings.get(key)
+        if greeting is None:
+            greeting = await asyncio.to_thread(self._load, key)
+            if greeting is not None:
+                self._greetings[key] = greeting
+        return greeting
+
+    async def put(self, key: str, greeting: Greeting):
+        self._greetings[key] = greeting
+        try:
+            await asyncio.to_thread(self._store, key, greeting)
+        except OSError as e:
+            logger.warning("Could not store greeting %s: %s", key, e)
+
+    def _load(self, key: str) -> Optional[Greeting]:
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as file:
+                data = json.load(file)
+            return Greeting(data["transcript"], base64.b64decode(data["audio"]))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning("Ignoring unreadable greeting %s: %s", key, e)
+            return None
+
+    def _store(self, key: str, greeting: Greeting):
+        os.makedirs(self.directory, exist_ok=True)
+        # Concurrent sessions may record the same greeting, the last one to finish wins
+        path = self._path(key)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            json.dump({ "transcript": greeting.transcript, "audio": base64.b64encode(greeting.pcm).decode("ascii") }, file)
+        os.replace(temp_path, path)
@@ -1,8 +1,94 @@
 import json
+import re
 from openai.types.beta.realtime import (InputAudioBufferAppendEvent, SessionUpdateEvent)
 from openai.types.beta.realtime.session_update_event import Session, SessionTurnDetection
 from typing import Any, Literal, Optional
 from backend.tools.tools import Tool
+from backend.audio import AUDIO_FORMATS, AudioTranscoder
+
+# Both the OpenAI Realtime API and ACS put the event type ("type" or "kind") first in every frame.
+# Matching it at the very start of the raw text tells us the type of a frame without decoding its
+# (potentially large) base64 payload. Anything else, including frames where the type is not the
+# first key, returns None and takes the regular, fully parsed path.
+_EVENT_TYPE_PATTERN = re.compile(r'\s*\{\s*"type"\s*:\s*"([^"\\]*)"')
+_EVENT_KIND_PATTERN = re.compile(r'\s*\{\s*"kind"\s*:\s*"([^"\\]*)"')
+
+def peek_event_type(raw: str) -> Optional[str]:
+    """
+    Returns the "type" of a raw OpenAI Realtime API event without parsing it, or None if it can't be determined cheaply.
+    """
+    match = _EVENT_TYPE_PATTERN.match(raw)
+    return match.group(1) if match else None
+
+def peek_event_kind(raw: str) -> Optional[str]:
+    """
+    Returns the "kind" of a raw Azure Communication Services media streaming message without parsing it, or None.
+    """
+    match = _EVENT_KIND_PATTERN.match(raw)
+    return match.group(1) if match else None
+
+# Server VAD settings for phone calls, which don't send a session.update themselves
+ACS_TURN_DETECTION = {
+    "type": 'server_vad',
+    "threshold": 0.7, # Adjust if necessary
+    "prefix_padding_ms": 300, # Adjust if necessary
+    "silence_duration_ms": 500 # Adjust if necessary
+}
+
+# Locate the base64 payload of audio frames, the payloads never contain quotes or escapes
+_ACS_AUDIO_DATA_PATTERN = re.compile(r'"data"\s*:\s*"')
+_OPENAI_AUDIO_DELTA_PATTERN = re.compile(r'"delta"\s*:\s*"')
+
+def _find_string_value(raw: str, pattern: re.Pattern) -> Optional[tuple[int, int]]:
+    match = pattern.search(raw)
+    if match is None:
+        return None
+    end = raw.find('"', match.end())
+    if end < 0:
+        return None
+    return match.end(), end
+
+_OPENAI_AUDIO_APPEND_PATTERN = re.compile(r'"audio"\s*:\s*"')
+
+def get_input_audio(raw: str) -> Optional[str]:
+    """
+    Returns the base64 audio of a raw input_audio_buffer.append event without parsing it, or None if it can't be found.
+    """
+    span = _find_string_value(raw, _OPENAI_AUDIO_APPEND_PATTERN)
+    return raw[span[0]:span[1]] if span is not None else None
+
+def get_output_audio(raw: str) -> Optional[str]:
+    """
+    Returns the base64 audio of a raw response.audio.delta event without parsing it, or None if it can't be found.
+    """
+    span = _find_string_value(raw, _OPENAI_AUDIO_DELTA_PATTERN)
+    return raw[span[0]:span[1]] if span is not None else None
+
+def find_audio_payload(raw: str) -> Optional[tuple[int, int]]:
+    """
+    Returns the start and end of the base64 audio in a raw input_audio_buffer.append, response.audio.delta or ACS AudioData frame,
+    or None for all other frames.
+    """
+    event_type = peek_event_type(raw)
+    if event_type == "input_audio_buffer.append":
+        return _find_string_value(raw, _OPENAI_AUDIO_APPEND_PATTERN)
+    if event_type == "response.audio.delta":
+        return _find_string_value(raw, _OPENAI_AUDIO_DELTA_PATTERN)
+    if event_type is None and peek_event_kind(raw) == "AudioData":
+        return _find_string_value(raw, _ACS_AUDIO_DATA_PATTERN)
+    return None
+
+_ITEM_ID_PATTERN = re.compile(r'"item_id"\s*:\s*"([^"\\]*)"')
+
+# The ids come before the payload in audio deltas, so looking at the head of the frame is usually enough
+_ITEM_ID_SEARCH_WINDOW = 512
+
+def peek_item_id(raw: str) -> Optional[str]:
+    """
+    Returns the "item_id" of a raw OpenAI Realtime API event without parsing it, or None if it has none.
+    """
+    match = _ITEM_ID_PATTERN.search(raw, 0, _ITEM_ID_SEARCH_WINDOW) or _ITEM_ID_PATTERN.search(raw)
+    return match.group(1) if match else None
 
 def transform_acs_to_openai_format(msg_data: Any, model: Optional[str], tools: dict[str, Tool], system_message: Optional[str], temperature: Optional[float], max_tokens: Optional[int], disable_audio: Optional[bool], voice: str) -> InputAudioBufferAppendEvent | SessionUpdateEvent | Any | None:
     """
@@ -26,12 +112,7 @@ def transform_acs_to_openai_format(msg_data: Any, model: Optional[str], tools: d
                 "voice": voice,
                 "tool_choice": "auto" if len(tools) > 0 else "none",
                 "tools": [tool.schema for tool in tools.values()],
-                "turn_detection": {
-                    "type": 'server_vad',
-                    "threshold": 0.7, # Adjust if necessary
-                    "prefix_padding_ms": 300, # Adjust if necessary
-                    "silence_duration_ms": 500 # Adjust if necessary
-                },
+                "turn_detection": dict(ACS_TURN_DETECTION),
             }
         }
 
@@ -89,6 +170,146 @@ def transform_openai_to_acs_format(msg_data: Any) -> Optional[Any]:
 
     return acs_message
 
+def parse_partial_json_object(text: str) -> Optional[dict[str, Any]]:
+    """
+    Parses a JSON object that is still being streamed, e.g. function call arguments.
+    Returns the object if the text is complete, or if it only lacks closing brackets after a complete value.
+    Returns None while a string, key or value is still incomplete.
+    """
+    try:
+        value = json.loads(text)
+        return value if isinstance(value, dict) else None
+    except ValueError:
+        pass
+
+    closing = []
+    in_string = False
+    escaped = False
+    for char in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == "{":
+            closing.append("}")
+        elif char == "[":
+            closing.append("]")
+        elif char in "}]" and closing:
+            closing.pop()
+    if in_string or not closing:
+        return None
+
+    prefix = text.rstrip()
+    if prefix.endswith(","):
+        prefix = prefix[:-1]
+    try:
+        value = json.loads(prefix + "".join(reversed(closing)))
+        return value if isinstance(value, dict) else None
+    except ValueError:
+        return None
+
+class AcsTranslator:
+    """
+    Streaming translator between Azure Communication Services media streaming messages and OpenAI Realtime API events for one call.
+    Unlike transform_acs_to_openai_format and transform_openai_to_acs_format, it works on raw frames: audio frames are translated
+    by splicing their base64 payload into the frame of the other side, without decoding the JSON into intermediate dicts.
+    All configuration happens once when the call starts, the session.update sent for the call is serialized upfront.
+    Server-enforced settings (voice, instructions, tools, ...) are not part of it, the middle tier adds them to every session.update.
+    If the call streams audio in another format than 24 kHz PCM, the payload is transcoded on the way, the format announced
+    in the AudioMetadata message of the call takes precedence over the configured one.
+    """
+    session_update: str
+    transcoder: Optional[AudioTranscoder]
+
+    _AUDIO_APPEND_PREFIX = '{"type":"input_audio_buffer.append","audio":"'
+    _AUDIO_APPEND_SUFFIX = '"}'
+    _AUDIO_DATA_PREFIX = '{"kind":"AudioData","audioData":{"data":"'
+    _AUDIO_DATA_SUFFIX = '"}}'
+    _STOP_AUDIO = json.dumps({"kind": "StopAudio", "audioData": None, "stopAudio": {}})
+
+    def __init__(self, turn_detection: dict[str, Any] = ACS_TURN_DETECTION, audio_format: str = "pcm24k"):
+        self.session_update = json.dumps({"type": "session.update", "session": {"turn_detection": turn_detection}})
+        self.transcoder = None
+        self.set_audio_format(audio_format)
+
+    def set_audio_format(self, audio_format: str):
+        if self.transcoder is not None and self.transcoder.audio_format == audio_format:
+            return
+        transcoder = AudioTranscoder(audio_format)
+        self.transcoder = None if transcoder.is_passthrough else transcoder
+
+    def _on_audio_metadata(self, metadata: Optional[dict[str, Any]]):
+        if not metadata:
+            return
+        encoding = str(metadata.get("encoding", "PCM")).lower()
+        rate = metadata.get("sampleRate", 24000)
+        if encoding in ("pcmu", "mulaw", "ulaw"):
+            audio_format = f"mulaw{rate // 1000}k"
+        elif encoding in ("pcma", "alaw"):
+            audio_format = f"alaw{rate // 1000}k"
+        else:
+            audio_format = f"pcm{rate // 1000}k"
+        if audio_format in AUDIO_FORMATS:
+            self.set_audio_format(audio_format)
+
+    def _audio_append(self, audio: str) -> str:
+        if self.transcoder is not None:
+            audio = self.transcoder.to_pcm24k_base64(audio)
+        return self._AUDIO_APPEND_PREFIX + audio + self._AUDIO_APPEND_SUFFIX
+
+    def _audio_data(self, audio: str) -> str:
+        if self.transcoder is not None:
+            audio = self.transcoder.from_pcm24k_base64(audio)
+        return self._AUDIO_DATA_PREFIX + audio + self._AUDIO_DATA_SUFFIX
+
+    def to_openai(self, raw: str) -> Optional[str]:
+        """
+        Translates a raw ACS message into a raw OpenAI Realtime API event, or returns None if it is not relevant for the Realtime API.
+        """
+        kind = peek_event_kind(raw)
+        if kind == "AudioData":
+            span = _find_string_value(raw, _ACS_AUDIO_DATA_PATTERN)
+            if span is not None:
+                return self._audio_append(raw[span[0]:span[1]])
+        elif kind == "AudioMetadata":
+            self._on_audio_metadata(json.loads(raw).get("audioMetadata"))
+            return self.session_update
+        elif kind is not None:
+            return None
+
+        # Unusual formatting, fall back to parsing the message
+        msg_data = json.loads(raw)
+        if msg_data["kind"] == "AudioData":
+            return self._audio_append(msg_data["audioData"]["data"])
+        if msg_data["kind"] == "AudioMetadata":
+            self._on_audio_metadata(msg_data.get("audioMetadata"))
+            return self.session_update
+        return None
+
+    def to_acs(self, raw: str) -> Optional[str]:
+        """
+        Translates a raw response.audio.delta event into a raw ACS AudioData message.
+        """
+        span = _find_string_value(raw, _OPENAI_AUDIO_DELTA_PATTERN)
+        if span is None:
+            return self.to_acs_event(json.loads(raw))
+        return self._audio_data(raw[span[0]:span[1]])
+
+    def to_acs_event(self, msg_data: Any) -> Optional[str]:
+        """
+        Translates an already parsed OpenAI Realtime API event into a raw ACS message, or returns None if it is not relevant for ACS.
+        """
+        if msg_data["type"] == "response.audio.delta":
+            return self._audio_data(msg_data["delta"])
+        if msg_data["type"] == "input_audio_buffer.speech_started":
+            return self._STOP_AUDIO
+        return None
+
 async def load_prompt_from_markdown(file_path):
     with open(file_path, 'r', encoding='utf-8') as file:
         prompt = file.read()
@@ -0,0 +1,191 @@
+import asyncio
+import bisect
+import math
+from typing import Callable, Optional
+
+# Bucket upper bounds in seconds, from sub-frame forwarding times up to slow tool calls
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 0.75, 1, 1.5, 2.5, 5, 10)
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class _Metric:
+    name: str
+    help: str
+    label_names: tuple[str, ...]
+
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, label_names: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self._children = {}
+
+    def labels(self, *values: str):
+        """
+        Returns the metric for one combination of label values. Keep the result around on hot paths.
+        """
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self._samples())
+        return "\n".join(lines)
+
+class _Value:
+    value: float
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+class Counter(_Metric):
+    """
+    Monotonically increasing count, e.g. of frames or bytes. Use labels() for labeled counters, inc() otherwise.
+    With a function, the value is read from it whenever the metrics are collected, for counts kept elsewhere.
+    """
+    type = "counter"
+
+    def __init__(self, name: str, help: str, label_names: tuple[str, ...] = (), function: Optional[Callable[[], float]] = None):
+        super().__init__(name, help, label_names)
+        self.function = function
+
+    def _new_child(self) -> _Value:
+        return _Value()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+    def _samples(self) -> list[str]:
+        if self.function is not None:
+            return [f"{self.name} {_format_value(self.function())}"]
+        return [f"{self.name}{_format_labels(self.label_names, values)} {_format_value(child.value)}" for values, child in self._children.items()]
+
+class Gauge(Counter):
+    """
+    Value that goes up and down, e.g. the number of active sessions.
+    """
+    type = "gauge"
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+    def dec(self, amount: float = 1):
+        self.labels().dec(amount)
+
+class _HistogramValue:
+    def __init__(self, buckets: tuple[float, ...]):
+        self._buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self._buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Histogram(_Metric):
+    """
+    Distribution of durations in seconds, rendered as cumulative buckets like Prometheus client libraries do.
+    """
+    type = "histogram"
+    buckets: tuple[float, ...]
+
+    def __init__(self, name: str, help: str, label_names: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self) -> _HistogramValue:
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def _samples(self) -> list[str]:
+        lines = []
+        for values, child in self._children.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), child.counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, values, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, values)} {_format_value(child.sum)}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, values)} {child.count}")
+        return lines
+
+class MetricsRegistry:
+    """
+    Collects the metrics of the process and renders them in the Prometheus text format.
+    Registering a metric under a name that is already taken replaces the previous one, e.g. when the app is created again.
+    """
+    def __init__(self):
+        self._metrics: dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def unregister(self, name: str):
+        self._metrics.pop(name, None)
+
+    def counter(self, name: str, help: str, label_names: tuple[str, ...] = (), function: Optional[Callable[[], float]] = None) -> Counter:
+        return self.register(Counter(name, help, label_names, function))
+
+    def gauge(self, name: str, help: str, label_names: tuple[str, ...] = (), function: Optional[Callable[[], float]] = None) -> Gauge:
+        return self.register(Gauge(name, help, label_names, function))
+
+    def histogram(self, name: str, help: str, label_names: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, label_names, buckets))
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+
+# Metrics of this process, served on /metrics
+REGISTRY = MetricsRegistry()
+
+# Content type of the Prometheus text exposition format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_EVENT_LOOP_LAG = REGISTRY.histogram(
+    "voicerag_event_loop_lag_seconds",
+    "Delay of event loop callbacks beyond their scheduled time, audio forwarding of all sessions waits this long",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1))
+
+async def monitor_event_loop_lag(interval_seconds: float = 0.1):
+    """
+    Measures how late the event loop wakes up from a sleep, until cancelled.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval_seconds)
+        _EVENT_LOOP_LAG.observe(max(0, loop.time() - start - interval_seconds))
@@ -0,0 +1,69 @@
+import time
+from typing import Optional
+from backend.audio import PCM24K_BYTES_PER_MS
+
+class PlayoutTracker:
+    """
+    Keeps track of how much audio of the current assistant item was forwarded to a client and estimates how much of it
+    has been played, so the item can be truncated at the point where the caller interrupted it.
+    Clients play audio in real time, starting playout_delay_ms after the first chunk arrived, so the played duration
+    is the wall-clock time since then, capped at the forwarded duration.
+    """
+    playout_delay_ms: float
+    item_id: Optional[str]
+    forwarded_ms: float
+
+    # Interrupted items are remembered for a while to drop their remaining audio, not forever
+    MAX_CANCELLED_ITEMS = 32
+
+    def __init__(self, playout_delay_ms: float, bytes_per_ms: int = PCM24K_BYTES_PER_MS):
+        self.playout_delay_ms = playout_delay_ms
+        self.item_id = None
+        self.forwarded_ms = 0
+        self._bytes_per_ms = bytes_per_ms
+        self._started_at = 0.0
+        self._cancelled: list[str] = []
+
+    def is_cancelled(self, item_id: Optional[str]) -> bool:
+        return item_id is not None and item_id in self._cancelled
+
+    def on_audio(self, item_id: Optional[str], audio_bytes: int, now: Optional[float] = None):
+        """
+        Records audio of an assistant item that was forwarded to the client.
+        """
+        now = time.monotonic() if now is None else now
+        if item_id != self.item_id:
+            self.item_id = item_id
+            self.forwarded_ms = 0
+            self._started_at = now
+        self.forwarded_ms += audio_bytes / self._bytes_per_ms
+
+    def on_unsent(self, ms: float):
+        """
+        Records that ms of the forwarded audio was dropped before it was sent to the client, so it can't have been played.
+        """
+        self.forwarded_ms = max(0, self.forwarded_ms - ms)
+
+    def played_ms(self, now: Optional[float] = None) -> float:
+        if self.item_id is None:
+            return 0
+        now = time.monotonic() if now is None else now
+        elapsed_ms = (now - self._started_at) * 1000 - self.playout_delay_ms
+        return min(self.forwarded_ms, max(0, elapsed_ms))
+
+    def interrupt(self, now: Optional[float] = None) -> Optional[tuple[str, int]]:
+        """
+        Called when the caller starts speaking. Returns the item id and the milliseconds of its audio the caller heard,
+        if the item was still playing. Further audio of that item should not be forwarded anymore.
+        """
+        if self.item_id is None:
+            return None
+        item_id, played_ms, forwarded_ms = self.item_id, self.played_ms(now), self.forwarded_ms
+        self.item_id = None
+        self.forwarded_ms = 0
+        if played_ms >= forwarded_ms:
+            # Everything was played already, nothing to cut off
+            return None
+        self._cancelled.append(item_id)
+        del self._cancelled[:-self.MAX_CANCELLED_ITEMS]
+        return item_id, int(played_ms)
@@ -0,0 +1,125 @@
+import asyncio
+import json
+import logging
+from collections import deque
+from typing import Awaitable, Callable, Optional
+from aiohttp import ClientWebSocketResponse, WSMsgType
+
+logger = logging.getLogger("voicerag")
+
+class RealtimeConnectionPool:
+    """
+    Keeps a number of OpenAI Realtime API WebSocket connections open and configured ahead of time,
+    so a new web or phone session can start talking without waiting for the TLS and WebSocket handshakes.
+    Claimed connections are replaced in the background. Connections that sat idle for longer than
+    max_idle_seconds are closed and replaced as well, before the service or the credentials expire them.
+    """
+    size: int
+    max_idle_seconds: float
+
+    # Seconds to wait for the service to confirm the session configuration of a new connection
+    SETUP_TIMEOUT_SECONDS = 10
+    # Seconds to wait before retrying after a connection attempt failed
+    RETRY_SECONDS = 5
+
+    def __init__(self, connect: Callable[[], Awaitable[ClientWebSocketResponse]], session_update: Callable[[], str], size: int, max_idle_seconds: float = 60):
+        self.size = size
+        self.max_idle_seconds = max_idle_seconds
+        self._connect = connect
+        self._session_update = session_update
+        self._idle: deque[tuple[ClientWebSocketResponse, float]] = deque()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def idle_count(self) -> int:
+        return len(self._idle)
+
+    def start(self):
+        if self._task is None and self.size > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        while self._idle:
+            ws, _ = self._idle.popleft()
+            await ws.close()
+
+    def claim(self) -> Optional[ClientWebSocketResponse]:
+        """
+        Returns a connected and configured WebSocket, or None if none is available right now.
+        The caller owns the returned connection and is responsible for closing it.
+        """
+        loop = asyncio.get_running_loop()
+        claimed = None
+        while self._idle and claimed is None:
+            ws, idle_since = self._idle.popleft()
+            if ws.closed or loop.time() - idle_since > self.max_idle_seconds:
+                asyncio.ensure_future(ws.close())
+            else:
+                claimed = ws
+        self._wakeup.set()
+        return claimed
+
+    async def _open(self) -> ClientWebSocketResponse:
+        ws = await self._connect()
+        try:
+            await ws.send_str(self._session_update())
+            # Consume the session.created and session.updated events, the session that claims
+            # the connection configures it again with its own settings anyway
+            async with asyncio.timeout(self.SETUP_TIMEOUT_SECONDS):
+                while True:
+                    msg = await ws.receive()
+                    if msg.type != WSMsgType.TEXT:
+                        raise ConnectionError(f"Connection closed during setup: {msg.type}")
+                    event = json.loads(msg.data)
+                    if event["type"] == "session.updated":
+                        return ws
+                    if event["type"] == "error":
+                        raise ConnectionError(f"Session setup failed: {event.get('error')}")
+        except BaseException:
+            await ws.close()
+            raise
+
+    def _evict_expired(self, now: float):
+        while self._idle:
+            ws, idle_since = self._idle[0]
+            if not ws.closed and now - idle_since <= self.max_idle_seconds:
+                break
+            self._idle.popleft()
+            asyncio.ensure_future(ws.close())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self._wakeup.clear()
+            self._evict_expired(loop.time())
+
+            retry = False
+            while len(self._idle) < self.size:
+                try:
+                    ws = await self._open()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.warning("Could not open pooled Realtime API connection: %s", e)
+                    retry = True
+                    break
+                self._idle.append((ws, loop.time()))
+
+            if retry:
+                timeout = self.RETRY_SECONDS
+            elif self._idle:
+                timeout = max(0, self._idle[0][1] + self.max_idle_seconds - loop.time())
+            else:
+                timeout = None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
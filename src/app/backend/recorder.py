@@ -0,0 +1,163 @@
+import base64
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterator, Optional
+from backend.helpers import find_audio_payload
+
+logger = logging.getLogger("voicerag")
+
+# Directions of recorded frames, always as received by the middle tier
+FROM_CLIENT = 0
+FROM_SERVER = 1
+
+# One fixed-size index record per frame: receive time in seconds since the session started, direction,
+# whether the frame carries audio, where the audio payload goes into the frame text, the frame text in
+# the events file and the decoded audio in the PCM file
+_INDEX_RECORD = struct.Struct("<dBBxxIQIQI")
+
+RECORDING_FORMAT_VERSION = 1
+
+_SUFFIXES = (".json", ".idx", ".events", ".pcm")
+
+# File I/O of all recorders runs on one thread, which keeps the writes of every recording in order
+_WRITER = ThreadPoolExecutor(max_workers=1, thread_name_prefix="session-recorder")
+
+class SessionRecorder:
+    """
+    Records every frame a session receives from its client and from the OpenAI Realtime API, with timestamps.
+    Audio payloads are decoded and appended to a raw PCM side file, the frames themselves are kept without their
+    payload in an events file, and a binary index with one fixed-size record per frame ties both together.
+    All three files can be memory-mapped for replay and analysis. Recordings contain the caller's voice and the
+    full conversation, only enable them where that is allowed.
+    Frames are collected in memory and written by a background thread in batches of about FLUSH_BYTES, so the
+    event loop never waits for the disk. The files are complete once the future returned by close() is done.
+    """
+    path: Path
+
+    FLUSH_BYTES = 256 * 1024
+
+    def __init__(self, directory: str, session_id: str, client_type: str):
+        self.path = Path(directory) / session_id
+        self._start = time.monotonic()
+        self._pcm_offset = 0
+        self._events_offset = 0
+        self._buffers = (bytearray(), bytearray(), bytearray())
+        self._files = None
+        self._failed = False
+        _WRITER.submit(self._open, directory, {
+            "version": RECORDING_FORMAT_VERSION,
+            "session_id": session_id,
+            "client": client_type,
+            "started_at": time.time(),
+        })
+
+    def record(self, direction: int, raw: str):
+        t = time.monotonic() - self._start
+        span = find_audio_payload(raw)
+        if span is not None:
+            audio = base64.b64decode(raw[span[0]:span[1]])
+            text = (raw[:span[0]] + raw[span[1]:]).encode("utf-8")
+            splice_at = len(raw[:span[0]].encode("utf-8"))
+        else:
+            audio = b""
+            text = raw.encode("utf-8")
+            splice_at = 0
+
+        index, events, pcm = self._buffers
+        index += _INDEX_RECORD.pack(t, direction, span is not None, splice_at, self._events_offset, len(text), self._pcm_offset, len(audio))
+        events += text
+        self._events_offset += len(text)
+        if audio:
+            pcm += audio
+            self._pcm_offset += len(audio)
+        if len(index) + len(events) + len(pcm) >= self.FLUSH_BYTES:
+            self.flush()
+
+    def flush(self):
+        """
+        Hands the frames recorded so far to the writer thread.
+        """
+        buffers, self._buffers = self._buffers, (bytearray(), bytearray(), bytearray())
+        _WRITER.submit(self._write, buffers)
+
+    def close(self) -> Future:
+        self.flush()
+        return _WRITER.submit(self._close)
+
+    def _open(self, directory: str, metadata: dict):
+        try:
+            os.makedirs(directory, exist_ok=True)
+            with open(f"{self.path}.json", "w", encoding="utf-8") as f:
+                json.dump(metadata, f)
+            self._files = tuple(open(f"{self.path}{suffix}", "wb") for suffix in (".idx", ".events", ".pcm"))
+        except OSError as e:
+            self._fail(e)
+
+    def _write(self, buffers: tuple[bytearray, bytearray, bytearray]):
+        if self._files is None:
+            return
+        try:
+            for f, data in zip(self._files, buffers):
+                f.write(data)
+        except OSError as e:
+            self._fail(e)
+
+    def _close(self):
+        if self._files is not None:
+            for f in self._files:
+                f.close()
+            self._files = None
+
+    def _fail(self, error: OSError):
+        # The session goes on without a recording
+        if not self._failed:
+            self._failed = True
+            logger.warning("Stopped recording %s: %s", self.path, error)
+        self._close()
+
+class Recording:
+    """
+    Reads a session recording, given the path of any of its files or without suffix.
+    Frames are restored as they were received, audio payloads are base64 encoded again.
+    """
+    metadata: dict
+
+    def __init__(self, path: str):
+        base = path[:-len(Path(path).suffix)] if Path(path).suffix in _SUFFIXES else path
+        with open(f"{base}.json", encoding="utf-8") as f:
+            self.metadata = json.load(f)
+        self._index = _map(f"{base}.idx")
+        self._events = _map(f"{base}.events")
+        self._pcm = _map(f"{base}.pcm")
+
+    @property
+    def is_acs(self) -> bool:
+        return self.metadata["client"] == "acs"
+
+    def __len__(self) -> int:
+        return len(self._index) // _INDEX_RECORD.size
+
+    def frames(self, direction: Optional[int] = None) -> Iterator[tuple[float, int, str]]:
+        """
+        Yields the receive time, direction and text of every frame, optionally of one direction only.
+        """
+        for t, frame_direction, is_audio, splice_at, events_offset, events_length, pcm_offset, pcm_length in _INDEX_RECORD.iter_unpack(self._index):
+            if direction is not None and frame_direction != direction:
+                continue
+            text = self._events[events_offset:events_offset + events_length]
+            if is_audio:
+                audio = base64.b64encode(self._pcm[pcm_offset:pcm_offset + pcm_length])
+                text = text[:splice_at] + audio + text[splice_at:]
+            yield t, frame_direction, text.decode("utf-8")
+
+def _map(path: str) -> bytes | mmap.mmap:
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
@@ -1,22 +1,266 @@
 import aiohttp
 import asyncio
+import base64
 import json
+import logging
+import time
+import uuid
 from typing import Any, Optional
 from aiohttp import ClientWebSocketResponse, web
-from azure.identity import DefaultAzureCredential, AzureDeveloperCliCredential, get_bearer_token_provider
+from azure.identity import DefaultAzureCredential, AzureDeveloperCliCredential
 from azure.core.credentials import AzureKeyCredential
-from backend.tools.tools import RTToolCall, Tool, ToolResultDirection
-from backend.helpers import transform_acs_to_openai_format, transform_openai_to_acs_format
+from backend.tools.tools import RTToolCall, Tool, ToolContext, ToolResult, ToolResultDirection
+from backend.helpers import AcsTranslator, get_input_audio, get_output_audio, parse_partial_json_object, peek_event_type, peek_item_id
+from backend.audio import PCM24K_BYTES_PER_MS, AudioCoalescer, SilenceGate, base64_decoded_length
+from backend.playout import PlayoutTracker
+from backend.metrics import REGISTRY
+from backend.recorder import FROM_CLIENT, FROM_SERVER, SessionRecorder
+from backend.send_queue import SendQueue
+from backend.session_config import SessionConfig
+from backend.greeting import Greeting, GreetingCache
+from backend.pool import RealtimeConnectionPool
+from backend.azure import OPENAI_SCOPE, AzureTokenCache
+
+logger = logging.getLogger("voicerag")
+
+# Default upper bound for concurrent client connections (web + ACS) handled by one process.
+# Every session holds two WebSockets and a bit of per-call state, so the limit is mostly
+# about keeping audio forwarding latency stable, not about memory.
+DEFAULT_MAX_SESSIONS = 50
+
+# Estimated time between forwarding the first audio chunk of a response and the caller hearing it.
+# The web frontend schedules playback 100 ms ahead, ACS adds its own jitter buffer on the phone leg.
+DEFAULT_WEB_PLAYOUT_DELAY_MS = 100
+DEFAULT_ACS_PLAYOUT_DELAY_MS = 200
+
+# Audio that may wait to be sent to a client or the service before the oldest of it is dropped. Answers arrive
+# faster than real time, so a few seconds of backlog towards a client are normal, more means it can't keep up.
+DEFAULT_SEND_QUEUE_MAX_AUDIO_MS = 10000
+
+# Voices of the OpenAI Realtime API. The service rejects a session.update with any other voice as a whole,
+# which would leave the session without the server-enforced instructions and tools.
+VOICES = frozenset({ "alloy", "ash", "ballad", "coral", "echo", "sage", "shimmer", "verse" })
+
+# Answers are queued in full when audio to phone calls is paced, so the bound only protects against runaway sessions
+_PACED_SEND_QUEUE_MAX_AUDIO_MS = 180000
+
+# Seconds to wait for queued frames to go out when a session ends
+_SEND_QUEUE_DRAIN_SECONDS = 5
+
+# Audio frames make up almost all of the traffic. They are recognized by peeking at the event type
+# and forwarded as raw text, so their base64 payload is never decoded and re-encoded.
+_AUDIO_EVENT_TO_SERVER = "input_audio_buffer.append"
+_AUDIO_APPEND_PREFIX = '{"type":"input_audio_buffer.append","audio":"'
+_AUDIO_APPEND_SUFFIX = '"}'
+_AUDIO_EVENT_TO_CLIENT = "response.audio.delta"
+
+# Events from the OpenAI Realtime API the middle tier needs to look into. All other events are
+# passed through to web clients untouched and are not relevant for ACS.
+_HANDLED_EVENTS_TO_CLIENT = frozenset({
+    "session.created",
+    "session.updated",
+    "response.output_item.added",
+    "conversation.item.created",
+    "response.function_call_arguments.delta",
+    "response.function_call_arguments.done",
+    "response.output_item.done",
+    "response.done",
+    "input_audio_buffer.speech_started",
+})
+
+_ACTIVE_SESSIONS = REGISTRY.gauge("voicerag_active_sessions", "Sessions currently bridged to the OpenAI Realtime API", ("client",))
+_REJECTED_SESSIONS = REGISTRY.counter("voicerag_rejected_sessions_total", "Connections closed because the session limit was reached", ("client",))
+_FRAMES = REGISTRY.counter("voicerag_frames_total", "WebSocket frames received per direction", ("client", "direction"))
+_BYTES = REGISTRY.counter("voicerag_bytes_total", "WebSocket payload bytes received per direction", ("client", "direction"))
+_RESPONSE_LATENCY = REGISTRY.histogram("voicerag_response_latency_seconds", "Time from the end of user speech to the first audio of the answer", ("client",))
+_TOOL_DURATION = REGISTRY.histogram("voicerag_tool_duration_seconds", "Duration of tool calls", ("tool", "outcome"))
+_SUPPRESSED_AUDIO = REGISTRY.counter("voicerag_suppressed_audio_seconds_total", "Caller audio not sent to the OpenAI Realtime API because it was silent", ("client",))
+_UPSTREAM_CONNECT = REGISTRY.histogram("voicerag_upstream_connect_seconds", "Time to open a WebSocket connection to the OpenAI Realtime API")
+
+class RTSession:
+    """
+    State of a single client connection (Web Frontend or ACS call) bridged to the OpenAI Realtime API.
+    Everything that differs between two concurrent calls lives here, never on the RTMiddleTier.
+    """
+    id: str
+    client_ws: web.WebSocketResponse
+    server_ws: Optional[ClientWebSocketResponse]
+    is_acs_audio_stream: bool
+    selected_voice: str
+    tools_pending: dict[str, RTToolCall]
+    tool_context: ToolContext
+    acs_translator: Optional[AcsTranslator]
+    audio_coalescer: Optional[AudioCoalescer]
+    silence_gate: Optional[SilenceGate]
+    playout: PlayoutTracker
+
+    # When the service detected the end of the last user utterance that has not been answered yet
+    speech_stopped_at: Optional[float]
+
+    recorder: Optional[SessionRecorder]
+
+    # The opening answer is played from the greeting cache or recorded into it, see RTMiddleTier.greeting_cache
+    greeted: bool
+    greeting_item_id: Optional[str]
+    greeting_key: Optional[str]
+    greeting_audio: list[str]
+
+    # Outbound frames per direction, written by their own tasks, None sends directly
+    client_queue: Optional[SendQueue]
+    server_queue: Optional[SendQueue]
+
+    def __init__(self, id: str, client_ws: web.WebSocketResponse, is_acs_audio_stream: bool, selected_voice: str, playout_delay_ms: float = 0, acs_audio_format: str = "pcm24k"):
+        self.id = id
+        self.client_ws = client_ws
+        self.server_ws = None
+        self.is_acs_audio_stream = is_acs_audio_stream
+        self.selected_voice = selected_voice
+        self.tools_pending = {}
+        self.tool_context = ToolContext()
+        self.acs_translator = AcsTranslator(audio_format=acs_audio_format) if is_acs_audio_stream else None
+        self.audio_coalescer = None
+        self.silence_gate = None
+        self.playout = PlayoutTracker(playout_delay_ms)
+        self.speech_stopped_at = None
+        self.recorder = None
+        self.greeted = False
+        self.greeting_item_id = None
+        self.greeting_key = None
+        self.greeting_audio = []
+        self.client_queue = None
+        self.server_queue = None
+        self._tasks = set()
+
+    @property
+    def client_type(self) -> str:
+        return "acs" if self.is_acs_audio_stream else "web"
+
+    def start_send_queues(self, max_audio_ms: float, client_lead_ms: Optional[float] = None):
+        if client_lead_ms is not None:
+            max_audio_ms = max(max_audio_ms, _PACED_SEND_QUEUE_MAX_AUDIO_MS)
+        self.client_queue = SendQueue(self.client_ws.send_str, "to_client", max_audio_ms, client_lead_ms)
+        self.server_queue = SendQueue(self.server_ws.send_str, "to_server", max_audio_ms)
+        self.create_task(self.client_queue.run())
+        self.create_task(self.server_queue.run())
+
+    async def send_to_client(self, data: str, audio_ms: float = 0):
+        if self.client_queue is not None:
+            self.client_queue.put(data, audio_ms)
+        else:
+            await self.client_ws.send_str(data)
+
+    async def write_to_server(self, data: str):
+        """
+        Sends a frame to the service right away, without passing the audio coalescer.
+        """
+        if self.server_queue is not None:
+            audio_ms = 0
+            if peek_event_type(data) == _AUDIO_EVENT_TO_SERVER:
+                audio_ms = base64_decoded_length(get_input_audio(data)) / PCM24K_BYTES_PER_MS
+            self.server_queue.put(data, audio_ms)
+        else:
+            await self.server_ws.send_str(data)
+
+    async def send_to_server(self, data: str):
+        if self.audio_coalescer is not None:
+            await self.audio_coalescer.send(data)
+        else:
+            await self.write_to_server(data)
+
+    async def send_audio_to_server(self, data: str):
+        if self.silence_gate is None and self.audio_coalescer is None:
+            await self.write_to_server(data)
+            return
+        audio = get_input_audio(data)
+        if audio is None:
+            await self.write_to_server(data)
+            return
+        if self.silence_gate is not None:
+            released = self.silence_gate.process(audio)
+            if len(released) == 0:
+                return
+            # Audio held back before the caller started speaking goes out first
+            for chunk in released[:-1]:
+                await self._send_audio_chunk(chunk, _AUDIO_APPEND_PREFIX + chunk + _AUDIO_APPEND_SUFFIX)
+        await self._send_audio_chunk(audio, data)
+
+    async def _send_audio_chunk(self, audio: str, data: str):
+        if self.audio_coalescer is not None:
+            await self.audio_coalescer.append(audio)
+        else:
+            await self.write_to_server(data)
+
+    def create_task(self, coro) -> asyncio.Task:
+        """
+        Runs work that belongs to this session in the background, it is cancelled when the session ends.
+        """
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def close(self):
+        for task in list(self._tasks):
+            task.cancel()
+        if self.audio_coalescer is not None:
+            self.audio_coalescer.close()
+        if self.silence_gate is not None:
+            _SUPPRESSED_AUDIO.labels(self.client_type).inc(self.silence_gate.suppressed_ms / 1000)
+        if self.recorder is not None:
+            self.recorder.close()
 
 class RTMiddleTier:
     endpoint: str
     deployment: str
     key: Optional[str] = None
+
+    # Voice of sessions whose client doesn't choose one, like phone calls
     selected_voice: str = "alloy"
 
     # Tools are server-side only for now, though the case could be made for client-side tools
     # in addition to server-side tools that are invisible to the client
-    tools: dict[str, Tool] = {}
+    tools: dict[str, Tool]
+
+    # Live sessions by id and the maximum number of them this process accepts
+    sessions: dict[str, RTSession]
+    max_sessions: int = DEFAULT_MAX_SESSIONS
+
+    # Merge caller audio into one upstream message per this many milliseconds, 0 forwards every chunk as it arrives
+    audio_coalesce_ms: int = 0
+
+    # Seconds a tool call may take before the model is told that it failed, tools can override this
+    tool_timeout_seconds: float = 10
+
+    # Start side-effect free tools from the streamed arguments, before the model has finished the function call
+    speculative_tools: bool = False
+
+    # Hold back caller audio quieter than this many dBFS, see backend.audio.SilenceGate, None forwards all audio
+    silence_threshold_dbfs: Optional[float] = None
+    silence_hangover_ms: float = 700
+    silence_padding_ms: float = 300
+
+    # Number of pre-connected Realtime API connections to keep ready, 0 connects on demand
+    pool_size: int = 0
+    pool_max_idle_seconds: float = 60
+
+    # Playout delay per client type, used to estimate how much of an interrupted answer the caller has heard
+    web_playout_delay_ms: float = DEFAULT_WEB_PLAYOUT_DELAY_MS
+    acs_playout_delay_ms: float = DEFAULT_ACS_PLAYOUT_DELAY_MS
+
+    # Send audio to phone calls at real-time rate, at most this far ahead of playback, 0 sends it as fast as it arrives
+    acs_playout_lead_ms: float = 0
+
+    # Audio format of phone calls until their AudioMetadata message says otherwise, see backend.audio.AUDIO_FORMATS
+    acs_audio_format: str = "pcm24k"
+
+    # Audio that may wait in the send queue of each direction before the oldest of it is dropped, 0 sends directly
+    send_queue_max_audio_ms: float = DEFAULT_SEND_QUEUE_MAX_AUDIO_MS
+
+    # Play the opening answer from this cache instead of having the model generate it for every session
+    greeting_cache: Optional[GreetingCache] = None
+
+    # Record the frames of every session into this directory for offline replay, see backend.recorder
+    recording_dir: Optional[str] = None
 
     # Server-enforced configuration, if set, these will override the client's configuration
     # Typically at least the model name and system message will be set by the server
@@ -26,19 +270,71 @@ class RTMiddleTier:
     max_tokens: Optional[int] = None
     disable_audio: Optional[bool] = None
 
-    _tools_pending: dict[str, RTToolCall] = {}
-    _token_provider = None
+    # Serialized form of the settings above, shared by all sessions until reload_session_config() replaces it
+    _session_config: Optional[SessionConfig] = None
+    _token_cache: Optional[AzureTokenCache] = None
+    _http_session: Optional[aiohttp.ClientSession] = None
+    _pool: Optional[RealtimeConnectionPool] = None
 
-    def __init__(self, endpoint: str, deployment: str, credentials: AzureKeyCredential | AzureDeveloperCliCredential | DefaultAzureCredential):
+    def __init__(self, endpoint: str, deployment: str, credentials: AzureKeyCredential | AzureDeveloperCliCredential | DefaultAzureCredential, max_sessions: int = DEFAULT_MAX_SESSIONS, audio_coalesce_ms: int = 0, pool_size: int = 0, pool_max_idle_seconds: float = 60, token_cache: Optional[AzureTokenCache] = None, tool_timeout_seconds: float = 10, speculative_tools: bool = False, web_playout_delay_ms: float = DEFAULT_WEB_PLAYOUT_DELAY_MS, acs_playout_delay_ms: float = DEFAULT_ACS_PLAYOUT_DELAY_MS, acs_playout_lead_ms: float = 0, acs_audio_format: str = "pcm24k", recording_dir: Optional[str] = None, greeting_cache_dir: Optional[str] = None, send_queue_max_audio_ms: float = DEFAULT_SEND_QUEUE_MAX_AUDIO_MS, silence_threshold_dbfs: Optional[float] = None, silence_hangover_ms: float = 700, silence_padding_ms: float = 300):
         self.endpoint = endpoint
         self.deployment = deployment
+        self.tools = {}
+        self.sessions = {}
+        self.max_sessions = max_sessions
+        self.audio_coalesce_ms = audio_coalesce_ms
+        self.pool_size = pool_size
+        self.pool_max_idle_seconds = pool_max_idle_seconds
+        self.tool_timeout_seconds = tool_timeout_seconds
+        self.speculative_tools = speculative_tools
+        self.web_playout_delay_ms = web_playout_delay_ms
+        self.acs_playout_delay_ms = acs_playout_delay_ms
+        self.acs_playout_lead_ms = acs_playout_lead_ms
+        self.acs_audio_format = acs_audio_format
+        self.recording_dir = recording_dir
+        if greeting_cache_dir is not None:
+            self.greeting_cache = GreetingCache(greeting_cache_dir)
+        self.send_queue_max_audio_ms = send_queue_max_audio_ms
+        self.silence_threshold_dbfs = silence_threshold_dbfs
+        self.silence_hangover_ms = silence_hangover_ms
+        self.silence_padding_ms = silence_padding_ms
         if isinstance(credentials, AzureKeyCredential):
             self.key = credentials.key
         else:
-            self._token_provider = get_bearer_token_provider(credentials, "https://cognitiveservices.azure.com/.default")
-            self._token_provider() # Warm up during startup so we have a token cached when the first request arrives
+            # Tokens are fetched off the event loop and refreshed ahead of expiry, pass a shared, started cache
+            # to have a token ready when the first request arrives
+            self._token_cache = token_cache if token_cache is not None else AzureTokenCache(credentials, [OPENAI_SCOPE])
+
+    async def _process_message_to_client(self, raw: str, session: RTSession):
+        event_type = peek_event_type(raw)
+        if event_type == _AUDIO_EVENT_TO_CLIENT:
+            # Audio of an answer the caller interrupted is dropped, it would only be cleared on the client again
+            item_id = peek_item_id(raw)
+            if session.playout.is_cancelled(item_id):
+                return
+            audio = get_output_audio(raw)
+            if session.greeting_key is not None and audio is not None:
+                session.greeting_audio.append(audio)
+            audio_bytes = base64_decoded_length(audio)
+            session.playout.on_audio(item_id, audio_bytes)
+            if session.speech_stopped_at is not None:
+                _RESPONSE_LATENCY.labels(session.client_type).observe(time.monotonic() - session.speech_stopped_at)
+                session.speech_stopped_at = None
+            audio_ms = audio_bytes / PCM24K_BYTES_PER_MS
+            if session.is_acs_audio_stream:
+                await session.send_to_client(session.acs_translator.to_acs(raw), audio_ms)
+            else:
+                await session.send_to_client(raw, audio_ms)
+            return
+        if event_type == "input_audio_buffer.speech_stopped":
+            session.speech_stopped_at = time.monotonic()
+        if event_type is not None and event_type not in _HANDLED_EVENTS_TO_CLIENT:
+            if not session.is_acs_audio_stream:
+                await session.send_to_client(raw)
+            return
+
+        message = json.loads(raw)
 
-    async def _process_message_to_client(self, message: Any, client_ws: web.WebSocketResponse, server_ws: ClientWebSocketResponse, is_acs_audio_stream: bool):
         # This method basically follows a 3-step process:
         # 1. Check if we need to react to the message (e.g. a function call needs to me made)
         # 2. Check if we need to transform the message to a different format (e.g. when we use Azure Communication Services)
@@ -47,21 +343,33 @@ class RTMiddleTier:
         if message is not None:
             match message["type"]:
                 case "session.created":
-                    session = message["session"]
+                    config = message["session"]
                     # Hide the instructions, tools and max tokens from clients, if we ever allow client-side
                     # tools, this will need updating
-                    session["instructions"] = ""
-                    session["tools"] = []
-                    session["tool_choice"] = "none"
-                    session["max_response_output_tokens"] = None
+                    config["instructions"] = ""
+                    config["tools"] = []
+                    config["tool_choice"] = "none"
+                    config["max_response_output_tokens"] = None
 
                 case "session.updated":
                     # Prompt the model to take over the conversation and talk whenever a session was updated
                     # This is also the case, when the client connects for the first time
                     # This ensures, that the model starts the conversation the moment the client connects
-                    await server_ws.send_json({
-                        "type": "response.create"
-                    })
+                    # The first time, a cached greeting is played instead, if there is one
+                    greeting = None
+                    if not session.greeted:
+                        session.greeted = True
+                        if self.greeting_cache is not None and not self.disable_audio:
+                            key = GreetingCache.key(self.system_message, session.selected_voice)
+                            greeting = await self.greeting_cache.get(key)
+                            if greeting is None:
+                                session.greeting_key = key
+                    if greeting is not None:
+                        session.create_task(self._play_greeting(session, greeting))
+                    else:
+                        await session.send_to_server(json.dumps({
+                            "type": "response.create"
+                        }))
 
                 case "response.output_item.added":
                     if "item" in message and message["item"]["type"] == "function_call":
@@ -70,54 +378,65 @@ class RTMiddleTier:
                 case "conversation.item.created":
                     if "item" in message and message["item"]["type"] == "function_call":
                         item = message["item"]
-                        if item["call_id"] not in self._tools_pending:
-                            self._tools_pending[item["call_id"]] = RTToolCall(item["call_id"], message["previous_item_id"])
+                        if item["call_id"] not in session.tools_pending:
+                            session.tools_pending[item["call_id"]] = RTToolCall(item["call_id"], message["previous_item_id"], item.get("name"))
                         message = None
                     elif "item" in message and message["item"]["type"] == "function_call_output":
                         message = None
 
                 case "response.function_call_arguments.delta":
+                    tool_call = session.tools_pending.get(message["call_id"])
+                    if tool_call is not None:
+                        tool_call.response_id = message.get("response_id")
+                    if self.speculative_tools and tool_call is not None and tool_call.speculative_task is None:
+                        tool_call.arguments += message["delta"]
+                        self._start_speculative_tool_call(session, tool_call, parse_partial_json_object(tool_call.arguments))
                     message = None
 
                 case "response.function_call_arguments.done":
+                    tool_call = session.tools_pending.get(message["call_id"])
+                    if tool_call is not None:
+                        tool_call.response_id = message.get("response_id")
+                    if self.speculative_tools and tool_call is not None and tool_call.speculative_task is None:
+                        # Malformed arguments only rule out speculation, they must not end the session
+                        self._start_speculative_tool_call(session, tool_call, parse_partial_json_object(message["arguments"]))
                     message = None
 
                 case "response.output_item.done":
                     if "item" in message and message["item"]["type"] == "function_call":
                         item = message["item"]
-                        tool_call = self._tools_pending[message["item"]["call_id"]]
-                        tool = self.tools[item["name"]]
-                        args = item["arguments"]
-                        result = await tool.target(json.loads(args))
-
-                        await server_ws.send_json({
-                            "type": "conversation.item.create",
-                            "item": {
-                                "type": "function_call_output",
-                                "call_id": item["call_id"],
-                                "output": result.to_text() if result.destination == ToolResultDirection.TO_SERVER else ""
-                            }
-                        })
-
-                        if result.destination == ToolResultDirection.TO_CLIENT:
-                            # Only send extra messages to clients that are not ACS audio streams
-                            if is_acs_audio_stream == False:
-                                # TODO: this will break clients that don't know about this extra message, rewrite
-                                # this to be a regular text message with a special marker of some sort
-                                await client_ws.send_json({
-                                    "type": "extension.middle_tier_tool_response",
-                                    "previous_item_id": tool_call.previous_id,
-                                    "tool_name": item["name"],
-                                    "tool_result": result.to_text()
-                                })
+                        tool_call = session.tools_pending.get(item["call_id"])
+                        if tool_call is None:
+                            tool_call = session.tools_pending[item["call_id"]] = RTToolCall(item["call_id"], None, item["name"])
+                        tool_call.response_id = message.get("response_id")
+
+                        # Reuse a speculative execution if it was started with the final arguments, otherwise discard it
+                        args = json.loads(item["arguments"])
+                        execution = tool_call.speculative_task
+                        if execution is not None and tool_call.speculative_args != args:
+                            execution.cancel()
+                            execution = None
+                        if execution is None:
+                            execution = session.create_task(self._execute_tool(session, item["name"], args))
+
+                        # Run the tool in the background, so audio and other events keep streaming while it works
+                        tool_call.task = session.create_task(self._run_tool_call(session, tool_call, item["name"], execution))
                         message = None
 
                 case "response.done":
-                    if len(self._tools_pending) > 0:
-                        self._tools_pending.clear() # Any chance tool calls could be interleaved across different outstanding responses?
-                        await server_ws.send_json({
-                            "type": "response.create"
-                        })
+                    if session.greeting_key is not None:
+                        self._store_greeting(session, message.get("response", {}))
+                    # Let the model continue once all tool calls of this response have delivered their output
+                    response_id = message["response"].get("id") if "response" in message else None
+                    finished = [c for c in session.tools_pending.values() if c.response_id in (response_id, None)]
+                    for tool_call in finished:
+                        del session.tools_pending[tool_call.tool_call_id]
+                        # Calls of a cancelled or interrupted response never completed, drop their speculative work
+                        if tool_call.task is None and tool_call.speculative_task is not None:
+                            tool_call.speculative_task.cancel()
+                    tool_calls = [c for c in finished if c.task is not None]
+                    if len(tool_calls) > 0:
+                        session.create_task(self._continue_after_tool_calls(session, tool_calls))
 
                     if "response" in message:
                         replace = False
@@ -132,89 +451,322 @@ class RTMiddleTier:
                 # This happens when OpenAI detects, that the user starts speaking and won't continue to speak and send audio.
                 # In this case, we don't want to send the unplayed audio buffer to the client anymore.
                 # For the web app, we pass this message to the client, so it can clear the audio buffer.
-                # For Azure Communication Services, we don't need to do anything here. The transform_openai_to_acs_format function
-                # will handle this message and clear the audio buffer.
+                # For Azure Communication Services, the translator turns this message into a StopAudio message.
+                # The answer that was playing is truncated to what the caller has heard, so the model doesn't
+                # assume the caller knows the rest (https://platform.openai.com/docs/api-reference/realtime-client-events/conversation/item/truncate)
                 case "input_audio_buffer.speech_started":
-                    # TODO: Add Truncation
-                    # if message["item_id"]:
-                    #     await server_ws.send_json({
-                    #         "type": "conversation.item.truncate",
-                    #         "item_id": message['item_id'],
-                    #         "audio_end_ms": ??? # Set this to let the model know, how much audio has been played (https://platform.openai.com/docs/api-reference/realtime-client-events/conversation/item/truncate)
-                    #     })
-                    pass
+                    # Audio still queued was never sent, with paced playout that is most of the answer
+                    if session.client_queue is not None:
+                        session.playout.on_unsent(session.client_queue.discard_audio())
+                    interrupted = session.playout.interrupt()
+                    # The cached greeting is a text item on the service, it has no audio to truncate
+                    if interrupted is not None and interrupted[0] != session.greeting_item_id:
+                        item_id, audio_end_ms = interrupted
+                        await session.send_to_server(json.dumps({
+                            "type": "conversation.item.truncate",
+                            "item_id": item_id,
+                            "content_index": 0,
+                            "audio_end_ms": audio_end_ms
+                        }))
 
         # Transform the message to the Azure Communication Services format,
         # if it comes from the OpenAI realtime stream.
-        if is_acs_audio_stream and message is not None:
-            message = transform_openai_to_acs_format(message)
-
         if message is not None:
-            await client_ws.send_str(json.dumps(message))
+            if session.is_acs_audio_stream:
+                acs_message = session.acs_translator.to_acs_event(message)
+                if acs_message is not None:
+                    await session.send_to_client(acs_message)
+            else:
+                await session.send_to_client(json.dumps(message))
+
+    async def _play_greeting(self, session: RTSession, greeting: Greeting):
+        # The greeting becomes part of the conversation as an assistant message, so the model knows what was said
+        item_id = "greeting_" + uuid.uuid4().hex[:23]
+        session.greeting_item_id = item_id
+        await session.send_to_server(json.dumps({
+            "type": "conversation.item.create",
+            "item": {
+                "id": item_id,
+                "type": "message",
+                "role": "assistant",
+                "content": [{ "type": "text", "text": greeting.transcript }]
+            }
+        }))
+        # Audio takes the regular path to the client, which drops the rest of it when the caller interrupts
+        for chunk in greeting.audio_chunks():
+            await self._process_message_to_client(json.dumps({
+                "type": "response.audio.delta",
+                "item_id": item_id,
+                "content_index": 0,
+                "delta": chunk
+            }), session)
+
+    def _store_greeting(self, session: RTSession, response: dict[str, Any]):
+        # Only complete spoken answers are cached, not ones that were cancelled or called a tool
+        key, audio = session.greeting_key, session.greeting_audio
+        session.greeting_key = None
+        session.greeting_audio = []
+        outputs = response.get("output", [])
+        if response.get("status") != "completed" or len(outputs) == 0 or any(output["type"] != "message" for output in outputs):
+            return
+        transcript = "".join(content.get("transcript") or "" for output in outputs for content in output.get("content", []) if content.get("type") == "audio")
+        if transcript and audio:
+            pcm = b"".join(base64.b64decode(chunk) for chunk in audio)
+            session.create_task(self.greeting_cache.put(key, Greeting(transcript, pcm)))
+
+    async def _execute_tool(self, session: RTSession, name: str, args: Any) -> ToolResult:
+        tool = self.tools[name]
+        timeout = tool.timeout if tool.timeout is not None else self.tool_timeout_seconds
+        start = time.monotonic()
+        outcome = "ok"
+        try:
+            return await asyncio.wait_for(tool.target(args, session.tool_context), timeout)
+        except asyncio.TimeoutError:
+            outcome = "timeout"
+            logger.warning("Tool %s timed out after %s seconds", name, timeout)
+            return ToolResult(f"The {name} tool did not respond in time. Let the user know that the information is not available right now.", ToolResultDirection.TO_SERVER)
+        except asyncio.CancelledError:
+            outcome = "cancelled"
+            raise
+        except Exception as e:
+            outcome = "error"
+            logger.exception("Tool %s failed", name)
+            return ToolResult(f"The {name} tool failed: {e}", ToolResultDirection.TO_SERVER)
+        finally:
+            _TOOL_DURATION.labels(name, outcome).observe(time.monotonic() - start)
 
-    async def _process_message_to_server(self, data: Any, ws: web.WebSocketResponse, server_ws: ClientWebSocketResponse, is_acs_audio_stream: bool):
+    def _start_speculative_tool_call(self, session: RTSession, tool_call: RTToolCall, args: Optional[dict[str, Any]]):
+        # Only tools without side effects run before the model has committed to the call, and only once all
+        # required arguments are there. If the final arguments turn out different, the result is discarded.
+        tool = self.tools.get(tool_call.name)
+        if tool is None or not tool.speculative or args is None:
+            return
+        if not all(key in args for key in tool.schema.get("parameters", {}).get("required", [])):
+            return
+        tool_call.speculative_args = args
+        tool_call.speculative_task = session.create_task(self._execute_tool(session, tool_call.name, args))
+
+    async def _run_tool_call(self, session: RTSession, tool_call: RTToolCall, name: str, execution: asyncio.Future):
+        result = await execution
+
+        # Only now the chunks are known to the model, a discarded speculative result never got there
+        session.tool_context.sent_chunks.update(result.chunk_ids)
+        await session.send_to_server(json.dumps({
+            "type": "conversation.item.create",
+            "item": {
+                "type": "function_call_output",
+                "call_id": tool_call.tool_call_id,
+                "output": result.to_text() if result.destination == ToolResultDirection.TO_SERVER else ""
+            }
+        }))
+
+        if result.destination == ToolResultDirection.TO_CLIENT:
+            # Only send extra messages to clients that are not ACS audio streams
+            if session.is_acs_audio_stream == False:
+                # TODO: this will break clients that don't know about this extra message, rewrite
+                # this to be a regular text message with a special marker of some sort
+                await session.send_to_client(json.dumps({
+                    "type": "extension.middle_tier_tool_response",
+                    "previous_item_id": tool_call.previous_id,
+                    "tool_name": name,
+                    "tool_result": result.to_text()
+                }))
+
+    async def _continue_after_tool_calls(self, session: RTSession, tool_calls: list[RTToolCall]):
+        # Tool calls handle their own errors, gather only waits for all of them to finish
+        await asyncio.gather(*(tool_call.task for tool_call in tool_calls), return_exceptions=True)
+        await session.send_to_server(json.dumps({
+            "type": "response.create"
+        }))
+
+    @property
+    def session_config(self) -> SessionConfig:
+        if self._session_config is None:
+            return self.reload_session_config()
+        return self._session_config
+
+    def reload_session_config(self) -> SessionConfig:
+        """
+        Takes a new snapshot of the server-enforced settings and tools. Call it after changing them while sessions
+        are running, sessions pick up the new configuration with their next session.update.
+        """
+        version = self._session_config.version + 1 if self._session_config is not None else 1
+        self._session_config = SessionConfig(version, dict(self.tools), self.system_message, self.temperature, self.max_tokens, self.disable_audio)
+        logger.info("Using session configuration version %d", version)
+        return self._session_config
+
+    def set_system_message(self, system_message: str):
+        self.system_message = system_message
+        self.reload_session_config()
+
+    async def _process_message_to_server(self, raw: str, session: RTSession):
         # If the message comes from the Azure Communication Services audio stream, transform it to the OpenAI Realtime API format first
-        if (is_acs_audio_stream):
-            data = transform_acs_to_openai_format(data, self.model, self.tools, self.system_message, self.temperature, self.max_tokens, self.disable_audio, self.selected_voice)
+        if (session.is_acs_audio_stream):
+            raw = session.acs_translator.to_openai(raw)
+            if raw is None:
+                return
+
+        event_type = peek_event_type(raw)
+        if event_type == _AUDIO_EVENT_TO_SERVER:
+            await session.send_audio_to_server(raw)
+            return
+        if event_type == "session.update":
+            await session.send_to_server(self.session_config.session_update_from_raw(session.selected_voice, raw))
+            return
+
+        data = json.loads(raw)
 
         if data is not None:
             match data["type"]:
                 case "session.update":
-                    session = data["session"]
-                    session["voice"] = self.selected_voice
-                    if self.system_message is not None:
-                        session["instructions"] = self.system_message
-                    if self.temperature is not None:
-                        session["temperature"] = self.temperature
-                    if self.max_tokens is not None:
-                        session["max_response_output_tokens"] = self.max_tokens
-                    if self.disable_audio is not None:
-                        session["disable_audio"] = self.disable_audio
-                    session["tool_choice"] = "auto" if len(self.tools) > 0 else "none"
-                    session["tools"] = [tool.schema for tool in self.tools.values()]
-                    data["session"] = session
-
-            await server_ws.send_str(json.dumps(data))
-
-    async def forward_messages(self, ws: web.WebSocketResponse, is_acs_audio_stream: bool):
-        async with aiohttp.ClientSession(base_url=self.endpoint) as session:
-            params = { "api-version": "2024-10-01-preview", "deployment": self.deployment }
-
-            headers = {}
-            if "x-ms-client-request-id" in ws.headers:
-                headers["x-ms-client-request-id"] = ws.headers["x-ms-client-request-id"]
-
-            # Setup authentication headers for the OpenAI Realtime API WebSocket connection
-            if self.key is not None:
-                headers = { "api-key": self.key }
+                    await session.send_to_server(self.session_config.session_update(session.selected_voice, data))
+                    return
+
+            await session.send_to_server(json.dumps(data))
+
+    def _create_session(self, ws: web.WebSocketResponse, is_acs_audio_stream: bool, voice: Optional[str] = None) -> RTSession:
+        # ACS sends the call connection id with the media streaming WebSocket, which makes
+        # sessions easy to correlate with call automation events. Web clients get a random id.
+        session_id = ws.headers.get("x-ms-call-connection-id") if is_acs_audio_stream else None
+        if session_id is None or session_id in self.sessions:
+            session_id = str(uuid.uuid4())
+        playout_delay_ms = self.acs_playout_delay_ms if is_acs_audio_stream else self.web_playout_delay_ms
+        if voice is not None and voice not in VOICES:
+            logger.warning("Ignoring unsupported voice %s, using %s", voice, self.selected_voice)
+            voice = None
+        return RTSession(session_id, ws, is_acs_audio_stream, voice or self.selected_voice, playout_delay_ms, self.acs_audio_format)
+
+    async def forward_messages(self, ws: web.WebSocketResponse, is_acs_audio_stream: bool, voice: Optional[str] = None):
+        if len(self.sessions) >= self.max_sessions:
+            logger.warning("Rejecting connection, %d of %d sessions in use", len(self.sessions), self.max_sessions)
+            _REJECTED_SESSIONS.labels("acs" if is_acs_audio_stream else "web").inc()
+            await ws.close(code=aiohttp.WSCloseCode.TRY_AGAIN_LATER, message=b"Too many concurrent sessions")
+            return
+
+        session = self._create_session(ws, is_acs_audio_stream, voice)
+        if self.recording_dir is not None:
+            session.recorder = SessionRecorder(self.recording_dir, session.id, session.client_type)
+        self.sessions[session.id] = session
+        active_sessions = _ACTIVE_SESSIONS.labels(session.client_type)
+        active_sessions.inc()
+        try:
+            await self._forward_session_messages(session)
+        finally:
+            session.close()
+            del self.sessions[session.id]
+            active_sessions.dec()
+
+    async def start(self):
+        """
+        Starts background work that needs a running event loop, like filling the connection pool.
+        """
+        # The tools and the system message are configured by now, serialize them once for all sessions
+        self.reload_session_config()
+        if self.pool_size > 0 and self._pool is None:
+            self._pool = RealtimeConnectionPool(self._connect, self._pooled_session_update, self.pool_size, self.pool_max_idle_seconds)
+            self._pool.start()
+
+    async def close(self):
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+        if self._http_session is not None:
+            await self._http_session.close()
+            self._http_session = None
+
+    @property
+    def pooled_connections(self) -> int:
+        return self._pool.idle_count if self._pool is not None else 0
+
+    def _get_http_session(self) -> aiohttp.ClientSession:
+        # One HTTP session for the whole process, so connections to the Realtime API share DNS and TLS state
+        if self._http_session is None or self._http_session.closed:
+            self._http_session = aiohttp.ClientSession(base_url=self.endpoint)
+        return self._http_session
+
+    async def _connect(self, client_request_id: Optional[str] = None) -> ClientWebSocketResponse:
+        params = { "api-version": "2024-10-01-preview", "deployment": self.deployment }
+
+        # Setup authentication headers for the OpenAI Realtime API WebSocket connection
+        if self.key is not None:
+            headers = { "api-key": self.key }
+        else:
+            if self._token_cache is not None:
+                headers = { "Authorization": await self._token_cache.get_bearer(OPENAI_SCOPE) }
             else:
-                if self._token_provider is not None:
-                    headers = { "Authorization": f"Bearer {self._token_provider()}" } # NOTE: no async version of token provider, maybe refresh token on a timer?
-                else:
-                    raise ValueError("No token provider available")
-
-            # Connect to the OpenAI Realtime API WebSocket
-            async with session.ws_connect("/openai/realtime", headers=headers, params=params) as target_ws:
-                async def from_client_to_server():
-                    # Messages from Azure Communication Services or the Web Frontend are forwarded to the OpenAI Realtime API
-                    async for msg in ws:
-                        if msg.type == aiohttp.WSMsgType.TEXT:
-                            data = json.loads(msg.data)
-                            await self._process_message_to_server(data, ws, target_ws, is_acs_audio_stream)
-                        else:
-                            print("Error: unexpected message type:", msg.type)
-
-                async def from_server_to_client():
-                    # Messages from the OpenAI Realtime API are forwarded to the Azure Communication Services or the Web Frontend
-                    async for msg in target_ws:
-                        if msg.type == aiohttp.WSMsgType.TEXT:
-                            data = json.loads(msg.data)
-                            await self._process_message_to_client(data, ws, target_ws, is_acs_audio_stream)
-                        else:
-                            print("Error: unexpected message type:", msg.type)
-
-                try:
-                    await asyncio.gather(from_client_to_server(), from_server_to_client())
-                except ConnectionResetError:
-                    # Ignore the errors resulting from the client disconnecting the socket
-                    pass
+                raise ValueError("No token provider available")
+
+        if client_request_id is not None:
+            headers["x-ms-client-request-id"] = client_request_id
+
+        start = time.monotonic()
+        ws = await self._get_http_session().ws_connect("/openai/realtime", headers=headers, params=params)
+        _UPSTREAM_CONNECT.observe(time.monotonic() - start)
+        return ws
+
+    def _pooled_session_update(self) -> str:
+        # Pooled connections are configured with the server-enforced settings and the default voice
+        return self.session_config.session_update(self.selected_voice)
+
+    async def _forward_session_messages(self, session: RTSession):
+        ws = session.client_ws
+
+        # Connect to the OpenAI Realtime API WebSocket, preferably by taking a connection from the pool
+        target_ws = self._pool.claim() if self._pool is not None else None
+        if target_ws is None:
+            target_ws = await self._connect(ws.headers.get("x-ms-client-request-id"))
+
+        try:
+            session.server_ws = target_ws
+            paced = session.is_acs_audio_stream and self.acs_playout_lead_ms > 0
+            if self.send_queue_max_audio_ms > 0 or paced:
+                # Each socket gets its own writer, so a slow client never holds up reading from the service
+                session.start_send_queues(self.send_queue_max_audio_ms, self.acs_playout_lead_ms if paced else None)
+            if self.silence_threshold_dbfs is not None:
+                session.silence_gate = SilenceGate(self.silence_threshold_dbfs, self.silence_hangover_ms, self.silence_padding_ms)
+            if self.audio_coalesce_ms > 0:
+                session.audio_coalescer = AudioCoalescer(session.write_to_server, self.audio_coalesce_ms)
+
+            frames_to_server = _FRAMES.labels(session.client_type, "to_server")
+            bytes_to_server = _BYTES.labels(session.client_type, "to_server")
+            frames_to_client = _FRAMES.labels(session.client_type, "to_client")
+            bytes_to_client = _BYTES.labels(session.client_type, "to_client")
+
+            async def from_client_to_server():
+                # Messages from Azure Communication Services or the Web Frontend are forwarded to the OpenAI Realtime API
+                async for msg in ws:
+                    if msg.type == aiohttp.WSMsgType.TEXT:
+                        frames_to_server.inc()
+                        bytes_to_server.inc(len(msg.data))
+                        if session.recorder is not None:
+                            session.recorder.record(FROM_CLIENT, msg.data)
+                        await self._process_message_to_server(msg.data, session)
+                    else:
+                        logger.warning("Unexpected message type from client: %s", msg.type)
+                # The client hung up, release the upstream connection so the session can end
+                if session.server_queue is not None:
+                    await session.server_queue.drain(_SEND_QUEUE_DRAIN_SECONDS)
+                await target_ws.close()
+
+            async def from_server_to_client():
+                # Messages from the OpenAI Realtime API are forwarded to the Azure Communication Services or the Web Frontend
+                async for msg in target_ws:
+                    if msg.type == aiohttp.WSMsgType.TEXT:
+                        frames_to_client.inc()
+                        bytes_to_client.inc(len(msg.data))
+                        if session.recorder is not None:
+                            session.recorder.record(FROM_SERVER, msg.data)
+                        await self._process_message_to_client(msg.data, session)
+                    else:
+                        logger.warning("Unexpected message type from the Realtime API: %s", msg.type)
+                if session.client_queue is not None:
+                    await session.client_queue.drain(_SEND_QUEUE_DRAIN_SECONDS)
+                await ws.close()
+
+            try:
+                await asyncio.gather(from_client_to_server(), from_server_to_client())
+            except ConnectionResetError:
+                # Ignore the errors resulting from the client disconnecting the socket
+                pass
+        finally:
+            await target_ws.close()
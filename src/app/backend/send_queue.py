@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Awaitable, Callable, Optional
+from backend.metrics import REGISTRY
+
+logger = logging.getLogger("voicerag")
+
+_QUEUED_FRAMES = REGISTRY.gauge("voicerag_send_queue_frames", "Frames waiting in the send queues of all sessions", ("direction",))
+_QUEUED_AUDIO = REGISTRY.gauge("voicerag_send_queue_audio_seconds", "Audio waiting in the send queues of all sessions", ("direction",))
+_DROPPED_AUDIO = REGISTRY.counter("voicerag_send_queue_dropped_audio_seconds_total", "Audio dropped because a send queue was full or the caller interrupted", ("direction",))
+
+class SendQueue:
+    """
+    Outbound frames of one WebSocket, written by a dedicated task, so the loop reading the other socket never
+    waits for a slow receiver. Audio is bounded by max_audio_ms: when more audio is queued, the oldest audio
+    frames are dropped, they would be played late anyway. Control frames are never dropped and keep their order.
+    With lead_ms, audio is paced to real time: it is only sent while the receiver has less than lead_ms of audio
+    left to play, so unsent audio stays here, where it can be dropped instantly when the caller interrupts.
+    """
+    direction: str
+    max_audio_ms: float
+    lead_ms: Optional[float]
+    audio_ms: float
+
+    def __init__(self, send: Callable[[str], Awaitable[None]], direction: str, max_audio_ms: float, lead_ms: Optional[float] = None):
+        self.direction = direction
+        self.max_audio_ms = max_audio_ms
+        self.lead_ms = lead_ms
+        self.audio_ms = 0
+        # When the receiver will have played all audio sent so far, if paced
+        self._playout_end = 0.0
+        self._send = send
+        self._frames: deque[tuple[str, float]] = deque()
+        self._ready = asyncio.Event()
+        # Set when queued audio was dropped or the queue was closed, ends a wait for pacing
+        self._changed = asyncio.Event()
+        self._done = asyncio.Event()
+        self._closed = False
+        self._queued_frames = _QUEUED_FRAMES.labels(direction)
+        self._queued_audio = _QUEUED_AUDIO.labels(direction)
+        self._dropped_audio = _DROPPED_AUDIO.labels(direction)
+
+    def __len__(self) -> int:
+        return len(self._frames)
+
+    def put(self, data: str, audio_ms: float = 0):
+        """
+        Queues a frame without waiting, audio_ms > 0 marks it as audio that may be dropped under overload.
+        """
+        if self._closed:
+            return
+        self._frames.append((data, audio_ms))
+        self._queued_frames.inc()
+        if audio_ms > 0:
+            self.audio_ms += audio_ms
+            self._queued_audio.inc(audio_ms / 1000)
+            if self.audio_ms > self.max_audio_ms:
+                self._drop_audio(self.audio_ms - self.max_audio_ms)
+        self._ready.set()
+
+    def discard_audio(self) -> float:
+        """
+        Drops all queued audio, e.g. when the caller interrupted the answer it belongs to, and returns its duration.
+        The receiver is expected to stop playing as well, so pacing starts over with the next audio.
+        """
+        self._playout_end = 0
+        return self._drop_audio(self.audio_ms)
+
+    def _drop_audio(self, ms: float) -> float:
+        kept = deque()
+        dropped_ms = 0
+        for data, audio_ms in self._frames:
+            if audio_ms > 0 and dropped_ms < ms:
+                dropped_ms += audio_ms
+            else:
+                kept.append((data, audio_ms))
+        self._queued_frames.dec(len(self._frames) - len(kept))
+        self._frames = kept
+        self.audio_ms -= dropped_ms
+        self._queued_audio.dec(dropped_ms / 1000)
+        self._dropped_audio.inc(dropped_ms / 1000)
+        self._changed.set()
+        return dropped_ms
+
+    async def run(self):
+        """
+        Writes queued frames until the queue is closed or the socket fails.
+        """
+        try:
+            while True:
+                while self._frames:
+                    data, audio_ms = self._frames[0]
+                    if audio_ms > 0 and self.lead_ms is not None:
+                        now = time.monotonic()
+                        wait = self._playout_end - self.lead_ms / 1000 - now
+                        if wait > 0:
+                            # The frame may be dropped while waiting for its turn, check again then
+                            self._changed.clear()
+                            try:
+                                await asyncio.wait_for(self._changed.wait(), wait)
+                            except asyncio.TimeoutError:
+                                pass
+                            continue
+                        self._playout_end = max(self._playout_end, now) + audio_ms / 1000
+                    self._frames.popleft()
+                    self._queued_frames.dec()
+                    if audio_ms > 0:
+                        self.audio_ms -= audio_ms
+                        self._queued_audio.dec(audio_ms / 1000)
+                    await self._send(data)
+                if self._closed:
+                    return
+                self._ready.clear()
+                await self._ready.wait()
+        except (ConnectionError, RuntimeError) as e:
+            # The read loops notice the closed socket and end the session
+            logger.debug("Stopped sending %s: %s", self.direction, e)
+        finally:
+            self.close()
+            self.clear()
+            self._done.set()
+
+    async def drain(self, timeout: float):
+        """
+        Closes the queue and waits up to timeout seconds for the writer to send what is queued.
+        """
+        self.close()
+        try:
+            await asyncio.wait_for(self._done.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Gave up sending %d queued frames %s", len(self._frames), self.direction)
+
+    def close(self):
+        """
+        Stops accepting frames, frames queued so far are still written if the writer is running.
+        """
+        self._closed = True
+        self._ready.set()
+        self._changed.set()
+
+    def clear(self):
+        self._queued_frames.dec(len(self._frames))
+        self._queued_audio.dec(self.audio_ms / 1000)
+        self._frames.clear()
+        self.audio_ms = 0
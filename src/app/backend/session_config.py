@@ -0,0 +1,56 @@
+import json
+from typing import Any, Optional
+from backend.tools.tools import Tool
+
+class SessionConfig:
+    """
+    Immutable snapshot of the server-enforced session settings (instructions, tools, ...) that are merged into every
+    session.update. They are serialized once per snapshot, a session.update only serializes the settings of the client
+    and splices them together. Clients of the same kind send identical session.update events, so the result is cached
+    per event and voice. To change a setting, build a new snapshot and replace the old one.
+    """
+    version: int
+
+    # Distinct client session.update events and voices whose merged event is kept
+    MAX_CACHED_UPDATES = 64
+
+    def __init__(self, version: int, tools: dict[str, Tool], system_message: Optional[str] = None, temperature: Optional[float] = None, max_tokens: Optional[int] = None, disable_audio: Optional[bool] = None):
+        self.version = version
+        enforced: dict[str, Any] = {}
+        if system_message is not None:
+            enforced["instructions"] = system_message
+        if temperature is not None:
+            enforced["temperature"] = temperature
+        if max_tokens is not None:
+            enforced["max_response_output_tokens"] = max_tokens
+        if disable_audio is not None:
+            enforced["disable_audio"] = disable_audio
+        enforced["tool_choice"] = "auto" if len(tools) > 0 else "none"
+        enforced["tools"] = [tool.schema for tool in tools.values()]
+        self._enforced_keys = frozenset(enforced) | {"voice"}
+        # The members of the session object without the braces, never empty because of the tool choice
+        self._enforced_members = json.dumps(enforced)[1:-1]
+        self._cache: dict[tuple[str, str], str] = {}
+
+    def session_update(self, voice: str, message: Optional[dict[str, Any]] = None) -> str:
+        """
+        Serializes a session.update event with the session settings of message, if any, overridden by the server-enforced ones.
+        """
+        message = message if message is not None else { "type": "session.update" }
+        client_session = { key: value for key, value in message.get("session", {}).items() if key not in self._enforced_keys }
+        client_session["voice"] = voice
+        head = json.dumps({ key: value for key, value in message.items() if key != "session" })
+        return head[:-1] + ', "session": ' + json.dumps(client_session)[:-1] + ", " + self._enforced_members + "}}"
+
+    def session_update_from_raw(self, voice: str, raw: str) -> str:
+        """
+        Same as session_update() for a raw client event, identical events are only merged once.
+        """
+        key = (raw, voice)
+        update = self._cache.get(key)
+        if update is None:
+            update = self.session_update(voice, json.loads(raw))
+            if len(self._cache) >= self.MAX_CACHED_UPDATES:
+                self._cache.pop(next(iter(self._cache)))
+            self._cache[key] = update
+        return update
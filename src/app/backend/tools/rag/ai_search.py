@@ -1,11 +1,22 @@
+import asyncio
+import logging
 import re
-from typing import Any
+from typing import Any, Optional
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.models import VectorizableTextQuery
-from backend.tools.tools import Tool, ToolResult, ToolResultDirection
+from backend.tools.tools import Tool, ToolContext, ToolResult, ToolResultDirection
+from backend.tools.rag.search_cache import SearchResultCache
+from backend.tools.rag.context_packing import ContextPacker
+from backend.tools.rag.search_resilience import SearchResilience
+
+logger = logging.getLogger("voicerag")
 
 KEY_PATTERN = re.compile(r'^[a-zA-Z0-9_=\-]+$')
 
+# Returned to the model instead of search results when Azure AI Search fails, phrased so it can be passed on to a caller
+SEARCH_UNAVAILABLE_MESSAGE = "The knowledge base is not available right now. Briefly tell the user that you can't look this up " + \
+                             "at the moment and offer to help with something else or to try again in a little while."
+
 _search_tool_schema = {
     "type": "function",
     "name": "search",
@@ -47,65 +58,143 @@ _grounding_tool_schema = {
     }
 }
 
-async def _search_tool(
-    search_client: SearchClient, 
+async def _query_knowledge_base(
+    search_client: SearchClient,
     semantic_configuration: str,
     identifier_field: str,
+    title_field: str,
     content_field: str,
     embedding_field: str,
     use_vector_query: bool,
-    args: Any) -> ToolResult:
+    query: str) -> list[dict[str, str]]:
 
-    print(f"Searching for '{args['query']}' in the knowledge base.")
-    
     # Hybrid + Reranking query using Azure AI Search
     vector_queries = []
     if use_vector_query:
-        vector_queries.append(VectorizableTextQuery(text=args['query'], k_nearest_neighbors=50, fields=embedding_field))
+        vector_queries.append(VectorizableTextQuery(text=query, k_nearest_neighbors=50, fields=embedding_field))
     
     search_results = await search_client.search(
-        search_text=args['query'], 
+        search_text=query, 
         query_type="semantic",
         semantic_configuration_name=semantic_configuration,
         top=5,
         vector_queries=vector_queries,
-        select=", ".join([identifier_field, content_field])
+        select=", ".join([identifier_field, title_field, content_field])
 
     )
-    result = ""
+    docs = []
     async for r in search_results:
-        result += f"[{r[identifier_field]}]: {r[content_field]}\n-----\n"
+        docs.append({"chunk_id": r[identifier_field], "title": r[title_field], "chunk": r[content_field]})
+    return docs
+
+async def _search_tool(
+    search_client: SearchClient, 
+    semantic_configuration: str,
+    identifier_field: str,
+    title_field: str,
+    content_field: str,
+    embedding_field: str,
+    use_vector_query: bool,
+    cache: Optional[SearchResultCache],
+    packer: Optional[ContextPacker],
+    resilience: Optional[SearchResilience],
+    context: ToolContext,
+    args: Any) -> ToolResult:
+
+    logger.info("Searching for '%s' in the knowledge base", args['query'])
+
+    query = lambda: _query_knowledge_base(search_client, semantic_configuration, identifier_field, title_field, content_field, embedding_field, use_vector_query, args['query'])
+    if resilience is not None:
+        fetch = lambda: resilience.call("search", query)
+    else:
+        fetch = query
+    try:
+        docs = await (cache.get_or_fetch(args['query'], fetch) if cache is not None else fetch())
+    except Exception as e:
+        if resilience is None:
+            raise
+        # An expired result is still better than leaving the caller without an answer
+        docs = cache.peek(args['query'], allow_expired=True) if cache is not None else None
+        logger.warning("Search failed, %s: %s", "using an expired cached result" if docs is not None else "no cached result", e)
+        if docs is None:
+            return ToolResult(SEARCH_UNAVAILABLE_MESSAGE, ToolResultDirection.TO_SERVER)
+
+    # Remember the chunks, so report_grounding can resolve them without another query
+    for doc in docs:
+        context.chunks[doc["chunk_id"]] = doc
+
+    if packer is not None:
+        result, chunk_ids = packer.pack(args['query'], docs, context)
+        return ToolResult(result, ToolResultDirection.TO_SERVER, chunk_ids)
+
+    result = ""
+    for doc in docs:
+        result += f"[{doc['chunk_id']}]: {doc['chunk']}\n-----\n"
     
     return ToolResult(result, ToolResultDirection.TO_SERVER)
 
 
-# TODO: move from sending all chunks used for grounding eagerly to only sending links to 
-# the original content in storage, it'll be more efficient overall
-async def _report_grounding_tool(search_client: SearchClient, identifier_field: str, title_field: str, content_field: str, args: Any) -> None:
-    sources = [s for s in args["sources"] if KEY_PATTERN.match(s)]
-    list = " OR ".join(sources)
-    print(f"Grounding source: {list}")
+async def refresh_index_version(search_client: SearchClient, cache: SearchResultCache, base_version: str, interval_seconds: float):
+    """
+    Keeps the index version of the search cache up to date. The version combines a configured base version with the
+    document count of the index, so cached results are dropped when the indexer adds or removes chunks.
+    """
+    while True:
+        try:
+            document_count = await search_client.get_document_count()
+            cache.set_index_version(f"{base_version}:{document_count}")
+        except Exception as e:
+            logger.warning("Could not refresh the search index version: %s", e)
+        await asyncio.sleep(interval_seconds)
+
+
+async def _query_sources(search_client: SearchClient, identifier_field: str, title_field: str, content_field: str, missing: list[str]) -> list[dict[str, str]]:
     # Use search instead of filter to align with how detailt integrated vectorization indexes
     # are generated, where chunk_id is searchable with a keyword tokenizer, not filterable 
-    search_results = await search_client.search(search_text=list, 
+    search_results = await search_client.search(search_text=" OR ".join(missing), 
                                                 search_fields=[identifier_field], 
                                                 select=[identifier_field, title_field, content_field], 
-                                                top=len(sources), 
+                                                top=len(missing), 
                                                 query_type="full")
     
     # If your index has a key field that's filterable but not searchable and with the keyword analyzer, you can 
     # use a filter instead (and you can remove the regex check above, just ensure you escape single quotes)
-    # search_results = await search_client.search(filter=f"search.in(chunk_id, '{list}')", select=["chunk_id", "title", "chunk"])
+    # search_results = await search_client.search(filter=f"search.in(chunk_id, '{",".join(missing)}')", select=["chunk_id", "title", "chunk"])
 
     docs = []
     async for r in search_results:
         docs.append({"chunk_id": r[identifier_field], "title": r[title_field], "chunk": r[content_field]})
+    return docs
+
+# TODO: move from sending all chunks used for grounding eagerly to only sending links to 
+# the original content in storage, it'll be more efficient overall
+async def _report_grounding_tool(search_client: SearchClient, identifier_field: str, title_field: str, content_field: str, resilience: Optional[SearchResilience], context: ToolContext, args: Any) -> None:
+    sources = [s for s in args["sources"] if KEY_PATTERN.match(s)]
+
+    # Sources usually come from a search earlier in this session, only fetch the ones we haven't seen
+    found = {s: context.chunks[s] for s in sources if s in context.chunks}
+    missing = [s for s in sources if s not in found]
+    if len(missing) > 0:
+        logger.info("Grounding source: %s", ' OR '.join(missing))
+        query = lambda: _query_sources(search_client, identifier_field, title_field, content_field, missing)
+        try:
+            docs = await (resilience.call("report_grounding", query) if resilience is not None else query())
+        except Exception as e:
+            if resilience is None:
+                raise
+            # Citations are a nice to have, report the sources that are known already
+            logger.warning("Could not look up grounding sources: %s", e)
+            docs = []
+        for doc in docs:
+            context.chunks[doc["chunk_id"]] = doc
+            found[doc["chunk_id"]] = doc
 
+    docs = [found[s] for s in dict.fromkeys(sources) if s in found]
     return ToolResult({"sources": docs}, ToolResultDirection.TO_CLIENT)
 
 
-def search_tool(search_client: SearchClient, semantic_configuration: str) -> Tool:
-    return Tool(schema=_search_tool_schema, target=lambda args: _search_tool(search_client, semantic_configuration, "chunk_id", "chunk", "text_vector", True, args))
+def search_tool(search_client: SearchClient, semantic_configuration: str, cache: Optional[SearchResultCache] = None, packer: Optional[ContextPacker] = None, resilience: Optional[SearchResilience] = None) -> Tool:
+    return Tool(schema=_search_tool_schema, target=lambda args, context: _search_tool(search_client, semantic_configuration, "chunk_id", "title", "chunk", "text_vector", True, cache, packer, resilience, context, args), speculative=True)
 
-def report_grounding_tool(search_client: SearchClient) -> Tool:
-    return Tool(schema=_grounding_tool_schema, target=lambda args: _report_grounding_tool(search_client, "chunk_id", "title", "chunk", args))
+def report_grounding_tool(search_client: SearchClient, resilience: Optional[SearchResilience] = None) -> Tool:
+    return Tool(schema=_grounding_tool_schema, target=lambda args, context: _report_grounding_tool(search_client, "chunk_id", "title", "chunk", resilience, context, args))
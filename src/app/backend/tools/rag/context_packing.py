@@ -0,0 +1,116 @@
+import re
+from typing import Optional
+from backend.tools.tools import ToolContext
+
+_WORD_PATTERN = re.compile(r"\w+", re.UNICODE)
+_SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+|\s*\n\s*")
+
+def _words(text: str) -> list[str]:
+    return _WORD_PATTERN.findall(text.lower())
+
+def _shingles(words: list[str], size: int = 3) -> set[tuple[str, ...]]:
+    if len(words) < size:
+        return { tuple(words) }
+    return { tuple(words[i:i + size]) for i in range(len(words) - size + 1) }
+
+def _allocate(lengths: list[int], budget: int) -> list[int]:
+    # Max-min fair split of the budget: short chunks keep their full length, the rest is shared evenly by the long ones
+    allocation = [0] * len(lengths)
+    remaining = budget
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    for position, i in enumerate(order):
+        allocation[i] = min(lengths[i], remaining // (len(order) - position))
+        remaining -= allocation[i]
+    return allocation
+
+class ContextPacker:
+    """
+    Packs search results into the text returned to the model, within a budget of max_tokens (estimated from characters).
+    Chunks that are near-duplicates of a higher ranked chunk are left out, chunks the model already received in full
+    earlier in the session are only referenced by their source name, and chunks that don't fit their share of the
+    budget are trimmed to the sentences that share the most words with the query. A trimmed chunk is sent again by a
+    later search, which may need the sentences that were left out. Results keep the format of the search tool,
+    a source name in square brackets followed by the content and a line with '-----'.
+    """
+    max_tokens: int
+    duplicate_threshold: float
+
+    # Rough average for English text with the tokenizers of the GPT-4o family
+    CHARS_PER_TOKEN = 4
+
+    ALREADY_SENT = "(already provided earlier in this conversation)"
+    GAP = " ... "
+
+    def __init__(self, max_tokens: int, duplicate_threshold: float = 0.8):
+        self.max_tokens = max_tokens
+        self.duplicate_threshold = duplicate_threshold
+
+    def pack(self, query: str, docs: list[dict[str, str]], context: ToolContext) -> tuple[str, list[str]]:
+        """
+        Returns the text for the model and the ids of the chunks whose full content it contains.
+        """
+        entries: list[tuple[str, Optional[str]]] = []
+        kept_shingles: list[set[tuple[str, ...]]] = []
+        for doc in docs:
+            if doc["chunk_id"] in context.sent_chunks:
+                entries.append((doc["chunk_id"], None))
+                continue
+            shingles = _shingles(_words(doc["chunk"]))
+            if any(self._similarity(shingles, kept) >= self.duplicate_threshold for kept in kept_shingles):
+                continue
+            kept_shingles.append(shingles)
+            entries.append((doc["chunk_id"], doc["chunk"]))
+
+        # Everything but the chunk contents counts against the budget up front
+        budget = self.max_tokens * self.CHARS_PER_TOKEN
+        budget -= sum(len(self._format(chunk_id, None if content is None else "")) for chunk_id, content in entries)
+        contents = [content for _, content in entries if content is not None]
+        allocation = iter(_allocate([len(content) for content in contents], max(0, budget)))
+        query_words = set(_words(query))
+
+        result = ""
+        chunk_ids = []
+        for chunk_id, content in entries:
+            if content is not None:
+                trimmed = self._trim(content, next(allocation), query_words)
+                if not trimmed:
+                    continue
+                if trimmed == content:
+                    chunk_ids.append(chunk_id)
+                content = trimmed
+            result += self._format(chunk_id, content)
+        return result, chunk_ids
+
+    def _format(self, chunk_id: str, content: Optional[str]) -> str:
+        return f"[{chunk_id}]: {content if content is not None else self.ALREADY_SENT}\n-----\n"
+
+    @staticmethod
+    def _similarity(a: set[tuple[str, ...]], b: set[tuple[str, ...]]) -> float:
+        if not a or not b:
+            return 0.0
+        return len(a & b) / len(a | b)
+
+    def _trim(self, content: str, limit: int, query_words: set[str]) -> str:
+        if len(content) <= limit:
+            return content
+        sentences = [s for s in _SENTENCE_BOUNDARY.split(content) if s]
+        # Most query words first, earlier sentences break ties
+        ranked = sorted(range(len(sentences)), key=lambda i: (-len(query_words.intersection(_words(sentences[i]))), i))
+        selected = []
+        used = 0
+        for i in ranked:
+            cost = len(sentences[i]) + len(self.GAP)
+            if used + cost <= limit:
+                selected.append(i)
+                used += cost
+        if not selected:
+            # Not even one sentence fits, cut the best one at a word boundary
+            best = sentences[ranked[0]] if ranked else content
+            return best[:limit].rsplit(" ", 1)[0] if limit > 0 else ""
+        selected.sort()
+        text = ""
+        for position, i in enumerate(selected):
+            if position > 0:
+                text += self.GAP if selected[position - 1] != i - 1 else " "
+            text += sentences[i]
+        return text
@@ -0,0 +1,350 @@
+"""
+In-process retrieval engine, a drop-in alternative to Azure AI Search for small knowledge bases.
+
+The index is built offline from the same data folder that scripts/upload_data.sh uploads and is stored as a folder
+of flat arrays that are memory-mapped at runtime:
+
+- chunks.jsonl: chunk id, title and content of every chunk, in row order
+- embeddings.npy: one L2-normalized embedding per chunk (float32, rows x dimensions)
+- postings_*.npy, terms.json: a compact BM25 inverted index (CSR layout, one row of postings per term)
+- meta.json: parameters the index was built with
+
+A query runs a vectorized cosine top-k over the embeddings and a BM25 top-k over the inverted index and combines
+both rankings with reciprocal rank fusion, like the hybrid queries the Azure AI Search tool runs.
+
+Build an index from the src/app folder:
+
+    python -m backend.tools.rag.local_search ../../data ../../local_index
+
+Pass --embedding-deployment to embed the chunks with an Azure OpenAI embedding deployment instead of the built-in
+hashing embedder. The application must then query the index with the same deployment.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import re
+import zlib
+from pathlib import Path
+from typing import Any, Callable, Optional
+import numpy as np
+from azure.core.credentials import TokenCredential
+from azure.identity import get_bearer_token_provider
+from dotenv import load_dotenv
+from openai import AzureOpenAI
+from backend.azure import OPENAI_SCOPE, get_azure_credentials
+from backend.tools.tools import Tool, ToolContext, ToolResult, ToolResultDirection
+from backend.tools.rag.ai_search import KEY_PATTERN, _grounding_tool_schema, _search_tool_schema
+from backend.tools.rag.context_packing import ContextPacker
+
+logger = logging.getLogger("voicerag")
+
+_TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+_UNSAFE_KEY_CHARACTERS = re.compile(r"[^a-zA-Z0-9_\-]")
+
+def tokenize(text: str) -> list[str]:
+    return _TOKEN_PATTERN.findall(text.lower())
+
+class HashingEmbedder:
+    """
+    Dependency-free text embedding based on feature hashing of word unigrams and bigrams.
+    It runs offline and needs no model, which makes it a reasonable default for small knowledge bases
+    and for benchmarks. Any callable mapping a list of texts to a (texts x dimensions) array can be used instead,
+    e.g. one calling the embedding deployment that the Azure AI Search skillset uses.
+    """
+    dimensions: int
+
+    def __init__(self, dimensions: int = 512):
+        self.dimensions = dimensions
+
+    @property
+    def name(self) -> str:
+        return f"hashing-{self.dimensions}"
+
+    def __call__(self, texts: list[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            tokens = tokenize(text)
+            features = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+            if not features:
+                continue
+            hashes = np.fromiter((zlib.crc32(f.encode("utf-8")) for f in features), dtype=np.uint32, count=len(features))
+            signs = np.where(hashes & 0x80000000, -1.0, 1.0).astype(np.float32)
+            np.add.at(vectors[row], hashes % self.dimensions, signs)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+class AzureOpenAIEmbedder:
+    """
+    Embeds texts with an Azure OpenAI embedding deployment, e.g. the one the Azure AI Search skillset uses.
+    Calls block on the network, the search tool runs queries in a worker thread.
+    """
+    deployment: str
+
+    # Texts per embeddings request when building an index
+    BATCH_SIZE = 64
+
+    def __init__(self, endpoint: str, deployment: str, key: Optional[str] = None, credential: Optional[TokenCredential] = None):
+        self.deployment = deployment
+        if key:
+            self._client = AzureOpenAI(azure_endpoint=endpoint, api_key=key, api_version="2024-10-21")
+        elif credential is not None:
+            self._client = AzureOpenAI(azure_endpoint=endpoint, azure_ad_token_provider=get_bearer_token_provider(credential, OPENAI_SCOPE), api_version="2024-10-21")
+        else:
+            raise ValueError("AzureOpenAIEmbedder needs an API key or a credential")
+
+    @classmethod
+    def from_environment(cls, credential: Optional[TokenCredential] = None) -> Optional["AzureOpenAIEmbedder"]:
+        """
+        Returns an embedder for the deployment in LOCAL_SEARCH_EMBEDDING_DEPLOYMENT, or None if it isn't set.
+        """
+        deployment = os.environ.get("LOCAL_SEARCH_EMBEDDING_DEPLOYMENT")
+        if not deployment:
+            return None
+        endpoint = os.environ.get("AZURE_OPENAI_ENDPOINT")
+        if not endpoint:
+            raise ValueError("Missing 'AZURE_OPENAI_ENDPOINT' environment variable.")
+        key = os.environ.get("AZURE_OPENAI_API_KEY")
+        if not key and credential is None:
+            credential = get_azure_credentials(os.environ.get("AZURE_TENANT_ID"))
+        return cls(endpoint, deployment, key, credential)
+
+    @property
+    def name(self) -> str:
+        return f"azure-openai-{self.deployment}"
+
+    def __call__(self, texts: list[str]) -> np.ndarray:
+        vectors = []
+        for start in range(0, len(texts), self.BATCH_SIZE):
+            response = self._client.embeddings.create(model=self.deployment, input=texts[start:start + self.BATCH_SIZE])
+            vectors.extend(item.embedding for item in sorted(response.data, key=lambda item: item.index))
+        vectors = np.array(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+def _embedder_name(embedder: Callable[[list[str]], np.ndarray]) -> Optional[str]:
+    # Plain functions are identified by their name, lambdas and other callables may not be identifiable at all
+    name = getattr(embedder, "name", None) or getattr(embedder, "__name__", None)
+    return name if name != "<lambda>" else None
+
+class LocalSearchIndex:
+    """
+    Memory-mapped hybrid (vector + BM25) index over knowledge base chunks.
+    """
+    chunks: list[dict[str, str]]
+
+    # Ranking constants, matching common BM25 and reciprocal rank fusion defaults
+    BM25_K1 = 1.2
+    BM25_B = 0.75
+    RRF_K = 60
+
+    def __init__(self, path: str | Path, embedder: Optional[Callable[[list[str]], np.ndarray]] = None):
+        path = Path(path)
+        meta = json.loads((path / "meta.json").read_text(encoding="utf-8"))
+        if embedder is None:
+            embedder = HashingEmbedder(meta["dimensions"])
+            if embedder.name != meta["embedder"]:
+                raise ValueError(f"Index at {path} was built with embedder {meta['embedder']}, pass the same embedder to query it")
+        self._embedder = embedder
+        embedder_name = _embedder_name(embedder)
+        if embedder_name is not None and meta["embedder"] is not None and embedder_name != meta["embedder"]:
+            raise ValueError(f"Index at {path} was built with embedder {meta['embedder']}, not {embedder_name}")
+
+        with open(path / "chunks.jsonl", encoding="utf-8") as file:
+            self.chunks = [json.loads(line) for line in file]
+        self._rows = {chunk["chunk_id"]: row for row, chunk in enumerate(self.chunks)}
+        self._terms: dict[str, int] = json.loads((path / "terms.json").read_text(encoding="utf-8"))
+
+        self._embeddings = np.load(path / "embeddings.npy", mmap_mode="r")
+        self._postings_offsets = np.load(path / "postings_offsets.npy", mmap_mode="r")
+        self._postings_docs = np.load(path / "postings_docs.npy", mmap_mode="r")
+        self._postings_tfs = np.load(path / "postings_tfs.npy", mmap_mode="r")
+        self._doc_lengths = np.load(path / "doc_lengths.npy", mmap_mode="r")
+        self._average_doc_length = float(meta["average_doc_length"])
+
+    def __len__(self) -> int:
+        return len(self.chunks)
+
+    def get(self, chunk_id: str) -> Optional[dict[str, str]]:
+        row = self._rows.get(chunk_id)
+        return self.chunks[row] if row is not None else None
+
+    def search(self, query: str, top: int = 5, k_nearest_neighbors: int = 50) -> list[dict[str, str]]:
+        if len(self.chunks) == 0:
+            return []
+        rankings = [self._vector_ranking(query, k_nearest_neighbors), self._bm25_ranking(query, k_nearest_neighbors)]
+
+        fused = np.zeros(len(self.chunks), dtype=np.float64)
+        for ranking in rankings:
+            fused[ranking] += 1.0 / (self.RRF_K + np.arange(1, len(ranking) + 1))
+        return [self.chunks[row] for row in self._top(fused, top) if fused[row] > 0]
+
+    def _top(self, scores: np.ndarray, k: int) -> np.ndarray:
+        k = min(k, len(scores))
+        candidates = np.argpartition(-scores, k - 1)[:k]
+        return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+    def _vector_ranking(self, query: str, k: int) -> np.ndarray:
+        query_vector = self._embedder([query])[0].astype(np.float32)
+        if query_vector.shape[0] != self._embeddings.shape[1]:
+            raise ValueError(f"Query embedding has {query_vector.shape[0]} dimensions, the index {self._embeddings.shape[1]}")
+        return self._top(self._embeddings @ query_vector, k)
+
+    def _bm25_ranking(self, query: str, k: int) -> np.ndarray:
+        scores = np.zeros(len(self.chunks), dtype=np.float32)
+        for term in set(tokenize(query)):
+            term_id = self._terms.get(term)
+            if term_id is None:
+                continue
+            start, end = self._postings_offsets[term_id], self._postings_offsets[term_id + 1]
+            docs = self._postings_docs[start:end]
+            tfs = self._postings_tfs[start:end].astype(np.float32)
+            idf = math.log(1 + (len(self.chunks) - len(docs) + 0.5) / (len(docs) + 0.5))
+            norm = self.BM25_K1 * (1 - self.BM25_B + self.BM25_B * self._doc_lengths[docs] / self._average_doc_length)
+            scores[docs] += idf * tfs * (self.BM25_K1 + 1) / (tfs + norm)
+        ranking = self._top(scores, k)
+        return ranking[scores[ranking] > 0]
+
+def _read_document(file: Path) -> Optional[str]:
+    if file.suffix.lower() in (".txt", ".md"):
+        return file.read_text(encoding="utf-8", errors="replace")
+    if file.suffix.lower() == ".pdf":
+        try:
+            from pypdf import PdfReader
+        except ImportError:
+            logger.warning("Skipping %s, install pypdf to index PDF files", file.name)
+            return None
+        return "\n".join(page.extract_text() or "" for page in PdfReader(file).pages)
+    logger.warning("Skipping %s, unsupported file type", file.name)
+    return None
+
+def _split_chunks(text: str, chunk_size: int, overlap: int) -> list[str]:
+    words = text.split()
+    chunks = []
+    start = 0
+    while start < len(words):
+        length = 0
+        end = start
+        while end < len(words) and length + len(words[end]) + 1 <= chunk_size:
+            length += len(words[end]) + 1
+            end += 1
+        end = max(end, start + 1)
+        chunks.append(" ".join(words[start:end]))
+        if end >= len(words):
+            break
+        # Step back so consecutive chunks share roughly `overlap` characters
+        back = end
+        shared = 0
+        while back > start + 1 and shared < overlap:
+            back -= 1
+            shared += len(words[back]) + 1
+        start = back if back > start else end
+    return chunks
+
+def build_index(data_folder: str | Path, index_folder: str | Path, chunk_size: int = 2000, overlap: int = 500, embedder: Optional[Callable[[list[str]], np.ndarray]] = None) -> int:
+    """
+    Builds a local search index from all supported files in a folder and returns the number of chunks.
+    Chunk sizes follow the split skill of the Azure AI Search skillset (2000 characters, 500 overlap).
+    The embedder maps a list of texts to a (texts x dimensions) array, the hashing embedder by default.
+    """
+    embedder = embedder if embedder is not None else HashingEmbedder()
+    data_folder, index_folder = Path(data_folder), Path(index_folder)
+    index_folder.mkdir(parents=True, exist_ok=True)
+
+    chunks = []
+    for file in sorted(p for p in data_folder.iterdir() if p.is_file()):
+        text = _read_document(file)
+        if not text:
+            continue
+        key = _UNSAFE_KEY_CHARACTERS.sub("_", file.stem)
+        for i, content in enumerate(_split_chunks(text, chunk_size, overlap)):
+            chunks.append({"chunk_id": f"{key}_{i}", "title": file.name, "chunk": content})
+
+    # Inverted index in CSR layout: postings of term t are docs[offsets[t]:offsets[t + 1]]
+    terms: dict[str, int] = {}
+    postings: list[list[tuple[int, int]]] = []
+    doc_lengths = np.zeros(len(chunks), dtype=np.int32)
+    for row, chunk in enumerate(chunks):
+        tokens = tokenize(chunk["chunk"])
+        doc_lengths[row] = len(tokens)
+        counts: dict[str, int] = {}
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        for token, count in counts.items():
+            term_id = terms.setdefault(token, len(terms))
+            if term_id == len(postings):
+                postings.append([])
+            postings[term_id].append((row, count))
+
+    offsets = np.zeros(len(postings) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(p) for p in postings])
+    docs = np.fromiter((row for p in postings for row, _ in p), dtype=np.int32, count=int(offsets[-1]))
+    tfs = np.fromiter((min(count, 65535) for p in postings for _, count in p), dtype=np.uint16, count=int(offsets[-1]))
+
+    if chunks:
+        embeddings = np.asarray(embedder([chunk["chunk"] for chunk in chunks]), dtype=np.float32)
+    else:
+        embeddings = np.zeros((0, getattr(embedder, "dimensions", 0)), dtype=np.float32)
+
+    with open(index_folder / "chunks.jsonl", "w", encoding="utf-8") as file:
+        for chunk in chunks:
+            file.write(json.dumps(chunk) + "\n")
+    (index_folder / "terms.json").write_text(json.dumps(terms), encoding="utf-8")
+    np.save(index_folder / "embeddings.npy", embeddings.astype(np.float32))
+    np.save(index_folder / "postings_offsets.npy", offsets)
+    np.save(index_folder / "postings_docs.npy", docs)
+    np.save(index_folder / "postings_tfs.npy", tfs)
+    np.save(index_folder / "doc_lengths.npy", doc_lengths)
+    (index_folder / "meta.json").write_text(json.dumps({
+        "embedder": _embedder_name(embedder),
+        "dimensions": int(embeddings.shape[1]),
+        "chunks": len(chunks),
+        "average_doc_length": float(doc_lengths.mean()) if len(chunks) > 0 else 1.0,
+    }), encoding="utf-8")
+    return len(chunks)
+
+async def _local_search_tool(index: LocalSearchIndex, packer: Optional[ContextPacker], context: ToolContext, args: Any) -> ToolResult:
+    logger.info("Searching for '%s' in the local knowledge base", args['query'])
+    # Ranking is CPU-bound and the embedder may call a remote deployment, neither may block the event loop
+    docs = await asyncio.to_thread(index.search, args['query'])
+    for doc in docs:
+        context.chunks[doc["chunk_id"]] = doc
+    if packer is not None:
+        result, chunk_ids = packer.pack(args['query'], docs, context)
+        return ToolResult(result, ToolResultDirection.TO_SERVER, chunk_ids)
+    result = ""
+    for doc in docs:
+        result += f"[{doc['chunk_id']}]: {doc['chunk']}\n-----\n"
+    return ToolResult(result, ToolResultDirection.TO_SERVER)
+
+async def _local_report_grounding_tool(index: LocalSearchIndex, context: ToolContext, args: Any) -> ToolResult:
+    docs = []
+    for source in dict.fromkeys(s for s in args["sources"] if KEY_PATTERN.match(s)):
+        doc = context.chunks.get(source) or index.get(source)
+        if doc is not None:
+            docs.append(doc)
+    logger.info("Grounding source: %s", ' OR '.join(doc['chunk_id'] for doc in docs))
+    return ToolResult({"sources": docs}, ToolResultDirection.TO_CLIENT)
+
+def local_search_tool(index: LocalSearchIndex, packer: Optional[ContextPacker] = None) -> Tool:
+    return Tool(schema=_search_tool_schema, target=lambda args, context: _local_search_tool(index, packer, context, args), speculative=True)
+
+def local_report_grounding_tool(index: LocalSearchIndex) -> Tool:
+    return Tool(schema=_grounding_tool_schema, target=lambda args, context: _local_report_grounding_tool(index, context, args))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a local search index from a folder of documents.")
+    parser.add_argument("data_folder", help="Folder with the knowledge base documents (.pdf, .txt, .md)")
+    parser.add_argument("index_folder", help="Folder to write the index to")
+    parser.add_argument("--chunk-size", type=int, default=2000, help="Maximum characters per chunk")
+    parser.add_argument("--overlap", type=int, default=500, help="Characters shared by consecutive chunks")
+    parser.add_argument("--embedding-deployment", help="Azure OpenAI embedding deployment to embed the chunks with, LOCAL_SEARCH_EMBEDDING_DEPLOYMENT by default. Without one, the built-in hashing embedder is used.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    load_dotenv()
+    if args.embedding_deployment:
+        os.environ["LOCAL_SEARCH_EMBEDDING_DEPLOYMENT"] = args.embedding_deployment
+    count = build_index(args.data_folder, args.index_folder, args.chunk_size, args.overlap, AzureOpenAIEmbedder.from_environment())
+    print(f"Indexed {count} chunks into {args.index_folder}")
@@ -0,0 +1,93 @@
+import asyncio
+import re
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable
+
+_WHITESPACE_PATTERN = re.compile(r"\s+")
+
+class SearchResultCache:
+    """
+    Process-local cache for knowledge base search results with LRU and TTL eviction.
+    Queries are keyed by their normalized text and the current index version, so changing the version
+    (e.g. after the index was refreshed) invalidates all cached results at once.
+    Concurrent lookups for the same query share a single request to the search service.
+    Expired results are kept until a new result replaces them, so peek() can still return them when the search service fails.
+    """
+    max_entries: int
+    ttl_seconds: float
+    index_version: str
+    hits: int
+    misses: int
+    coalesced: int
+
+    def __init__(self, max_entries: int = 256, ttl_seconds: float = 600, index_version: str = ""):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.index_version = index_version
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._entries: OrderedDict[tuple[str, str], tuple[float, Any]] = OrderedDict()
+        self._inflight: dict[tuple[str, str], asyncio.Future] = {}
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        return _WHITESPACE_PATTERN.sub(" ", query).strip().rstrip("?!.").strip().lower()
+
+    def set_index_version(self, index_version: str):
+        if index_version != self.index_version:
+            self.index_version = index_version
+            self._entries.clear()
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "index_version": self.index_version,
+        }
+
+    def peek(self, query: str, allow_expired: bool = False) -> Any:
+        """
+        Returns the cached result for a query without fetching it, or None.
+        """
+        entry = self._entries.get((self.index_version, self.normalize(query)))
+        if entry is None or (not allow_expired and entry[0] < time.monotonic()):
+            return None
+        return entry[1]
+
+    async def get_or_fetch(self, query: str, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        key = (self.index_version, self.normalize(query))
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] >= time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            # Expired entries stay until a new result replaces them, peek() falls back to them if the fetch fails
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.coalesced += 1
+            return await asyncio.shield(inflight)
+
+        self.misses += 1
+        inflight = asyncio.ensure_future(fetch())
+        self._inflight[key] = inflight
+        try:
+            # Shielded, so one caller giving up doesn't cancel the request for everyone waiting on it
+            value = await asyncio.shield(inflight)
+        finally:
+            if self._inflight.get(key) is inflight:
+                del self._inflight[key]
+
+        # Don't store results that were fetched for an index version that has been replaced meanwhile
+        if key[0] == self.index_version:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
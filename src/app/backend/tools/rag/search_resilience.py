@@ -0,0 +1,143 @@
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Optional
+from backend.metrics import REGISTRY
+
+logger = logging.getLogger("voicerag")
+
+_SEARCH_DURATION = REGISTRY.histogram("voicerag_search_duration_seconds", "Duration of Azure AI Search calls including hedged requests", ("operation", "outcome"))
+_SEARCH_HEDGES = REGISTRY.counter("voicerag_search_hedges_total", "Second requests sent because the first one was slower than usual", ("operation",))
+_SEARCH_CIRCUIT_OPEN = REGISTRY.gauge("voicerag_search_circuit_open", "1 while calls to Azure AI Search are suspended after repeated failures")
+
+class SearchUnavailableError(Exception):
+    """
+    Raised instead of calling Azure AI Search while the circuit breaker is open.
+    """
+
+class SearchResilience:
+    """
+    Guards the calls to Azure AI Search. A call that hasn't answered after the hedge_percentile of recent call durations
+    is sent a second time and the first answer wins, so one slow replica doesn't turn into seconds of silence on a call.
+    After failure_threshold failed calls in a row, the circuit opens: calls fail right away with SearchUnavailableError
+    for open_seconds, then a single trial call decides whether to close the circuit again. A call that takes longer
+    than timeout_seconds fails with TimeoutError and counts as a failure, keep it below the tool timeout so a hung
+    service opens the circuit instead of every call being cancelled from outside.
+    """
+    hedge_percentile: Optional[float]
+    failure_threshold: int
+    open_seconds: float
+    timeout_seconds: float
+    # Whether any call has succeeded yet, e.g. to report readiness
+    succeeded: bool
+
+    # Hedge delay until enough calls were measured, and the range the measured delay is kept in
+    DEFAULT_HEDGE_SECONDS = 1.0
+    MIN_HEDGE_SECONDS = 0.1
+    MAX_HEDGE_SECONDS = 2.0
+    MIN_SAMPLES = 20
+
+    def __init__(self, hedge_percentile: Optional[float] = 95, failure_threshold: int = 5, open_seconds: float = 30, timeout_seconds: float = 6, window: int = 200):
+        self.hedge_percentile = hedge_percentile
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.timeout_seconds = timeout_seconds
+        self._durations: deque[float] = deque(maxlen=window)
+        self.succeeded = False
+        self._failures = 0
+        self._open_until = 0.0
+        self._trial_running = False
+        _SEARCH_CIRCUIT_OPEN.set(0)
+
+    @property
+    def is_open(self) -> bool:
+        return self._open_until > 0
+
+    def hedge_delay(self) -> float:
+        if not self.hedge_percentile:
+            return math.inf
+        if len(self._durations) < self.MIN_SAMPLES:
+            return self.DEFAULT_HEDGE_SECONDS
+        durations = sorted(self._durations)
+        delay = durations[min(len(durations) - 1, int(len(durations) * self.hedge_percentile / 100))]
+        return min(self.MAX_HEDGE_SECONDS, max(self.MIN_HEDGE_SECONDS, delay))
+
+    async def call(self, operation: str, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Runs fetch, hedged and guarded by the circuit breaker. fetch must be safe to run twice at the same time.
+        """
+        trial = self._acquire()
+        if trial is None:
+            _SEARCH_DURATION.labels(operation, "rejected").observe(0)
+            raise SearchUnavailableError("Azure AI Search is unavailable after repeated failures")
+
+        start = time.monotonic()
+        outcome = "error"
+        try:
+            async with asyncio.timeout(self.timeout_seconds):
+                result = await self._hedged(operation, fetch)
+            outcome = "ok"
+            self._durations.append(time.monotonic() - start)
+            self._on_success()
+            return result
+        except asyncio.CancelledError:
+            outcome = "cancelled"
+            raise
+        except TimeoutError:
+            outcome = "timeout"
+            self._on_failure(trial)
+            raise
+        except Exception:
+            self._on_failure(trial)
+            raise
+        finally:
+            if trial:
+                self._trial_running = False
+            _SEARCH_DURATION.labels(operation, outcome).observe(time.monotonic() - start)
+
+    def _acquire(self) -> Optional[bool]:
+        # Returns None if the call is rejected, otherwise whether it is the trial call of a half-open circuit
+        if not self.is_open:
+            return False
+        if time.monotonic() < self._open_until or self._trial_running:
+            return None
+        self._trial_running = True
+        return True
+
+    def _on_success(self):
+        self.succeeded = True
+        self._failures = 0
+        if self.is_open:
+            logger.warning("Azure AI Search recovered, closing the circuit")
+            self._open_until = 0
+            _SEARCH_CIRCUIT_OPEN.set(0)
+
+    def _on_failure(self, trial: bool):
+        self._failures += 1
+        if self.failure_threshold > 0 and (trial or self._failures >= self.failure_threshold):
+            if not self.is_open:
+                logger.warning("Azure AI Search failed %d times in a row, suspending calls for %s seconds", self._failures, self.open_seconds)
+            self._open_until = time.monotonic() + self.open_seconds
+            _SEARCH_CIRCUIT_OPEN.set(1)
+
+    async def _hedged(self, operation: str, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        attempts = [asyncio.ensure_future(fetch())]
+        try:
+            done, _ = await asyncio.wait(attempts, timeout=self.hedge_delay())
+            if not done:
+                _SEARCH_HEDGES.labels(operation).inc()
+                attempts.append(asyncio.ensure_future(fetch()))
+            pending = set(attempts)
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for attempt in done:
+                    if attempt.exception() is None:
+                        return attempt.result()
+                    error = attempt.exception()
+            raise error
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
@@ -1,7 +1,8 @@
+import asyncio
 import json
 from typing import Any
 from enum import Enum
-from typing import Any, Callable
+from typing import Any, Callable, Optional
 
 class ToolResultDirection(Enum):
     TO_SERVER = 1
@@ -10,28 +11,62 @@ class ToolResultDirection(Enum):
 class ToolResult:
     text: str
     destination: ToolResultDirection
+    # Knowledge base chunks contained in full in the text, recorded in the ToolContext once the model received the result
+    chunk_ids: list[str]
 
-    def __init__(self, text: str, destination: ToolResultDirection):
+    def __init__(self, text: str, destination: ToolResultDirection, chunk_ids: Optional[list[str]] = None):
         self.text = text
         self.destination = destination
+        self.chunk_ids = chunk_ids if chunk_ids is not None else []
 
     def to_text(self) -> str:
         if self.text is None:
             return ""
         return self.text if type(self.text) == str else json.dumps(self.text)
 
+class ToolContext:
+    """
+    Per-session state that tools can share across the calls of one conversation.
+    """
+    # Knowledge base chunks returned to the model in this session, by chunk id
+    chunks: dict[str, dict[str, Any]]
+    # Ids of the chunks whose full content the model has received in this session
+    sent_chunks: set[str]
+
+    def __init__(self):
+        self.chunks = {}
+        self.sent_chunks = set()
+
 class Tool:
+    # Called with the parsed arguments and the ToolContext of the calling session
     target: Callable[..., ToolResult]
     schema: Any
+    timeout: Optional[float]
+    # Tools without side effects can be started from partially streamed arguments
+    speculative: bool
 
-    def __init__(self, target: Any, schema: Any):
+    def __init__(self, target: Any, schema: Any, timeout: Optional[float] = None, speculative: bool = False):
         self.target = target
         self.schema = schema
+        self.timeout = timeout
+        self.speculative = speculative
 
 class RTToolCall:
     tool_call_id: str
-    previous_id: str
+    previous_id: Optional[str]
+    name: Optional[str]
+    response_id: Optional[str]
+    task: Optional[asyncio.Task]
+    arguments: str
+    speculative_args: Optional[dict[str, Any]]
+    speculative_task: Optional[asyncio.Task]
 
-    def __init__(self, tool_call_id: str, previous_id: str):
+    def __init__(self, tool_call_id: str, previous_id: Optional[str], name: Optional[str] = None):
         self.tool_call_id = tool_call_id
         self.previous_id = previous_id
+        self.name = name
+        self.response_id = None
+        self.task = None
+        self.arguments = ""
+        self.speculative_args = None
+        self.speculative_task = None
@@ -0,0 +1,120 @@
+"""
+Micro-benchmark for the per-frame cost of the RTMiddleTier forwarding hot path.
+
+Measures the CPU time the middle tier spends per second of forwarded audio, for both directions
+and both client types, and compares it with the previous behavior of parsing and re-serializing
+every frame. No network is involved, sockets are replaced by no-op stand-ins.
+A second table shows the cost of transcoding phone audio to and from each supported telephony format.
+
+Run from the src/app folder:
+
+    python -m benchmarks.forwarding
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import time
+from azure.core.credentials import AzureKeyCredential
+from backend.helpers import transform_acs_to_openai_format, transform_openai_to_acs_format
+from backend.audio import AUDIO_FORMATS
+from backend.rtmt import RTMiddleTier, RTSession
+
+SAMPLE_RATE = 24000
+BYTES_PER_MS = SAMPLE_RATE * 2 // 1000
+
+class _NullWebSocket:
+    headers: dict = {}
+
+    async def send_str(self, data: str):
+        pass
+
+def _audio(ms: int) -> str:
+    return base64.b64encode(os.urandom(ms * BYTES_PER_MS)).decode("ascii")
+
+def web_upstream_frame() -> tuple[str, int]:
+    # One ScriptProcessor callback of the web client, 4096 samples
+    ms = 4096 * 1000 // SAMPLE_RATE
+    return json.dumps({"type": "input_audio_buffer.append", "audio": _audio(ms)}), ms
+
+def acs_upstream_frame() -> tuple[str, int]:
+    # ACS sends 20 ms packets
+    return json.dumps({
+        "kind": "AudioData",
+        "audioData": {"timestamp": "2024-11-20T10:00:00.000Z", "participantRawID": "4:+4912345678", "data": _audio(20), "silent": False}
+    }), 20
+
+def acs_upstream_frame_in_format(audio_format: str) -> tuple[str, int]:
+    sample_rate, encoding = AUDIO_FORMATS[audio_format]
+    bytes_per_sample = 2 if encoding == "pcm16" else 1
+    data = base64.b64encode(os.urandom(sample_rate * bytes_per_sample // 50)).decode("ascii")
+    return json.dumps({"kind": "AudioData", "audioData": {"data": data, "silent": False}}), 20
+
+def downstream_frame() -> tuple[str, int]:
+    return json.dumps({
+        "type": "response.audio.delta",
+        "event_id": "event_AbCdEfGhIjKlMnOp",
+        "response_id": "resp_AbCdEfGhIjKlMnOp",
+        "item_id": "item_AbCdEfGhIjKlMnOp",
+        "output_index": 0,
+        "content_index": 0,
+        "delta": _audio(100)
+    }), 100
+
+async def _baseline_to_server(rtmt: RTMiddleTier, raw: str, session: RTSession):
+    # Previous behavior: every frame is parsed, transformed if needed and serialized again
+    data = json.loads(raw)
+    if session.is_acs_audio_stream:
+        data = transform_acs_to_openai_format(data, rtmt.model, rtmt.tools, rtmt.system_message, rtmt.temperature, rtmt.max_tokens, rtmt.disable_audio, session.selected_voice)
+    await session.send_to_server(json.dumps(data))
+
+async def _baseline_to_client(rtmt: RTMiddleTier, raw: str, session: RTSession):
+    message = json.loads(raw)
+    if session.is_acs_audio_stream:
+        message = transform_openai_to_acs_format(message)
+    await session.send_to_client(json.dumps(message))
+
+async def _measure(process, rtmt: RTMiddleTier, session: RTSession, frame: str, frame_ms: int, seconds: int) -> float:
+    frames = seconds * 1000 // frame_ms
+    start = time.process_time()
+    for _ in range(frames):
+        await process(rtmt, frame, session)
+    return (time.process_time() - start) * 1000 / (frames * frame_ms / 1000)
+
+async def run(seconds: int):
+    rtmt = RTMiddleTier("http://localhost", "benchmark", AzureKeyCredential("benchmark"))
+    cases = [
+        ("web -> server", False, web_upstream_frame(), _baseline_to_server, lambda r, f, s: r._process_message_to_server(f, s)),
+        ("acs -> server", True, acs_upstream_frame(), _baseline_to_server, lambda r, f, s: r._process_message_to_server(f, s)),
+        ("server -> web", False, downstream_frame(), _baseline_to_client, lambda r, f, s: r._process_message_to_client(f, s)),
+        ("server -> acs", True, downstream_frame(), _baseline_to_client, lambda r, f, s: r._process_message_to_client(f, s)),
+    ]
+
+    print(f"CPU milliseconds per second of audio ({seconds} s of audio per case)")
+    print(f"{'direction':<16}{'baseline':>12}{'current':>12}{'speedup':>10}")
+    for name, is_acs, (frame, frame_ms), baseline, current in cases:
+        session = RTSession("benchmark", _NullWebSocket(), is_acs, rtmt.selected_voice)
+        session.server_ws = _NullWebSocket()
+        before = await _measure(baseline, rtmt, session, frame, frame_ms, seconds)
+        after = await _measure(current, rtmt, session, frame, frame_ms, seconds)
+        print(f"{name:<16}{before:>12.3f}{after:>12.3f}{before / after:>9.1f}x")
+
+    print()
+    print("Phone audio formats, CPU milliseconds per second of audio and bytes per second on the phone leg")
+    print(f"{'format':<16}{'to server':>12}{'to phone':>12}{'bytes/s':>10}")
+    to_server = lambda r, f, s: r._process_message_to_server(f, s)
+    to_client = lambda r, f, s: r._process_message_to_client(f, s)
+    for audio_format, (sample_rate, encoding) in AUDIO_FORMATS.items():
+        session = RTSession("benchmark", _NullWebSocket(), True, rtmt.selected_voice, acs_audio_format=audio_format)
+        session.server_ws = _NullWebSocket()
+        upstream = await _measure(to_server, rtmt, session, *acs_upstream_frame_in_format(audio_format), seconds)
+        downstream = await _measure(to_client, rtmt, session, *downstream_frame(), seconds)
+        bytes_per_second = sample_rate * (2 if encoding == "pcm16" else 1)
+        print(f"{audio_format:<16}{upstream:>12.3f}{downstream:>12.3f}{bytes_per_second:>10}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=int, default=600, help="Seconds of audio to push through each case")
+    args = parser.parse_args()
+    asyncio.run(run(args.seconds))
@@ -0,0 +1,259 @@
+"""
+Load test for one worker of app.py against a local mock of the OpenAI Realtime API and Azure AI Search.
+
+Starts app.py in a child process, configured to use the mocks, and drives it with simulated web and phone (ACS)
+calls that stream caller audio at real-time rate. The concurrency is raised step by step, for each step it reports:
+
+- throughput: WebSocket frames and audio bytes per second the worker forwarded in both directions
+- forwarding latency (p50/p99): time from the mock sending an audio chunk to the client receiving it, and back
+- event loop lag (p50/p99) of the worker, from its /metrics endpoint, and of the load generator itself.
+  If the load generator lags, it is the bottleneck and the numbers above are not meaningful.
+
+Run from the src/app folder:
+
+    python -m benchmarks.load --concurrency 1 10 25 50 --duration 20
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import time
+from pathlib import Path
+import aiohttp
+from benchmarks.mocks import BYTES_PER_MS, LatencyStats, MockRealtimeAPI, MockSearchService, audio_latencies, stamped_audio, start_mock_services
+
+# Web clients send one chunk per ScriptProcessor callback of 4096 samples, ACS sends 20 ms packets
+WEB_CHUNK_MS = 4096 * 1000 // 24000
+ACS_CHUNK_MS = 20
+
+class Traffic:
+    """
+    Counts what the simulated clients sent and received.
+    """
+    def __init__(self):
+        self.frames = 0
+        self.audio_bytes = 0
+        self.errors = 0
+        self.downstream_latency = LatencyStats()
+
+    def reset(self):
+        self.frames = 0
+        self.audio_bytes = 0
+        self.errors = 0
+        self.downstream_latency.reset()
+
+async def _paced(period_ms: int, stop: asyncio.Event):
+    # Yields at a fixed rate, scheduled against the start so delays don't accumulate
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    i = 0
+    while not stop.is_set():
+        yield i
+        i += 1
+        await asyncio.sleep(max(0, start + i * period_ms / 1000 - loop.time()))
+
+async def web_client(session: aiohttp.ClientSession, url: str, traffic: Traffic, stop: asyncio.Event):
+    async with session.ws_connect(url + "/realtime") as ws:
+        await ws.send_str(json.dumps({"type": "session.update", "session": {"turn_detection": {"type": "server_vad"}}}))
+
+        async def send():
+            async for _ in _paced(WEB_CHUNK_MS, stop):
+                audio = base64.b64encode(stamped_audio(WEB_CHUNK_MS)).decode("ascii")
+                await ws.send_str(json.dumps({"type": "input_audio_buffer.append", "audio": audio}))
+                traffic.frames += 1
+                traffic.audio_bytes += WEB_CHUNK_MS * BYTES_PER_MS
+            await ws.close()
+
+        async def receive():
+            async for msg in ws:
+                traffic.frames += 1
+                event = json.loads(msg.data)
+                if event["type"] == "response.audio.delta":
+                    audio = base64.b64decode(event["delta"])
+                    traffic.audio_bytes += len(audio)
+                    traffic.downstream_latency.add(audio_latencies(audio))
+                elif event["type"] == "error":
+                    traffic.errors += 1
+
+        await asyncio.gather(send(), receive())
+
+async def acs_client(session: aiohttp.ClientSession, url: str, traffic: Traffic, stop: asyncio.Event):
+    async with session.ws_connect(url + "/realtime-acs") as ws:
+        await ws.send_str(json.dumps({"kind": "AudioMetadata", "audioMetadata": {"subscriptionId": "benchmark", "encoding": "PCM", "sampleRate": 24000, "channels": 1, "length": ACS_CHUNK_MS * BYTES_PER_MS}}))
+
+        async def send():
+            async for _ in _paced(ACS_CHUNK_MS, stop):
+                audio = base64.b64encode(stamped_audio(ACS_CHUNK_MS)).decode("ascii")
+                await ws.send_str(json.dumps({"kind": "AudioData", "audioData": {"timestamp": "2024-01-01T00:00:00.000Z", "participantRawID": "4:+10000000000", "data": audio, "silent": False}}))
+                traffic.frames += 1
+                traffic.audio_bytes += ACS_CHUNK_MS * BYTES_PER_MS
+            await ws.close()
+
+        async def receive():
+            async for msg in ws:
+                traffic.frames += 1
+                message = json.loads(msg.data)
+                if message["kind"] == "AudioData":
+                    audio = base64.b64decode(message["audioData"]["data"])
+                    traffic.audio_bytes += len(audio)
+                    traffic.downstream_latency.add(audio_latencies(audio))
+
+        await asyncio.gather(send(), receive())
+
+async def _run_client(client, session: aiohttp.ClientSession, url: str, traffic: Traffic, stop: asyncio.Event):
+    try:
+        await client(session, url, traffic, stop)
+    except (aiohttp.ClientError, ConnectionError) as e:
+        print(f"Client failed: {e}", file=sys.stderr)
+        traffic.errors += 1
+
+_LAG_BUCKET = re.compile(r'^voicerag_event_loop_lag_seconds_bucket\{le="([^"]+)"\} (\d+)$', re.MULTILINE)
+
+async def scrape_loop_lag(session: aiohttp.ClientSession, url: str) -> list[tuple[float, int]]:
+    async with session.get(url + "/metrics") as response:
+        text = await response.text()
+    return [(float(le), int(count)) for le, count in _LAG_BUCKET.findall(text)]
+
+def bucket_percentile(before: list[tuple[float, int]], after: list[tuple[float, int]], p: float) -> float:
+    # Upper bound of the bucket the percentile falls into, from the difference of two scrapes
+    counts = [(le, count - previous) for (le, count), (_, previous) in zip(after, before)]
+    total = counts[-1][1] if counts else 0
+    if total == 0:
+        return float("nan")
+    for le, count in counts:
+        if count >= total * p / 100:
+            return le
+    return float("inf")
+
+async def monitor_own_loop_lag(stats: LatencyStats, stop: asyncio.Event):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        start = loop.time()
+        await asyncio.sleep(0.1)
+        stats.add([max(0, loop.time() - start - 0.1)])
+
+def start_app(port: int, mock_url: str, args: argparse.Namespace) -> subprocess.Popen:
+    env = dict(os.environ)
+    env.update({
+        "HOST": "127.0.0.1",
+        "PORT": str(port),
+        "AZURE_OPENAI_ENDPOINT": mock_url,
+        "AZURE_OPENAI_API_KEY": "benchmark",
+        "AZURE_OPENAI_COMPLETION_DEPLOYMENT_NAME": "benchmark",
+        "AZURE_SEARCH_ENDPOINT": mock_url,
+        "AZURE_SEARCH_INDEX": "benchmark",
+        "AZURE_SEARCH_API_KEY": "benchmark",
+        "AZURE_SEARCH_SEMANTIC_CONFIGURATION": "default",
+        "AZURE_SEARCH_INDEX_VERSION_POLL_SECONDS": "0",
+        "RTMT_MAX_SESSIONS": str(max(args.concurrency) * 2),
+    })
+    for name in ("AZURE_STORAGE_CONNECTION_STRING", "LOCAL_SEARCH_INDEX_PATH", "LOCAL_SEARCH_EMBEDDING_DEPLOYMENT"):
+        env.pop(name, None)
+    for setting in args.env:
+        name, _, value = setting.partition("=")
+        env[name] = value
+    app_directory = Path(__file__).resolve().parent.parent
+    # Warnings and errors of the app still show up on stderr
+    return subprocess.Popen([sys.executable, "app.py"], cwd=app_directory, env=env, stdout=subprocess.DEVNULL)
+
+async def wait_until_ready(session: aiohttp.ClientSession, url: str, process: subprocess.Popen):
+    for _ in range(100):
+        if process.poll() is not None:
+            raise RuntimeError("app.py exited during startup")
+        try:
+            async with session.get(url + "/ready") as response:
+                if response.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("app.py did not start")
+
+async def run_step(session: aiohttp.ClientSession, url: str, concurrency: int, args: argparse.Namespace, realtime: MockRealtimeAPI) -> dict:
+    traffic = Traffic()
+    own_lag = LatencyStats()
+    stop = asyncio.Event()
+    random.seed(concurrency)
+    clients = [acs_client if i < round(concurrency * args.acs_share) else web_client for i in range(concurrency)]
+
+    tasks = []
+    for client in clients:
+        tasks.append(asyncio.create_task(_run_client(client, session, url, traffic, stop)))
+        # Spread call setup a bit, like real traffic
+        await asyncio.sleep(random.uniform(0, 0.05))
+    lag_monitor = asyncio.create_task(monitor_own_loop_lag(own_lag, stop))
+
+    # Let the calls ramp up and the greetings play, then measure
+    await asyncio.sleep(args.warmup)
+    traffic.reset()
+    realtime.upstream_latency.reset()
+    own_lag.reset()
+    lag_before = await scrape_loop_lag(session, url)
+    start = time.monotonic()
+    await asyncio.sleep(args.duration)
+    elapsed = time.monotonic() - start
+    lag_after = await scrape_loop_lag(session, url)
+    result = {
+        "concurrency": concurrency,
+        "frames_per_second": traffic.frames / elapsed,
+        "audio_mb_per_second": traffic.audio_bytes / elapsed / 1e6,
+        "down_p50_ms": traffic.downstream_latency.percentile(50) * 1000,
+        "down_p99_ms": traffic.downstream_latency.percentile(99) * 1000,
+        "up_p50_ms": realtime.upstream_latency.percentile(50) * 1000,
+        "up_p99_ms": realtime.upstream_latency.percentile(99) * 1000,
+        "lag_p50_ms": bucket_percentile(lag_before, lag_after, 50) * 1000,
+        "lag_p99_ms": bucket_percentile(lag_before, lag_after, 99) * 1000,
+        "own_lag_p99_ms": own_lag.percentile(99) * 1000,
+        "errors": traffic.errors,
+    }
+
+    stop.set()
+    await asyncio.gather(*tasks, lag_monitor)
+    return result
+
+async def run(args: argparse.Namespace):
+    mock_url = f"http://127.0.0.1:{args.mock_port}"
+    url = f"http://127.0.0.1:{args.port}"
+    realtime = MockRealtimeAPI(turn_ms=args.turn_ms, answer_ms=args.answer_ms, tool_every=args.tool_every)
+    search = MockSearchService(latency_ms=args.search_latency_ms, slow_rate=args.search_slow_rate, slow_latency_ms=args.search_slow_latency_ms, failure_rate=args.search_failure_rate)
+    mocks = await start_mock_services("127.0.0.1", args.mock_port, realtime, search)
+    process = start_app(args.port, mock_url, args)
+    try:
+        async with aiohttp.ClientSession() as session:
+            await wait_until_ready(session, url, process)
+            print(f"{'calls':>6}{'frames/s':>10}{'audio MB/s':>11}{'down p50':>10}{'down p99':>10}{'up p50':>9}{'up p99':>9}{'lag p50':>9}{'lag p99':>9}{'gen lag':>9}{'errors':>8}")
+            for concurrency in args.concurrency:
+                r = await run_step(session, url, concurrency, args, realtime)
+                print(f"{r['concurrency']:>6}{r['frames_per_second']:>10.0f}{r['audio_mb_per_second']:>11.2f}"
+                      f"{r['down_p50_ms']:>10.1f}{r['down_p99_ms']:>10.1f}{r['up_p50_ms']:>9.1f}{r['up_p99_ms']:>9.1f}"
+                      f"{r['lag_p50_ms']:>9.1f}{r['lag_p99_ms']:>9.1f}{r['own_lag_p99_ms']:>9.1f}{r['errors']:>8}", flush=True)
+                await asyncio.sleep(1)
+            print("Latencies and lag in milliseconds, worker lag is the upper bound of its histogram bucket.")
+            print(f"Mock search: {search.queries} queries, {search.failures} failed.")
+    finally:
+        process.terminate()
+        process.wait()
+        await mocks.cleanup()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 25, 50], help="Concurrent calls per step")
+    parser.add_argument("--duration", type=float, default=20, help="Seconds to measure per step")
+    parser.add_argument("--warmup", type=float, default=5, help="Seconds to wait before measuring a step")
+    parser.add_argument("--acs-share", type=float, default=0.5, help="Share of phone calls, the rest are web clients")
+    parser.add_argument("--turn-ms", type=int, default=3000, help="Length of a simulated user utterance")
+    parser.add_argument("--answer-ms", type=int, default=2000, help="Length of a simulated answer")
+    parser.add_argument("--tool-every", type=int, default=2, help="Search on every n-th turn, 0 disables tool calls")
+    parser.add_argument("--search-latency-ms", type=float, default=150, help="Latency of the mock search service")
+    parser.add_argument("--search-slow-rate", type=float, default=0, help="Share of searches that take --search-slow-latency-ms instead")
+    parser.add_argument("--search-slow-latency-ms", type=float, default=3000, help="Latency of slow searches")
+    parser.add_argument("--search-failure-rate", type=float, default=0, help="Share of searches that fail with 503")
+    parser.add_argument("--port", type=int, default=8799, help="Port for app.py")
+    parser.add_argument("--mock-port", type=int, default=8798, help="Port for the mock services")
+    parser.add_argument("--env", nargs="*", default=[], metavar="NAME=VALUE", help="Extra environment for app.py, e.g. RTMT_AUDIO_COALESCE_MS=100")
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,249 @@
+"""
+Local stand-ins for the services the middle tier talks to, for benchmarks that run without Azure resources.
+
+MockRealtimeAPI serves /openai/realtime like the OpenAI Realtime API: it simulates server VAD on the caller audio,
+answers every user turn with audio deltas at real-time rate and calls the search tool on every n-th turn.
+MockSearchService answers Azure AI Search queries after a configurable latency.
+
+Audio is stamped to measure forwarding latency: clients and the mock put a marker and the send time
+(time.monotonic(), which is the same clock in all processes of a host) at the start of every audio chunk.
+"""
+import asyncio
+import base64
+import json
+import os
+import random
+import struct
+import time
+from typing import Optional
+from aiohttp import web, WSMsgType
+
+SAMPLE_RATE = 24000
+BYTES_PER_MS = SAMPLE_RATE * 2 // 1000
+
+_STAMP_MARKER = b"RTMTSTMP"
+_STAMP = struct.Struct("<8sd")
+
+def stamped_audio(ms: int) -> bytes:
+    """
+    Returns ms milliseconds of 24 kHz PCM noise that starts with the current time.
+    """
+    return _STAMP.pack(_STAMP_MARKER, time.monotonic()) + os.urandom(ms * BYTES_PER_MS - _STAMP.size)
+
+def audio_latencies(audio: bytes) -> list[float]:
+    """
+    Returns the seconds since every stamp in the audio was made. Chunks may have been merged on the way.
+    """
+    now = time.monotonic()
+    latencies = []
+    position = audio.find(_STAMP_MARKER)
+    while position >= 0:
+        _, sent = _STAMP.unpack_from(audio, position)
+        latencies.append(now - sent)
+        position = audio.find(_STAMP_MARKER, position + _STAMP.size)
+    return latencies
+
+class LatencyStats:
+    """
+    Collects latency samples in seconds.
+    """
+    def __init__(self):
+        self.samples: list[float] = []
+
+    def add(self, values: list[float]):
+        self.samples.extend(values)
+
+    def percentile(self, p: float) -> float:
+        if not self.samples:
+            return float("nan")
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+    def reset(self):
+        self.samples = []
+
+class MockRealtimeAPI:
+    """
+    Scripted OpenAI Realtime API. Every turn_ms of caller audio is treated as one user utterance, which is answered
+    with answer_ms of audio, sent in chunks of delta_ms at real-time rate. Caller audio that arrives while an answer is
+    playing is ignored, like silence. Every tool_every-th turn first calls the search tool, 0 never calls tools.
+    """
+    def __init__(self, turn_ms: int = 3000, answer_ms: int = 2000, delta_ms: int = 100, tool_every: int = 0, distinct_queries: int = 20):
+        self.turn_ms = turn_ms
+        self.answer_ms = answer_ms
+        self.delta_ms = delta_ms
+        self.tool_every = tool_every
+        self.distinct_queries = distinct_queries
+        self.upstream_latency = LatencyStats()
+        self.connections = 0
+        self._queries = 0
+
+    def add_routes(self, app: web.Application):
+        app.router.add_get("/openai/realtime", self.handle)
+
+    async def handle(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.connections += 1
+        try:
+            await _MockRealtimeSession(self, ws).run()
+        finally:
+            self.connections -= 1
+        return ws
+
+    def next_query(self) -> str:
+        self._queries += 1
+        return f"benchmark question {self._queries % self.distinct_queries}"
+
+class _MockRealtimeSession:
+    def __init__(self, api: MockRealtimeAPI, ws: web.WebSocketResponse):
+        self.api = api
+        self.ws = ws
+        self.config = {"voice": "alloy", "instructions": "", "tools": [], "turn_detection": None}
+        self.heard_ms = 0.0
+        self.speaking = False
+        self.turns = 0
+        self.called_tool = False
+        self.items = 0
+        self.response: Optional[asyncio.Task] = None
+
+    def _id(self, prefix: str) -> str:
+        self.items += 1
+        return f"{prefix}_{self.items:08d}"
+
+    async def send(self, event: dict):
+        event.setdefault("event_id", self._id("event"))
+        await self.ws.send_str(json.dumps(event))
+
+    async def run(self):
+        await self.send({"type": "session.created", "session": dict(self.config)})
+        try:
+            async for msg in self.ws:
+                if msg.type != WSMsgType.TEXT:
+                    continue
+                event = json.loads(msg.data)
+                match event["type"]:
+                    case "input_audio_buffer.append":
+                        await self.on_audio(base64.b64decode(event["audio"]))
+                    case "session.update":
+                        self.config.update(event["session"])
+                        await self.send({"type": "session.updated", "session": dict(self.config)})
+                    case "response.create":
+                        self.start_response()
+                    case "response.cancel":
+                        if self.response is not None:
+                            self.response.cancel()
+        finally:
+            if self.response is not None:
+                self.response.cancel()
+
+    async def on_audio(self, audio: bytes):
+        self.api.upstream_latency.add(audio_latencies(audio))
+        if self.response is not None and not self.response.done():
+            return
+        if not self.speaking:
+            self.speaking = True
+            await self.send({"type": "input_audio_buffer.speech_started", "audio_start_ms": 0, "item_id": self._id("item")})
+        self.heard_ms += len(audio) / BYTES_PER_MS
+        if self.heard_ms >= self.api.turn_ms:
+            self.heard_ms = 0
+            self.speaking = False
+            self.turns += 1
+            item_id = self._id("item")
+            await self.send({"type": "input_audio_buffer.speech_stopped", "audio_end_ms": self.api.turn_ms, "item_id": item_id})
+            await self.send({"type": "input_audio_buffer.committed", "previous_item_id": None, "item_id": item_id})
+            # Server VAD answers on its own
+            self.start_response()
+
+    def start_response(self):
+        if self.response is not None and not self.response.done():
+            return
+        # The response.create sent after a tool output is always answered with audio
+        use_tool = (self.api.tool_every > 0 and self.turns > 0 and self.turns % self.api.tool_every == 0 and not self.called_tool
+                    and any(tool.get("name") == "search" for tool in self.config.get("tools", [])))
+        self.called_tool = use_tool
+        self.response = asyncio.create_task(self.function_call() if use_tool else self.answer())
+
+    async def function_call(self):
+        response_id = self._id("resp")
+        call_id = self._id("call")
+        item = {"id": self._id("item"), "type": "function_call", "call_id": call_id, "name": "search", "arguments": ""}
+        arguments = json.dumps({"query": self.api.next_query()})
+        await self.send({"type": "response.created", "response": {"id": response_id, "status": "in_progress", "output": []}})
+        await self.send({"type": "response.output_item.added", "response_id": response_id, "output_index": 0, "item": item})
+        await self.send({"type": "conversation.item.created", "previous_item_id": None, "item": item})
+        await self.send({"type": "response.function_call_arguments.delta", "response_id": response_id, "item_id": item["id"], "call_id": call_id, "delta": arguments})
+        await self.send({"type": "response.function_call_arguments.done", "response_id": response_id, "item_id": item["id"], "call_id": call_id, "arguments": arguments})
+        done_item = dict(item, arguments=arguments, status="completed")
+        await self.send({"type": "response.output_item.done", "response_id": response_id, "output_index": 0, "item": done_item})
+        await self.send({"type": "response.done", "response": {"id": response_id, "status": "completed", "output": [done_item]}})
+
+    async def answer(self):
+        response_id = self._id("resp")
+        item = {"id": self._id("item"), "type": "message", "role": "assistant", "content": []}
+        await self.send({"type": "response.created", "response": {"id": response_id, "status": "in_progress", "output": []}})
+        await self.send({"type": "response.output_item.added", "response_id": response_id, "output_index": 0, "item": item})
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        for i in range(self.api.answer_ms // self.api.delta_ms):
+            # Scheduled against the start, so slow sends don't add up to a slower than real-time stream
+            await asyncio.sleep(max(0, start + i * self.api.delta_ms / 1000 - loop.time()))
+            await self.ws.send_str(json.dumps({
+                "type": "response.audio.delta",
+                "event_id": self._id("event"),
+                "response_id": response_id,
+                "item_id": item["id"],
+                "output_index": 0,
+                "content_index": 0,
+                "delta": base64.b64encode(stamped_audio(self.api.delta_ms)).decode("ascii")
+            }))
+            await self.send({"type": "response.audio_transcript.delta", "response_id": response_id, "item_id": item["id"], "output_index": 0, "content_index": 0, "delta": "word "})
+        await self.send({"type": "response.audio.done", "response_id": response_id, "item_id": item["id"], "output_index": 0, "content_index": 0})
+        done_item = dict(item, status="completed", content=[{"type": "audio", "transcript": "word " * (self.api.answer_ms // self.api.delta_ms)}])
+        await self.send({"type": "response.output_item.done", "response_id": response_id, "output_index": 0, "item": done_item})
+        await self.send({"type": "response.done", "response": {"id": response_id, "status": "completed", "output": [done_item]}})
+
+class MockSearchService:
+    """
+    Answers Azure AI Search queries of the search tools with made-up chunks after latency_ms.
+    A degraded service is simulated with slow_rate of the queries taking slow_latency_ms instead,
+    and failure_rate of them failing with 503 Service Unavailable.
+    """
+    def __init__(self, latency_ms: float = 50, results: int = 5, slow_rate: float = 0, slow_latency_ms: float = 3000, failure_rate: float = 0):
+        self.latency_ms = latency_ms
+        self.results = results
+        self.slow_rate = slow_rate
+        self.slow_latency_ms = slow_latency_ms
+        self.failure_rate = failure_rate
+        self.queries = 0
+        self.failures = 0
+
+    def add_routes(self, app: web.Application):
+        app.router.add_post("/indexes('{index}')/docs/search.post.search", self.search)
+        app.router.add_get("/indexes('{index}')/docs/$count", self.count)
+
+    async def count(self, request: web.Request) -> web.Response:
+        return web.Response(text="1000", content_type="text/plain")
+
+    async def search(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        self.queries += 1
+        await asyncio.sleep((self.slow_latency_ms if random.random() < self.slow_rate else self.latency_ms) / 1000)
+        if random.random() < self.failure_rate:
+            self.failures += 1
+            return web.json_response({"error": {"code": "ServiceUnavailable", "message": "Simulated failure"}}, status=503)
+        query = body.get("search", "")
+        return web.json_response({"value": [
+            {"@search.score": 1.0 / (i + 1), "chunk_id": f"chunk_{abs(hash(query)) % 1000}_{i}", "title": f"Document {i}", "chunk": f"Passage {i} about {query}. " * 20}
+            for i in range(self.results)
+        ]})
+
+async def start_mock_services(host: str, port: int, realtime: MockRealtimeAPI, search: Optional[MockSearchService] = None) -> web.AppRunner:
+    app = web.Application()
+    realtime.add_routes(app)
+    if search is not None:
+        search.add_routes(app)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
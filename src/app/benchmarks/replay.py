@@ -0,0 +1,157 @@
+"""
+Replays a session recording (see backend.recorder, enabled with RTMT_RECORDING_DIR) through the RTMiddleTier.
+
+The frames the middle tier received from the OpenAI Realtime API are sent again by a local mock of the service,
+the frames it received from the web client or ACS are sent again by a local client. Both sides follow the
+recorded timing, or run as fast as possible with --speed 0, which makes it easy to profile the forwarding path
+with the traffic of a real call. Tools the model called in the recording are replaced by stubs.
+
+Run from the src/app folder:
+
+    python -m benchmarks.replay recordings/<session id> --speed 0 --profile replay.prof
+"""
+import argparse
+import asyncio
+import cProfile
+import json
+import pstats
+import time
+import aiohttp
+from aiohttp import web
+from azure.core.credentials import AzureKeyCredential
+from backend.recorder import FROM_CLIENT, FROM_SERVER, Recording
+from backend.rtmt import RTMiddleTier
+from backend.tools.tools import Tool, ToolResult, ToolResultDirection
+from benchmarks.mocks import start_mock_services
+
+# Seconds to wait for the last forwarded frames after both sides have sent everything
+DRAIN_SECONDS = 0.5
+
+async def _play(frames: list[tuple[float, str]], ws, speed: float):
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    for t, text in frames:
+        if speed > 0:
+            await asyncio.sleep(max(0, start + t / speed - loop.time()))
+        await ws.send_str(text)
+
+class RecordedRealtimeAPI:
+    """
+    Stands in for /openai/realtime and sends the recorded frames of the service, once the middle tier connects.
+    The connection stays open until the middle tier closes it, after the client has hung up.
+    """
+    def __init__(self, frames: list[tuple[float, str]], speed: float):
+        self.frames = frames
+        self.speed = speed
+        self.done = asyncio.Event()
+        self.received = 0
+
+    def add_routes(self, app: web.Application):
+        app.router.add_get("/openai/realtime", self.handle)
+
+    async def handle(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+
+        async def receive():
+            async for _ in ws:
+                self.received += 1
+
+        receiver = asyncio.create_task(receive())
+        await _play(self.frames, ws, self.speed)
+        self.done.set()
+        await receiver
+        return ws
+
+def _stub_tools(frames: list[tuple[float, str]], latency_ms: float) -> dict[str, Tool]:
+    async def stub(args, context):
+        await asyncio.sleep(latency_ms / 1000)
+        return ToolResult("", ToolResultDirection.TO_SERVER)
+
+    names = set()
+    for _, text in frames:
+        if '"function_call"' in text:
+            event = json.loads(text)
+            item = event.get("item") or {}
+            if item.get("type") == "function_call" and item.get("name"):
+                names.add(item["name"])
+    return {name: Tool(target=stub, schema={"type": "function", "name": name, "parameters": {"type": "object", "properties": {}}}) for name in names}
+
+async def replay(args: argparse.Namespace) -> dict:
+    recording = Recording(args.recording)
+    client_frames = [(t, text) for t, _, text in recording.frames(FROM_CLIENT)]
+    server_frames = [(t, text) for t, _, text in recording.frames(FROM_SERVER)]
+
+    service = RecordedRealtimeAPI(server_frames, args.speed)
+    mocks = await start_mock_services("127.0.0.1", args.mock_port, service)
+
+    rtmt = RTMiddleTier(f"http://127.0.0.1:{args.mock_port}", "replay", AzureKeyCredential("replay"), audio_coalesce_ms=args.audio_coalesce_ms)
+    rtmt.tools.update(_stub_tools(server_frames, args.tool_latency_ms))
+
+    async def handler(request: web.Request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        await rtmt.forward_messages(ws, request.path.endswith("-acs"))
+        return ws
+
+    app = web.Application()
+    app.router.add_get("/realtime", handler)
+    app.router.add_get("/realtime-acs", handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", args.port).start()
+
+    received = 0
+    start, cpu_start = time.monotonic(), time.process_time()
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.ws_connect(f"http://127.0.0.1:{args.port}/realtime" + ("-acs" if recording.is_acs else "")) as ws:
+                async def receive():
+                    nonlocal received
+                    async for _ in ws:
+                        received += 1
+
+                receiver = asyncio.create_task(receive())
+                await _play(client_frames, ws, args.speed)
+                await service.done.wait()
+                await asyncio.sleep(DRAIN_SECONDS)
+                await ws.close()
+                await receiver
+    finally:
+        await runner.cleanup()
+        await rtmt.close()
+        await mocks.cleanup()
+
+    return {
+        "recorded_seconds": max((t for t, _ in client_frames + server_frames), default=0),
+        "wall_seconds": time.monotonic() - start - DRAIN_SECONDS,
+        "cpu_seconds": time.process_time() - cpu_start,
+        "from_client": len(client_frames),
+        "from_server": len(server_frames),
+        "to_client": received,
+        "to_server": service.received,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("recording", help="Path of the recording, with or without file suffix")
+    parser.add_argument("--speed", type=float, default=1, help="Playback speed, 1 is the recorded timing, 0 is as fast as possible")
+    parser.add_argument("--audio-coalesce-ms", type=int, default=0, help="RTMT_AUDIO_COALESCE_MS for the replay")
+    parser.add_argument("--tool-latency-ms", type=float, default=0, help="Latency of the tool stubs")
+    parser.add_argument("--profile", metavar="FILE", help="Profile the replay with cProfile and write the stats to this file")
+    parser.add_argument("--port", type=int, default=8797, help="Port for the middle tier")
+    parser.add_argument("--mock-port", type=int, default=8796, help="Port for the mock Realtime API")
+    args = parser.parse_args()
+
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler is not None:
+        profiler.enable()
+    result = asyncio.run(replay(args))
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+
+    print(f"Replayed {result['recorded_seconds']:.1f} s of recorded traffic in {result['wall_seconds']:.2f} s, {result['cpu_seconds']:.2f} s CPU")
+    print(f"Frames from client {result['from_client']}, from service {result['from_server']}, forwarded to client {result['to_client']}, to service {result['to_server']}")
+    if profiler is not None:
+        pstats.Stats(args.profile).sort_stats("tottime").print_stats(15)
@@ -0,0 +1,14 @@
+# Production settings for gunicorn, which picks up this file from the working directory of the container.
+# Every worker process holds its own sessions and warm connections, see RTMT_MAX_SESSIONS.
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8000)}"
+worker_class = "aiohttp.GunicornWebWorker"
+workers = int(os.environ.get("WEB_CONCURRENCY", 1))
+accesslog = "-"
+
+# Live calls are not interrupted by a deployment until they end or this many seconds have passed
+graceful_timeout = int(os.environ.get("GRACEFUL_TIMEOUT_SECONDS", 30))
+
+# The reloader watches the source tree and restarts workers on changes, only useful for development
+reload = os.environ.get("GUNICORN_RELOAD", "false").lower() == "true"
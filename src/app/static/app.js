@@ -51,7 +51,8 @@ async function startRecording() {
   // Open WebSocket connection
   const mainHost = window.location.host;
   const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
-  websocket = new WebSocket(`${protocol}//${mainHost}/realtime`);
+  const selectedVoice = encodeURIComponent(document.getElementById('themeSelect').value);
+  websocket = new WebSocket(`${protocol}//${mainHost}/realtime?voice=${selectedVoice}`);
 
   websocket.onopen = () => {
     console.log('WebSocket connection opened');
@@ -305,12 +306,3 @@ function detectSpeech(inputData) {
   return rms > VAD_THRESHOLD;
 }
 
-function updateVoiceOnServer(selectedVoice) {
-  fetch('/update-voice', {
-    method: 'POST',
-    headers: {
-      'Content-Type': 'application/json'
-    },
-    body: JSON.stringify({ voice: selectedVoice })
-  });
-}
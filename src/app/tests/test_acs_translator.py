@@ -0,0 +1,32 @@
+import json
+from backend.helpers import ACS_TURN_DETECTION, AcsTranslator
+
+_AUDIO = "AAECAwQFBgcICQ=="
+
+def test_audio_data_is_spliced_into_an_append_event():
+    translator = AcsTranslator()
+    raw = json.dumps({ "kind": "AudioData", "audioData": { "timestamp": "2024-11-20T10:00:00Z", "data": _AUDIO, "silent": False } })
+    assert json.loads(translator.to_openai(raw)) == { "type": "input_audio_buffer.append", "audio": _AUDIO }
+
+def test_unusual_formatting_falls_back_to_parsing():
+    translator = AcsTranslator()
+    raw = json.dumps({ "audioData": { "data": _AUDIO }, "kind": "AudioData" })
+    assert json.loads(translator.to_openai(raw)) == { "type": "input_audio_buffer.append", "audio": _AUDIO }
+
+def test_audio_metadata_becomes_the_session_update():
+    translator = AcsTranslator()
+    raw = json.dumps({ "kind": "AudioMetadata", "audioMetadata": { "subscriptionId": "1", "encoding": "PCM", "sampleRate": 24000, "channels": 1, "length": 640 } })
+    assert json.loads(translator.to_openai(raw)) == { "type": "session.update", "session": { "turn_detection": ACS_TURN_DETECTION } }
+    assert translator.transcoder is None
+
+def test_other_acs_messages_are_dropped():
+    assert AcsTranslator().to_openai(json.dumps({ "kind": "DtmfData", "dtmfData": { "data": "1" } })) is None
+
+def test_audio_delta_is_spliced_into_audio_data():
+    translator = AcsTranslator()
+    raw = json.dumps({ "type": "response.audio.delta", "response_id": "resp_1", "item_id": "item_1", "delta": _AUDIO })
+    assert json.loads(translator.to_acs(raw)) == { "kind": "AudioData", "audioData": { "data": _AUDIO } }
+
+def test_speech_started_stops_audio():
+    message = json.loads(AcsTranslator().to_acs_event({ "type": "input_audio_buffer.speech_started" }))
+    assert message == { "kind": "StopAudio", "audioData": None, "stopAudio": {} }
@@ -0,0 +1,76 @@
+import asyncio
+from backend.tools.rag.ai_search import SEARCH_UNAVAILABLE_MESSAGE, search_tool
+from backend.tools.rag.search_cache import SearchResultCache
+from backend.tools.rag.search_resilience import SearchResilience
+from backend.tools.tools import ToolContext
+
+class _Results:
+    def __init__(self, docs):
+        self._docs = iter(docs)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._docs)
+        except StopIteration:
+            raise StopAsyncIteration
+
+class FakeSearchClient:
+    """
+    Stands in for the async SearchClient, mode is "ok", "fail" or "hang".
+    """
+    def __init__(self, docs):
+        self.docs = docs
+        self.mode = "ok"
+
+    async def search(self, **kwargs):
+        if self.mode == "fail":
+            raise ConnectionError("search is down")
+        if self.mode == "hang":
+            await asyncio.sleep(3600)
+        return _Results(self.docs)
+
+_DOCS = [{"chunk_id": "refunds_0", "title": "refunds.md", "chunk": "Refunds are paid within ten days."}]
+
+def _run_search(tool, query="How long do refunds take?"):
+    return tool.target({"query": query}, ToolContext())
+
+def test_hung_search_falls_back_to_expired_cached_result():
+    async def run():
+        client = FakeSearchClient(_DOCS)
+        cache = SearchResultCache(ttl_seconds=0)
+        resilience = SearchResilience(hedge_percentile=0, timeout_seconds=0.01)
+        tool = search_tool(client, "default", cache, None, resilience)
+
+        assert "Refunds are paid" in (await _run_search(tool)).text
+        client.mode = "hang"
+        result = await asyncio.wait_for(_run_search(tool), 1)
+        assert "Refunds are paid" in result.text
+
+    asyncio.run(run())
+
+def test_failed_search_without_cached_result_reports_unavailable():
+    async def run():
+        client = FakeSearchClient(_DOCS)
+        client.mode = "fail"
+        tool = search_tool(client, "default", SearchResultCache(), None, SearchResilience())
+        assert (await _run_search(tool)).text == SEARCH_UNAVAILABLE_MESSAGE
+
+    asyncio.run(run())
+
+def test_open_circuit_answers_from_expired_cached_result():
+    async def run():
+        client = FakeSearchClient(_DOCS)
+        cache = SearchResultCache(ttl_seconds=0)
+        resilience = SearchResilience(hedge_percentile=0, failure_threshold=1, open_seconds=60)
+        tool = search_tool(client, "default", cache, None, resilience)
+
+        await _run_search(tool)
+        client.mode = "fail"
+        await _run_search(tool, "something else")
+        assert resilience.is_open
+        assert "Refunds are paid" in (await _run_search(tool)).text
+
+    asyncio.run(run())
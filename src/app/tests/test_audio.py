@@ -0,0 +1,73 @@
+import base64
+import json
+import numpy as np
+import pytest
+from backend.audio import AudioTranscoder, Resampler, _G711_TABLES
+from backend.helpers import AcsTranslator
+
+def _all_samples() -> bytes:
+    return np.arange(-32768, 32768, dtype="<i2").tobytes()
+
+def _tone(frequency: float, rate: int, seconds: float, amplitude: float = 8000) -> bytes:
+    t = np.arange(int(rate * seconds)) / rate
+    return np.rint(amplitude * np.sin(2 * np.pi * frequency * t)).astype("<i2").tobytes()
+
+@pytest.mark.parametrize("encoding", ["mulaw", "alaw"])
+def test_g711_matches_audioop(encoding):
+    audioop = pytest.importorskip("audioop")
+    encode_table, decode_table = _G711_TABLES[encoding]
+    lin2code, code2lin = (audioop.lin2ulaw, audioop.ulaw2lin) if encoding == "mulaw" else (audioop.lin2alaw, audioop.alaw2lin)
+
+    samples = _all_samples()
+    assert encode_table[np.frombuffer(samples, dtype="<u2")].tobytes() == lin2code(samples, 2)
+    codes = bytes(range(256))
+    assert decode_table[np.frombuffer(codes, dtype=np.uint8)].tobytes() == code2lin(codes, 2)
+
+@pytest.mark.parametrize("from_rate, to_rate", [(24000, 8000), (24000, 16000), (8000, 24000), (16000, 24000)])
+def test_streaming_resampler_matches_one_shot(from_rate, to_rate):
+    pcm = _tone(440, from_rate, 0.5)
+    whole = Resampler(from_rate, to_rate).process(pcm)
+
+    streaming = Resampler(from_rate, to_rate)
+    # Odd frame sizes, so the phase carries over between frames
+    frame_bytes = 2 * 157
+    pieces = [streaming.process(pcm[i:i + frame_bytes]) for i in range(0, len(pcm), frame_bytes)]
+    assert b"".join(pieces) == whole
+    assert abs(len(whole) // 2 - len(pcm) // 2 * to_rate // from_rate) <= 1
+
+def test_resampler_keeps_a_tone_below_nyquist():
+    pcm = _tone(1000, 24000, 0.5)
+    out = np.frombuffer(Resampler(24000, 8000).process(pcm), dtype="<i2").astype(np.float64)
+    # Skip the filter delay at the start
+    spectrum = np.abs(np.fft.rfft(out[200:]))
+    peak_hz = np.argmax(spectrum) * 8000 / len(out[200:])
+    assert abs(peak_hz - 1000) < 20
+
+def test_resampler_removes_content_above_nyquist():
+    pcm = _tone(6000, 24000, 0.5)
+    out = np.frombuffer(Resampler(24000, 8000).process(pcm), dtype="<i2").astype(np.float64)
+    assert np.sqrt(np.mean(out[200:] ** 2)) < 100
+
+@pytest.mark.parametrize("audio_format, bytes_per_20ms", [("pcm16k", 640), ("pcm8k", 320), ("mulaw8k", 160), ("alaw8k", 160)])
+def test_transcoder_frame_sizes(audio_format, bytes_per_20ms):
+    transcoder = AudioTranscoder(audio_format)
+    frame = _tone(440, 24000, 0.02)
+    assert len(transcoder.from_pcm24k(frame)) == bytes_per_20ms
+    assert len(transcoder.to_pcm24k(b"\x00" * bytes_per_20ms)) == len(frame)
+
+def test_unknown_format_is_rejected():
+    with pytest.raises(ValueError):
+        AudioTranscoder("opus48k")
+
+def test_translator_transcodes_after_audio_metadata():
+    translator = AcsTranslator()
+    translator.to_openai(json.dumps({ "kind": "AudioMetadata", "audioMetadata": { "encoding": "PCMU", "sampleRate": 8000, "channels": 1 } }))
+    assert translator.transcoder is not None and translator.transcoder.audio_format == "mulaw8k"
+
+    mulaw = base64.b64encode(b"\xff" * 160).decode("ascii")
+    event = json.loads(translator.to_openai(json.dumps({ "kind": "AudioData", "audioData": { "data": mulaw } })))
+    assert len(base64.b64decode(event["audio"])) == 960
+
+    pcm = base64.b64encode(_tone(440, 24000, 0.02)).decode("ascii")
+    message = json.loads(translator.to_acs(json.dumps({ "type": "response.audio.delta", "delta": pcm })))
+    assert len(base64.b64decode(message["audioData"]["data"])) == 160
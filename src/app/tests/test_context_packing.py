@@ -0,0 +1,45 @@
+from backend.tools.rag.context_packing import ContextPacker
+from backend.tools.tools import ToolContext
+
+_POLICY = {
+    "chunk_id": "policy_0",
+    "title": "policy.md",
+    "chunk": "Parking costs five dollars per day. Refunds are paid within ten days. The office opens at nine.",
+}
+
+def test_chunks_within_budget_are_sent_unchanged():
+    text, chunk_ids = ContextPacker(1000).pack("parking cost", [_POLICY], ToolContext())
+    assert text == f"[policy_0]: {_POLICY['chunk']}\n-----\n"
+    assert chunk_ids == ["policy_0"]
+
+def test_trimmed_chunk_keeps_best_matching_sentence():
+    text, _ = ContextPacker(16).pack("parking cost", [_POLICY], ToolContext())
+    assert "Parking costs five dollars per day." in text
+    assert "Refunds" not in text
+
+def test_trimmed_chunk_is_not_marked_as_sent():
+    packer = ContextPacker(16)
+    context = ToolContext()
+    _, chunk_ids = packer.pack("parking cost", [_POLICY], context)
+    assert chunk_ids == []
+    context.sent_chunks.update(chunk_ids)
+
+    text, _ = packer.pack("how long do refunds take", [_POLICY], context)
+    assert "Refunds are paid within ten days." in text
+    assert ContextPacker.ALREADY_SENT not in text
+
+def test_chunk_sent_in_full_is_only_referenced_later():
+    packer = ContextPacker(1000)
+    context = ToolContext()
+    _, chunk_ids = packer.pack("parking cost", [_POLICY], context)
+    context.sent_chunks.update(chunk_ids)
+
+    text, chunk_ids = packer.pack("refunds", [_POLICY], context)
+    assert text == f"[policy_0]: {ContextPacker.ALREADY_SENT}\n-----\n"
+    assert chunk_ids == []
+
+def test_near_duplicates_are_left_out():
+    duplicate = dict(_POLICY, chunk_id="policy_copy_0")
+    text, chunk_ids = ContextPacker(1000).pack("parking", [_POLICY, duplicate], ToolContext())
+    assert chunk_ids == ["policy_0"]
+    assert "policy_copy_0" not in text
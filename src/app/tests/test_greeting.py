@@ -0,0 +1,25 @@
+import asyncio
+from backend.greeting import Greeting, GreetingCache
+
+def test_greeting_recorded_by_another_worker_is_loaded_after_a_miss(tmp_path):
+    async def run():
+        cache = GreetingCache(str(tmp_path))
+        other_worker = GreetingCache(str(tmp_path))
+        key = GreetingCache.key("Be brief.", "alloy")
+        assert await cache.get(key) is None
+        await other_worker.put(key, Greeting("Hello!", b"\x01\x00" * 2400))
+        greeting = await cache.get(key)
+        assert greeting.transcript == "Hello!" and greeting.pcm == b"\x01\x00" * 2400
+        # Loaded greetings are kept in memory
+        assert await cache.get(key) is greeting
+
+    asyncio.run(run())
+
+def test_unreadable_greeting_is_a_miss(tmp_path):
+    async def run():
+        cache = GreetingCache(str(tmp_path))
+        key = GreetingCache.key(None, "alloy")
+        (tmp_path / f"greeting-{key}.json").write_text("{")
+        assert await cache.get(key) is None
+
+    asyncio.run(run())
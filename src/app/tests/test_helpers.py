@@ -0,0 +1,72 @@
+import json
+import pytest
+from backend.helpers import find_audio_payload, get_input_audio, get_output_audio, parse_partial_json_object, peek_event_kind, peek_event_type, peek_item_id
+
+_AUDIO = "AAECAwQFBgcICQ=="
+
+_FRAMES = [
+    json.dumps({ "type": "input_audio_buffer.append", "audio": _AUDIO }),
+    json.dumps({ "type": "input_audio_buffer.append", "audio": _AUDIO }, separators=(",", ":")),
+    json.dumps({ "type": "input_audio_buffer.append", "audio": _AUDIO }, indent=2),
+    json.dumps({ "type": "response.audio.delta", "event_id": "event_1", "response_id": "resp_1", "item_id": "item_1", "output_index": 0, "content_index": 0, "delta": _AUDIO }),
+    json.dumps({ "type": "response.audio.delta", "delta": _AUDIO, "item_id": "item_1" }, separators=(",", ":")),
+    json.dumps({ "kind": "AudioData", "audioData": { "timestamp": "2024-11-20T10:00:00Z", "participantRawID": "8:acs:1", "data": _AUDIO, "silent": False } }),
+    json.dumps({ "kind": "AudioData", "audioData": { "data": _AUDIO } }, separators=(",", ":")),
+]
+
+@pytest.mark.parametrize("raw", _FRAMES)
+def test_audio_payload_matches_parsed_frame(raw):
+    parsed = json.loads(raw)
+    expected = parsed.get("audio") or parsed.get("delta") or parsed["audioData"]["data"]
+    start, end = find_audio_payload(raw)
+    assert raw[start:end] == expected
+
+@pytest.mark.parametrize("raw", _FRAMES)
+def test_event_type_and_kind_match_parsed_frame(raw):
+    parsed = json.loads(raw)
+    assert peek_event_type(raw) == parsed.get("type")
+    assert peek_event_kind(raw) == parsed.get("kind")
+
+def test_type_that_is_not_the_first_key_is_not_guessed():
+    raw = json.dumps({ "event_id": "event_1", "type": "response.audio.delta", "delta": _AUDIO })
+    assert peek_event_type(raw) is None
+    assert find_audio_payload(raw) is None
+
+def test_other_events_have_no_audio_payload():
+    assert find_audio_payload(json.dumps({ "type": "response.audio_transcript.delta", "delta": "Hello" })) is None
+    assert find_audio_payload(json.dumps({ "kind": "AudioMetadata", "audioMetadata": { "encoding": "PCM" } })) is None
+
+def test_audio_getters():
+    assert get_input_audio(_FRAMES[0]) == _AUDIO
+    assert get_output_audio(_FRAMES[3]) == _AUDIO
+    assert get_output_audio(json.dumps({ "type": "response.audio.delta" })) is None
+
+def test_item_id_is_found_before_and_after_the_payload():
+    assert peek_item_id(_FRAMES[3]) == "item_1"
+    long_audio = "A" * 4096
+    raw = json.dumps({ "type": "response.audio.delta", "delta": long_audio, "item_id": "item_2" })
+    assert peek_item_id(raw) == "item_2"
+    assert peek_item_id(_FRAMES[0]) is None
+
+def test_escaped_type_is_not_peeked():
+    assert peek_event_type('{"type": "response.\\u0061udio.delta"}') is None
+
+@pytest.mark.parametrize("text, expected", [
+    ('{"query": "refunds"}', { "query": "refunds" }),
+    ('{"query": "refunds"', { "query": "refunds" }),
+    ('{"query": "refunds", ', { "query": "refunds" }),
+    ('{"sources": ["a_0", "b_1"', { "sources": ["a_0", "b_1"] }),
+    ('{"filter": {"year": 2024', { "filter": { "year": 2024 } }),
+    ('{"query": "say \\"hi', None),
+    ('{"query": "refu', None),
+    ('{"query": ', None),
+    ('{"query"', None),
+    ('', None),
+    ('[1, 2]', None),
+    ('not json', None),
+])
+def test_parse_partial_json_object(text, expected):
+    assert parse_partial_json_object(text) == expected
+
+def test_partial_json_with_braces_inside_strings():
+    assert parse_partial_json_object('{"query": "a {b} [c]"') == { "query": "a {b} [c]" }
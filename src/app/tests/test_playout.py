@@ -0,0 +1,50 @@
+from backend.audio import PCM24K_BYTES_PER_MS
+from backend.playout import PlayoutTracker
+
+def _ms(ms: float) -> int:
+    return int(ms * PCM24K_BYTES_PER_MS)
+
+def test_interrupt_truncates_to_played_audio():
+    tracker = PlayoutTracker(playout_delay_ms=100)
+    tracker.on_audio("item_1", _ms(2000), now=10.0)
+    # 500 ms later, 400 ms were played after the playout delay
+    assert tracker.interrupt(now=10.5) == ("item_1", 400)
+    assert tracker.is_cancelled("item_1")
+
+def test_played_audio_is_capped_at_forwarded_audio():
+    tracker = PlayoutTracker(playout_delay_ms=0)
+    tracker.on_audio("item_1", _ms(300), now=10.0)
+    assert tracker.played_ms(now=11.0) == 300
+    # Everything was heard, there is nothing to truncate
+    assert tracker.interrupt(now=11.0) is None
+    assert not tracker.is_cancelled("item_1")
+
+def test_nothing_played_during_playout_delay():
+    tracker = PlayoutTracker(playout_delay_ms=200)
+    tracker.on_audio("item_1", _ms(1000), now=10.0)
+    assert tracker.interrupt(now=10.1) == ("item_1", 0)
+
+def test_new_item_starts_over():
+    tracker = PlayoutTracker(playout_delay_ms=0)
+    tracker.on_audio("item_1", _ms(1000), now=10.0)
+    tracker.on_audio("item_2", _ms(1000), now=12.0)
+    assert tracker.forwarded_ms == 1000
+    assert tracker.interrupt(now=12.25) == ("item_2", 250)
+
+def test_unsent_audio_was_not_played():
+    tracker = PlayoutTracker(playout_delay_ms=0)
+    tracker.on_audio("item_1", _ms(5000), now=10.0)
+    tracker.on_unsent(4000)
+    assert tracker.forwarded_ms == 1000
+    assert tracker.interrupt(now=12.0) is None
+
+def test_interrupt_without_audio():
+    assert PlayoutTracker(playout_delay_ms=0).interrupt(now=1.0) is None
+
+def test_cancelled_items_are_bounded():
+    tracker = PlayoutTracker(playout_delay_ms=0)
+    for i in range(PlayoutTracker.MAX_CANCELLED_ITEMS + 1):
+        tracker.on_audio(f"item_{i}", _ms(1000), now=float(i))
+        tracker.interrupt(now=float(i))
+    assert not tracker.is_cancelled("item_0")
+    assert tracker.is_cancelled(f"item_{PlayoutTracker.MAX_CANCELLED_ITEMS}")
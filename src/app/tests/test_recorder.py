@@ -0,0 +1,41 @@
+import base64
+import json
+from backend.recorder import FROM_CLIENT, FROM_SERVER, Recording, SessionRecorder
+
+_AUDIO = base64.b64encode(bytes(range(256)) * 8).decode("ascii")
+
+_FRAMES = [
+    (FROM_CLIENT, json.dumps({ "type": "session.update", "session": { "instructions": "Bé brief." } })),
+    (FROM_CLIENT, json.dumps({ "type": "input_audio_buffer.append", "audio": _AUDIO })),
+    (FROM_SERVER, json.dumps({ "type": "response.audio.delta", "item_id": "item_1", "delta": _AUDIO })),
+    (FROM_SERVER, json.dumps({ "type": "response.done" })),
+]
+
+def test_recorded_frames_are_read_back(tmp_path):
+    recorder = SessionRecorder(str(tmp_path), "session_1", "web")
+    for direction, raw in _FRAMES:
+        recorder.record(direction, raw)
+    recorder.close().result(timeout=5)
+    recording = Recording(str(tmp_path / "session_1"))
+    assert not recording.is_acs
+    assert [(direction, text) for _, direction, text in recording.frames()] == _FRAMES
+    assert [text for _, _, text in recording.frames(FROM_SERVER)] == [raw for _, raw in _FRAMES[2:]]
+
+def test_frames_are_written_in_order_across_flushes(tmp_path, monkeypatch):
+    monkeypatch.setattr(SessionRecorder, "FLUSH_BYTES", 4096)
+    recorder = SessionRecorder(str(tmp_path), "session_1", "acs")
+    frames = [(i % 2, json.dumps({ "type": "input_audio_buffer.append", "event_id": f"event_{i}", "audio": _AUDIO })) for i in range(50)]
+    for direction, raw in frames:
+        recorder.record(direction, raw)
+    recorder.close().result(timeout=5)
+    recording = Recording(str(tmp_path / "session_1.idx"))
+    assert recording.is_acs and len(recording) == 50
+    assert [(direction, text) for _, direction, text in recording.frames()] == frames
+
+def test_unwritable_directory_does_not_break_the_session(tmp_path):
+    blocker = tmp_path / "file"
+    blocker.write_text("")
+    recorder = SessionRecorder(str(blocker / "recordings"), "session_1", "web")
+    recorder.record(FROM_CLIENT, _FRAMES[1][1])
+    recorder.flush()
+    recorder.close().result(timeout=5)
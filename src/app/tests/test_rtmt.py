@@ -0,0 +1,132 @@
+import asyncio
+import json
+from azure.core.credentials import AzureKeyCredential
+from backend.rtmt import RTMiddleTier, RTSession
+from backend.tools.tools import Tool, ToolResult, ToolResultDirection
+
+class FakeWebSocket:
+    def __init__(self):
+        self.sent: list[str] = []
+
+    async def send_str(self, data: str):
+        self.sent.append(data)
+
+    def events(self) -> list[dict]:
+        return [json.loads(data) for data in self.sent]
+
+def _middle_tier(speculative_tools: bool = False) -> RTMiddleTier:
+    rtmt = RTMiddleTier("https://example.openai.azure.com", "gpt-4o-realtime", AzureKeyCredential("key"), speculative_tools=speculative_tools)
+    calls = []
+
+    async def search(args, context):
+        calls.append(args)
+        return ToolResult(f"results for {args['query']}", ToolResultDirection.TO_SERVER)
+
+    schema = { "type": "function", "name": "search", "parameters": { "type": "object", "properties": { "query": { "type": "string" } }, "required": ["query"] } }
+    rtmt.tools["search"] = Tool(target=search, schema=schema, speculative=True)
+    rtmt.search_calls = calls
+    return rtmt
+
+def _session() -> RTSession:
+    session = RTSession("session", FakeWebSocket(), False, "alloy")
+    session.server_ws = FakeWebSocket()
+    return session
+
+def _function_call_events(call_id: str, response_id: str, arguments: str) -> list[dict]:
+    return [
+        { "type": "conversation.item.created", "previous_item_id": "item_0", "item": { "type": "function_call", "call_id": call_id, "name": "search" } },
+        { "type": "response.function_call_arguments.done", "response_id": response_id, "call_id": call_id, "arguments": arguments },
+    ]
+
+async def _send(rtmt: RTMiddleTier, session: RTSession, events: list[dict]):
+    for event in events:
+        await rtmt._process_message_to_client(json.dumps(event), session)
+
+def test_malformed_speculative_arguments_skip_speculation():
+    async def run():
+        rtmt = _middle_tier(speculative_tools=True)
+        session = _session()
+        await _send(rtmt, session, _function_call_events("call_1", "resp_1", '{"query": "refu'))
+        assert session.tools_pending["call_1"].speculative_task is None
+        session.close()
+
+    asyncio.run(run())
+
+def test_speculative_call_starts_with_complete_arguments():
+    async def run():
+        rtmt = _middle_tier(speculative_tools=True)
+        session = _session()
+        await _send(rtmt, session, _function_call_events("call_1", "resp_1", '{"query": "refunds"}'))
+        assert session.tools_pending["call_1"].speculative_args == { "query": "refunds" }
+        session.close()
+
+    asyncio.run(run())
+
+def _function_call_done(call_id: str, response_id: str, arguments: str) -> dict:
+    return {
+        "type": "response.output_item.done",
+        "response_id": response_id,
+        "item": { "type": "function_call", "call_id": call_id, "name": "search", "arguments": arguments },
+    }
+
+def _response_done(response_id: str, status: str = "completed") -> dict:
+    return { "type": "response.done", "response": { "id": response_id, "status": status, "output": [] } }
+
+def test_tool_output_is_sent_before_the_next_response():
+    async def run():
+        rtmt = _middle_tier()
+        session = _session()
+        await _send(rtmt, session, _function_call_events("call_1", "resp_1", '{"query": "refunds"}') + [
+            _function_call_done("call_1", "resp_1", '{"query": "refunds"}'),
+            _response_done("resp_1"),
+        ])
+        await asyncio.sleep(0.05)
+
+        events = session.server_ws.events()
+        assert [event["type"] for event in events] == ["conversation.item.create", "response.create"]
+        assert events[0]["item"] == { "type": "function_call_output", "call_id": "call_1", "output": "results for refunds" }
+        assert session.tools_pending == {}
+        session.close()
+
+    asyncio.run(run())
+
+def test_tool_calls_of_other_responses_wait_for_their_own_response():
+    async def run():
+        rtmt = _middle_tier()
+        session = _session()
+        await _send(rtmt, session, _function_call_events("call_1", "resp_2", '{"query": "refunds"}') + [
+            _function_call_done("call_1", "resp_2", '{"query": "refunds"}'),
+            _response_done("resp_1"),
+        ])
+        await asyncio.sleep(0.05)
+        assert "call_1" in session.tools_pending
+        assert [event["type"] for event in session.server_ws.events()] == ["conversation.item.create"]
+        session.close()
+
+    asyncio.run(run())
+
+def test_unfinished_tool_calls_are_dropped_when_their_response_ends():
+    async def run():
+        rtmt = _middle_tier(speculative_tools=True)
+        session = _session()
+        # The response is interrupted after the arguments were streamed, the call never completes
+        await _send(rtmt, session, _function_call_events("call_1", "resp_1", '{"query": "refunds"}'))
+        speculative_task = session.tools_pending["call_1"].speculative_task
+        await _send(rtmt, session, [_response_done("resp_1", "cancelled")])
+        await asyncio.sleep(0)
+
+        assert session.tools_pending == {}
+        assert speculative_task.cancelled() or speculative_task.done()
+        assert session.server_ws.events() == []
+        session.close()
+
+    asyncio.run(run())
+
+def test_client_voice_applies_to_its_session_only():
+    rtmt = _middle_tier()
+    assert rtmt._create_session(FakeWebSocket(), False, "coral").selected_voice == "coral"
+    assert rtmt._create_session(FakeWebSocket(), False).selected_voice == rtmt.selected_voice
+
+def test_unsupported_voice_falls_back_to_default():
+    rtmt = _middle_tier()
+    assert rtmt._create_session(FakeWebSocket(), False, "not-a-voice").selected_voice == rtmt.selected_voice
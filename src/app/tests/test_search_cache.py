@@ -0,0 +1,36 @@
+import asyncio
+import pytest
+from backend.tools.rag.search_cache import SearchResultCache
+
+def test_expired_result_is_available_after_failed_fetch():
+    async def run():
+        cache = SearchResultCache(ttl_seconds=0)
+
+        async def fetch_ok():
+            return ["chunk"]
+
+        async def fetch_fails():
+            raise ConnectionError("search is down")
+
+        assert await cache.get_or_fetch("What is covered?", fetch_ok) == ["chunk"]
+        assert cache.peek("what is covered") is None
+
+        with pytest.raises(ConnectionError):
+            await cache.get_or_fetch("What is covered?", fetch_fails)
+        assert cache.peek("what is covered", allow_expired=True) == ["chunk"]
+
+    asyncio.run(run())
+
+def test_expired_result_is_replaced_by_new_fetch():
+    async def run():
+        cache = SearchResultCache(ttl_seconds=0)
+
+        async def fetch(value):
+            return value
+
+        await cache.get_or_fetch("query", lambda: fetch(["old"]))
+        assert await cache.get_or_fetch("query", lambda: fetch(["new"])) == ["new"]
+        assert cache.peek("query", allow_expired=True) == ["new"]
+        assert cache.misses == 2
+
+    asyncio.run(run())
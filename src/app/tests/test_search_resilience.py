@@ -0,0 +1,127 @@
+import asyncio
+import pytest
+from backend.tools.rag.search_resilience import SearchResilience, SearchUnavailableError
+
+async def _fails():
+    raise ConnectionError("search is down")
+
+async def _hangs():
+    await asyncio.sleep(3600)
+
+async def _answers(value="ok"):
+    return value
+
+def test_slow_call_is_hedged_and_first_answer_wins():
+    async def run():
+        resilience = SearchResilience(hedge_percentile=95)
+        resilience.DEFAULT_HEDGE_SECONDS = 0.01
+        calls = 0
+
+        async def fetch():
+            nonlocal calls
+            calls += 1
+            if calls == 1:
+                await asyncio.sleep(3600)
+            return "hedged"
+
+        assert await resilience.call("search", fetch) == "hedged"
+        assert calls == 2
+
+    asyncio.run(run())
+
+def test_no_hedge_when_disabled():
+    async def run():
+        resilience = SearchResilience(hedge_percentile=0)
+        calls = 0
+
+        async def fetch():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.02)
+            return "ok"
+
+        assert await resilience.call("search", fetch) == "ok"
+        assert calls == 1
+
+    asyncio.run(run())
+
+def test_circuit_opens_after_repeated_failures():
+    async def run():
+        resilience = SearchResilience(failure_threshold=2, open_seconds=60)
+        for _ in range(2):
+            with pytest.raises(ConnectionError):
+                await resilience.call("search", _fails)
+        assert resilience.is_open
+
+        called = False
+
+        async def fetch():
+            nonlocal called
+            called = True
+            return "ok"
+
+        with pytest.raises(SearchUnavailableError):
+            await resilience.call("search", fetch)
+        assert not called
+
+    asyncio.run(run())
+
+def test_hung_calls_time_out_and_open_the_circuit():
+    async def run():
+        resilience = SearchResilience(hedge_percentile=0, failure_threshold=2, timeout_seconds=0.01)
+        for _ in range(2):
+            with pytest.raises(TimeoutError):
+                await resilience.call("search", _hangs)
+        assert resilience.is_open
+
+    asyncio.run(run())
+
+def test_half_open_trial_closes_the_circuit_on_success():
+    async def run():
+        resilience = SearchResilience(failure_threshold=1, open_seconds=0.01)
+        with pytest.raises(ConnectionError):
+            await resilience.call("search", _fails)
+        assert resilience.is_open
+
+        await asyncio.sleep(0.02)
+        assert await resilience.call("search", _answers) == "ok"
+        assert not resilience.is_open
+        assert resilience.succeeded
+
+    asyncio.run(run())
+
+def test_half_open_trial_reopens_the_circuit_on_failure():
+    async def run():
+        resilience = SearchResilience(failure_threshold=3, open_seconds=0.01)
+        for _ in range(3):
+            with pytest.raises(ConnectionError):
+                await resilience.call("search", _fails)
+
+        await asyncio.sleep(0.02)
+        # A single failed trial is enough to open the circuit again
+        with pytest.raises(ConnectionError):
+            await resilience.call("search", _fails)
+        with pytest.raises(SearchUnavailableError):
+            await resilience.call("search", _answers)
+
+    asyncio.run(run())
+
+def test_only_one_trial_call_while_half_open():
+    async def run():
+        resilience = SearchResilience(hedge_percentile=0, failure_threshold=1, open_seconds=0.01)
+        with pytest.raises(ConnectionError):
+            await resilience.call("search", _fails)
+        await asyncio.sleep(0.02)
+
+        trial = asyncio.ensure_future(resilience.call("search", lambda: _delayed("ok", 0.05)))
+        await asyncio.sleep(0)
+        with pytest.raises(SearchUnavailableError):
+            await resilience.call("search", _answers)
+        assert await trial == "ok"
+        assert not resilience.is_open
+
+    asyncio.run(run())
+
+async def _delayed(value, seconds):
+    await asyncio.sleep(seconds)
+    return value
@@ -0,0 +1,115 @@
+import asyncio
+from backend.send_queue import SendQueue
+
+class Receiver:
+    def __init__(self):
+        self.frames: list[str] = []
+
+    async def send(self, data: str):
+        self.frames.append(data)
+
+def test_frames_are_sent_in_order():
+    async def run():
+        receiver = Receiver()
+        queue = SendQueue(receiver.send, "to_client", max_audio_ms=1000)
+        writer = asyncio.create_task(queue.run())
+        for i in range(3):
+            queue.put(f"control_{i}")
+            queue.put(f"audio_{i}", 20)
+        await queue.drain(1)
+        await writer
+        assert receiver.frames == ["control_0", "audio_0", "control_1", "audio_1", "control_2", "audio_2"]
+        assert queue.audio_ms == 0
+
+    asyncio.run(run())
+
+def test_oldest_audio_is_dropped_when_full_and_control_frames_are_kept():
+    async def run():
+        receiver = Receiver()
+        queue = SendQueue(receiver.send, "to_client", max_audio_ms=100)
+        # Nothing is written until the writer runs, so everything below is queued
+        queue.put("audio_0", 40)
+        queue.put("control_0")
+        queue.put("audio_1", 40)
+        queue.put("audio_2", 40)
+        assert queue.audio_ms == 80
+        writer = asyncio.create_task(queue.run())
+        await queue.drain(1)
+        await writer
+        assert receiver.frames == ["control_0", "audio_1", "audio_2"]
+
+    asyncio.run(run())
+
+def test_discard_audio_returns_dropped_duration():
+    async def run():
+        queue = SendQueue(Receiver().send, "to_client", max_audio_ms=1000)
+        queue.put("audio_0", 20)
+        queue.put("control_0")
+        queue.put("audio_1", 30)
+        assert queue.discard_audio() == 50
+        assert queue.audio_ms == 0
+        assert len(queue) == 1
+
+    asyncio.run(run())
+
+def test_closed_queue_ignores_new_frames():
+    async def run():
+        receiver = Receiver()
+        queue = SendQueue(receiver.send, "to_server", max_audio_ms=1000)
+        writer = asyncio.create_task(queue.run())
+        queue.put("before")
+        await queue.drain(1)
+        await writer
+        queue.put("after")
+        assert receiver.frames == ["before"]
+
+    asyncio.run(run())
+
+def test_writer_stops_when_the_socket_fails():
+    async def run():
+        async def send(data: str):
+            raise ConnectionResetError("gone")
+
+        queue = SendQueue(send, "to_client", max_audio_ms=1000)
+        queue.put("control_0")
+        queue.put("audio_0", 20)
+        await asyncio.wait_for(queue.run(), 1)
+        assert len(queue) == 0 and queue.audio_ms == 0
+
+    asyncio.run(run())
+
+def test_paced_audio_is_sent_at_real_time_rate():
+    async def run():
+        receiver = Receiver()
+        queue = SendQueue(receiver.send, "to_client", max_audio_ms=10000, lead_ms=50)
+        for i in range(5):
+            queue.put(f"audio_{i}", 40)
+        writer = asyncio.create_task(queue.run())
+        await asyncio.sleep(0.01)
+        # Only the lead is sent ahead, the rest waits until the receiver has played enough
+        assert receiver.frames == ["audio_0", "audio_1"]
+        await asyncio.sleep(0.15)
+        assert len(receiver.frames) == 5
+        await queue.drain(1)
+        await writer
+
+    asyncio.run(run())
+
+def test_discarding_paced_audio_takes_effect_immediately():
+    async def run():
+        receiver = Receiver()
+        queue = SendQueue(receiver.send, "to_client", max_audio_ms=10000, lead_ms=50)
+        for i in range(10):
+            queue.put(f"audio_{i}", 40)
+        writer = asyncio.create_task(queue.run())
+        await asyncio.sleep(0.01)
+        assert queue.discard_audio() == 320
+        queue.put("control_0")
+        # Pacing starts over, the next answer goes out right away
+        queue.put("audio_next", 40)
+        await asyncio.sleep(0.01)
+        assert receiver.frames == ["audio_0", "audio_1", "control_0", "audio_next"]
+        await queue.drain(1)
+        await writer
+
+    asyncio.run(run())
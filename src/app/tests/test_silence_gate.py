@@ -0,0 +1,48 @@
+import base64
+import numpy as np
+from backend.audio import SilenceGate
+
+def _chunk(amplitude: float, ms: int = 20) -> str:
+    samples = np.full(24 * ms, amplitude, dtype="<i2")
+    samples[::2] *= -1
+    return base64.b64encode(samples.tobytes()).decode("ascii")
+
+_SILENCE = _chunk(0)
+# About -20 dBFS, well above the threshold of the tests
+_SPEECH = _chunk(3000)
+
+def test_silence_is_held_back():
+    gate = SilenceGate(threshold_dbfs=-50)
+    for _ in range(10):
+        assert gate.process(_SILENCE) == []
+    assert gate.suppressed_ms == 200
+
+def test_speech_releases_padding_before_it():
+    gate = SilenceGate(threshold_dbfs=-50, padding_ms=60)
+    silences = [_chunk(i % 3) for i in range(10)]
+    for chunk in silences:
+        gate.process(chunk)
+    # Only the last padding_ms of held back audio is released, in order, followed by the speech
+    assert gate.process(_SPEECH) == silences[-3:] + [_SPEECH]
+    assert gate.suppressed_ms == 140
+
+def test_audio_keeps_flowing_during_hangover():
+    gate = SilenceGate(threshold_dbfs=-50, hangover_ms=100, padding_ms=0)
+    assert gate.process(_SPEECH) == [_SPEECH]
+    for _ in range(5):
+        assert gate.process(_SILENCE) == [_SILENCE]
+    assert gate.process(_SILENCE) == []
+
+def test_speech_during_hangover_restarts_it():
+    gate = SilenceGate(threshold_dbfs=-50, hangover_ms=60, padding_ms=0)
+    gate.process(_SPEECH)
+    gate.process(_SILENCE)
+    gate.process(_SILENCE)
+    gate.process(_SPEECH)
+    for _ in range(3):
+        assert gate.process(_SILENCE) == [_SILENCE]
+    assert gate.process(_SILENCE) == []
+
+def test_threshold():
+    assert SilenceGate(threshold_dbfs=-30).process(_chunk(500)) == []
+    assert SilenceGate(threshold_dbfs=-40).process(_chunk(500)) == [_chunk(500)]